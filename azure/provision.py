@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 
-import os
-import subprocess
+from common.daemon_client import forward_to_daemon
+
+# Runs the command in the provisioner daemon when one is listening, before the
+# imports that the daemon already has.
+forward_to_daemon(__name__, __file__)
+
+from collections import namedtuple
 from pathlib import Path
 
 from common.cli_utils import get_app
+from common.kubeconfig_utils import get_kubelogin_cache_dir, write_kubeconfig
 from common.provisioner_utils import (
+    ProvisionerTools,
+    add_provisioner_commands,
+    get_affected_stacks,
+    get_terraform_changes,
     get_terraform_output,
     init_environment,
+    print_unaffected,
+    read_unchanged_outputs,
+    run_kubelogin,
     run_terraform,
+    run_terraform_init,
 )
-from common.utils import get_env_value
+from common.target_utils import print_target_warning
+from common.trace_utils import trace_span
+from common.utils import get_env_value, write_text_if_changed
 
 SCRIPT_PATH = Path(__file__)
 OUTPUTS_DIR = SCRIPT_PATH.parent.parent / "outputs"
@@ -18,6 +34,7 @@ KUBECONFIG_PATH = OUTPUTS_DIR / "unicorns-aks-kubeconfig"
 ENV_PATH = OUTPUTS_DIR / "azure.env"
 
 app = get_app()
+add_provisioner_commands(app, SCRIPT_PATH)
 
 ENV_TF_VARS = {
     "subscription_id": ("ARM_SUBSCRIPTION_ID", "AZURE_SUBSCRIPTION_ID"),
@@ -29,6 +46,13 @@ ENV_TF_VARS = {
 
 AKS_ADMIN_GROUP_ENV = "AZURE_AKS_ADMIN_GROUP_OBJECT_IDS"
 
+# What later stacks need from this one. The same values are written to
+# azure.env for stacks that run in another process.
+StackOutputs = namedtuple(
+    "StackOutputs",
+    ["aks_cluster_name", "ingress_external_ip", "kube_config_path"],
+)
+
 
 def get_tf_vars():
     variables = {
@@ -93,37 +117,77 @@ def write_stack_outputs(outputs: dict):
         "KUBE_CONFIG_PATH": str(KUBECONFIG_PATH.resolve()),
     }
     kubeconfig = require_output(outputs, "aks_kube_config")
+    login_args = [
+        "--login",
+        "spn",
+        "--client-id",
+        client_id,
+        "--tenant-id",
+        tenant_id,
+        "--token-cache-dir",
+        str(get_kubelogin_cache_dir()),
+    ]
+
+    def convert_kubeconfig(path: Path):
+        with trace_span("kubelogin", stack=SCRIPT_PATH.parent.name):
+            run_kubelogin(
+                ["convert-kubeconfig", "--kubeconfig", str(path), *login_args]
+            )
 
     OUTPUTS_DIR.mkdir(parents=True, exist_ok=True)
-    KUBECONFIG_PATH.write_text(kubeconfig)
-    subprocess.run(
-        [
-            "kubelogin",
-            "convert-kubeconfig",
-            "--kubeconfig",
-            str(KUBECONFIG_PATH),
-            "--login",
-            "spn",
-            "--client-id",
-            client_id,
-            "--tenant-id",
-            tenant_id,
-        ],
-        check=True,
+    write_kubeconfig(
+        KUBECONFIG_PATH,
+        kubeconfig,
+        login_args,
+        convert_kubeconfig,
+    )
+    write_text_if_changed(
+        ENV_PATH,
+        "".join(f"{name}={value}\n" for name, value in values.items()),
     )
-    output_owner = OUTPUTS_DIR.stat()
-    os.chown(KUBECONFIG_PATH, output_owner.st_uid, output_owner.st_gid)
-    KUBECONFIG_PATH.chmod(0o600)
-    ENV_PATH.write_text(
-        "".join(f"{name}={value}\n" for name, value in values.items())
+
+    return StackOutputs(
+        aks_cluster_name=values["AKS_CLUSTER_NAME"],
+        ingress_external_ip=values["INGRESS_EXTERNAL_IP"],
+        kube_config_path=KUBECONFIG_PATH.resolve(),
     )
 
 
+# A saved plan without changes already holds the outputs.
+def provision(tools: ProvisionerTools, force: bool = False, targets=None):
+    run_terraform(tools, get_tf_vars(), force=force, targets=targets)
+    outputs = read_unchanged_outputs(tools.env)
+    return write_stack_outputs(outputs or get_terraform_output(tools.env))
+
+
+# For stacks that need the outputs when nothing in this one has changed.
+def read_stack_outputs(tools: ProvisionerTools):
+    run_terraform_init(tools.env)
+    return write_stack_outputs(get_terraform_output(tools.env))
+
+
+@app.command()
+def all(
+    force: bool = False,
+    changed_since: str = None,
+    target: list[str] = None,
+):
+    if changed_since and SCRIPT_PATH.parent.name not in get_affected_stacks(
+        changed_since
+    ):
+        print_unaffected(SCRIPT_PATH.parent.name, changed_since)
+        return
+
+    provision(init_environment(SCRIPT_PATH, use_terraform=True), force, target)
+    if target:
+        print_target_warning(SCRIPT_PATH.parent.name, target)
+
+
+# Whether `all` would change anything, for example for `jq -e .changed`
 @app.command()
-def all():
+def changes():
     tools = init_environment(SCRIPT_PATH, use_terraform=True)
-    run_terraform(tools, get_tf_vars())
-    write_stack_outputs(get_terraform_output(tools.env))
+    return get_terraform_changes(tools, get_tf_vars())
 
 
 if __name__ == "__main__":
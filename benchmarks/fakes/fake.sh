@@ -0,0 +1,103 @@
+# Shared behaviour of the fake tools used by the benchmarks.
+#
+# FAKE_LATENCY        seconds that every command takes (default 0)
+# FAKE_OUTPUT_BYTES   size of the kubeconfig in `terraform output` (default 1024)
+# FAKE_FAIL           space-separated commands that fail, as `command` or
+#                     `command:project`, for example "apply:system"
+# FAKE_LOCKED         like FAKE_FAIL, but each command fails once with a state
+#                     lock error, which needs FAKE_LOG
+# FAKE_LOG            file that gets one line per call
+# FAKE_CHANGES        space-separated projects whose saved plans have changes
+
+fake_run() {
+    tool="$1"
+    command="$2"
+    project="$3"
+    shift 3
+
+    if [ -n "$FAKE_LOG" ]; then
+        echo "$tool $command $project" >> "$FAKE_LOG"
+    fi
+
+    if [ "${FAKE_LATENCY:-0}" != "0" ]; then
+        sleep "$FAKE_LATENCY"
+    fi
+
+    for failure in $FAKE_FAIL; do
+        if [ "$failure" = "$command" ] || [ "$failure" = "$command:$project" ]; then
+            echo "Error: simulated failure of $tool $command in $project" >&2
+            exit 1
+        fi
+    done
+
+    for locked in $FAKE_LOCKED; do
+        marker="$FAKE_LOG.locked-$command-$project"
+        if { [ "$locked" = "$command" ] || [ "$locked" = "$command:$project" ]; } \
+            && [ ! -e "$marker" ]; then
+            touch "$marker"
+            printf 'Error: Error acquiring the state lock\n\nLock Info:\n' >&2
+            printf '  ID:        fake-lock\n  Who:       fake@benchmark\n' >&2
+            printf '  Operation: OperationTypeApply\n' >&2
+            exit 1
+        fi
+    done
+
+    case "$command" in
+        init)
+            mkdir -p "${TF_DATA_DIR:-.terraform}"
+            if [ -n "$TERRAGRUNT_DOWNLOAD" ]; then
+                mkdir -p "$TERRAGRUNT_DOWNLOAD"
+            fi
+            echo "Terraform has been successfully initialized!"
+            ;;
+        plan | apply)
+            for arg in "$@"; do
+                case "$arg" in
+                    -out=*) echo "fake plan" > "${arg#-out=}" ;;
+                esac
+            done
+            echo "$command: 0 to add, 0 to change, 0 to destroy."
+            ;;
+        state)
+            if [ "$1" = "list" ]; then
+                echo "azurerm_resource_group.main"
+                echo 'helm_release.release["ingress"]'
+                exit 0
+            fi
+            printf '{"version": 4, "serial": 1, "outputs": '
+            printf '{"aks_cluster_name": {"value": "cluster", "type": "string"}}}\n'
+            ;;
+        show)
+            action="no-op"
+            for changed in $FAKE_CHANGES; do
+                if [ "$changed" = "$project" ]; then
+                    action="update"
+                fi
+            done
+            printf '{"resource_changes": [{"address": "azurerm_resource_group.main", '
+            printf '"change": {"actions": ["%s"]}}], ' "$action"
+            printf '"prior_state": {"values": {"outputs": {'
+            printf '"aks_cluster_name": {"sensitive": false, "value": "cluster"}, '
+            printf '"ingress_static_ip": {"sensitive": false, "value": "192.0.2.1"}, '
+            printf '"aks_kube_config": {"sensitive": true, "value": "'
+            head -c "${FAKE_OUTPUT_BYTES:-1024}" /dev/zero | tr '\0' 'x'
+            printf '"}}}}}\n'
+            ;;
+        graph)
+            echo 'digraph {'
+            echo '  "[root] azurerm_resource_group.main (expand)" [label = "main"]'
+            echo '  "[root] helm_release.release (expand)" [label = "release"]'
+            echo '  "[root] var.location" [label = "var.location"]'
+            echo '  "[root] azurerm_resource_group.main (expand)" -> "[root] var.location"'
+            echo '  "[root] helm_release.release (expand)" -> "[root] azurerm_resource_group.main (expand)"'
+            echo '}'
+            ;;
+        output)
+            printf '{"aks_cluster_name": {"value": "cluster"}, '
+            printf '"ingress_static_ip": {"value": "192.0.2.1"}, '
+            printf '"aks_kube_config": {"sensitive": true, "value": "'
+            head -c "${FAKE_OUTPUT_BYTES:-1024}" /dev/zero | tr '\0' 'x'
+            printf '"}}\n'
+            ;;
+    esac
+}
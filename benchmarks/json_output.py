@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import math
+import time
+import tracemalloc
+from json import JSONDecodeError, JSONDecoder
+
+from common.cli_utils import TyperOutputFormat, get_app
+from common.json_utils import iter_json_objects, read_chunks
+
+DEFAULT_SIZES = [
+    10 * 1024,
+    100 * 1024,
+    1024 * 1024,
+    10 * 1024 * 1024,
+    50 * 1024 * 1024,
+]
+
+NOISE_LINE = 'Warning: unexpected "{" while reading the state {\n'
+VALUE_LINE = (
+    'users: [{"name": "clusterUser", "user": {"exec": '
+    '{"args": ["--login", "spn"], "env": null}}}]\n'
+)
+
+app = get_app(default_output_format=TyperOutputFormat.json)
+
+
+# Builds `terraform output -json` text of roughly `size` bytes. Diagnostics
+# with stray braces surround a document whose kubeconfig-like value is full of
+# braces and escaped quotes, like the aks_kube_config output.
+def make_output(size: int):
+    noise = NOISE_LINE * max(size // 10 // len(NOISE_LINE), 1)
+    value = VALUE_LINE * max((size - 2 * len(noise)) // len(VALUE_LINE), 1)
+    document = json.dumps(
+        {
+            "aks_cluster_name": {"sensitive": False, "value": "cluster"},
+            "aks_kube_config": {"sensitive": True, "value": value},
+        }
+    )
+    return noise + document + "\n" + noise
+
+
+# The scanner that get_terraform_output used before the single-pass
+# extractor: a raw_decode of a copy of the remaining text at every "{".
+def legacy_json_objects(text: str):
+    decoder = JSONDecoder()
+    objects = []
+    position = 0
+    while (start := text.find("{", position)) != -1:
+        try:
+            value, length = decoder.raw_decode(text[start:])
+            if isinstance(value, dict):
+                objects.append(value)
+            position = start + length
+        except JSONDecodeError:
+            position = start + 1
+
+    return objects
+
+
+def measure(extract, text: str, repeat: int):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        objects = extract(text)
+        durations.append(time.perf_counter() - start)
+
+    if len(objects) != 1:
+        raise RuntimeError(f"Expected one JSON object, found {len(objects)}")
+
+    tracemalloc.start()
+    extract(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(durations), peak
+
+
+def get_scaling_exponent(results: list):
+    points = [
+        (math.log(result["bytes"]), math.log(result["seconds"]))
+        for result in results
+    ]
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / sum(
+        (x - mean_x) ** 2 for x, _ in points
+    )
+
+
+@app.command()
+def scaling(
+    sizes: list[int] = DEFAULT_SIZES,
+    repeat: int = 3,
+    legacy_max_bytes: int = 1024 * 1024,
+    max_exponent: float = 1.2,
+):
+    results = []
+    legacy_results = []
+    for size in sizes:
+        text = make_output(size)
+        seconds, peak = measure(
+            lambda text: list(iter_json_objects(read_chunks(io.StringIO(text)))),
+            text,
+            repeat,
+        )
+        results.append(
+            {
+                "bytes": len(text),
+                "seconds": seconds,
+                "mb_per_second": len(text) / seconds / 1024 / 1024,
+                "peak_memory_ratio": peak / len(text),
+            }
+        )
+
+        if len(text) <= legacy_max_bytes:
+            seconds, peak = measure(legacy_json_objects, text, repeat)
+            legacy_results.append(
+                {
+                    "bytes": len(text),
+                    "seconds": seconds,
+                    "peak_memory_ratio": peak / len(text),
+                }
+            )
+
+    # Fixed costs dominate the smallest inputs, so the fit starts at 1 MB when
+    # there are enough larger sizes.
+    fitted = [result for result in results if result["bytes"] >= 1024 * 1024]
+    exponent = get_scaling_exponent(fitted if len(fitted) >= 2 else results)
+    if exponent > max_exponent:
+        raise RuntimeError(
+            f"JSON extraction scales with exponent {exponent:.2f}, "
+            f"above the limit of {max_exponent}"
+        )
+
+    return {
+        "scaling_exponent": exponent,
+        "streaming": results,
+        "legacy": legacy_results,
+    }
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import typer
+
+from common.cli_utils import TyperOutputFormat, get_app
+
+BASE_DIR = Path(__file__).parent.parent
+FAKES_DIR = BASE_DIR / "benchmarks" / "fakes"
+DEFAULT_BASELINE = BASE_DIR / "benchmarks" / "baselines" / "orchestration.json"
+DEFAULT_PROJECT_COUNTS = [1, 10, 50, 100, 200]
+DEFAULT_OUTPUT_SIZES_MB = [1, 16, 64]
+COPIED_DIRS = ["common", "azure", "kubernetes-shared"]
+COPIED_FILES = ["pipeline.py"]
+IGNORED_FILES = shutil.ignore_patterns(
+    "__pycache__",
+    ".terraform",
+    ".terragrunt-cache",
+)
+
+app = get_app(default_output_format=TyperOutputFormat.json)
+
+
+def write_generated_projects(stack_dir: Path, count: int):
+    template = (stack_dir / "system" / "terragrunt.hcl").read_text()
+    for path in stack_dir.iterdir():
+        if (path / "terragrunt.hcl").is_file():
+            shutil.rmtree(path)
+
+    # Each project depends on the one before it in a binary tree, so that the
+    # scheduler has both chains and independent branches.
+    for index in range(count):
+        project_dir = stack_dir / f"project-{index:03}"
+        project_dir.mkdir()
+        dependency = ""
+        if index:
+            dependency = (
+                'dependency "parent" {\n'
+                f'  config_path = "../project-{(index - 1) // 2:03}"\n'
+                "}\n"
+            )
+        (project_dir / "terragrunt.hcl").write_text(template + dependency)
+        (project_dir / "main.tf").write_text("")
+
+
+# The provisioners write next to their code, so every run gets a copy of the
+# repository in a temporary directory instead of the working tree.
+def make_workspace(root: Path, project_count: int | None = None):
+    for name in COPIED_DIRS:
+        shutil.copytree(BASE_DIR / name, root / name, ignore=IGNORED_FILES)
+    for name in COPIED_FILES:
+        shutil.copy2(BASE_DIR / name, root / name)
+
+    if project_count is not None:
+        write_generated_projects(root / "kubernetes-shared", project_count)
+
+    (root / "kubeconfig").write_text("apiVersion: v1\n")
+    return root
+
+
+def get_fake_env(
+    root: Path,
+    latency: float = 0,
+    output_bytes: int = 1024,
+    fail: str = "",
+):
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in ("DRY_RUN", "SAVED_PLAN", "RESOURCE_TIMINGS")
+        and not key.startswith("PROV_")
+    }
+    return {
+        **env,
+        "PATH": f"{FAKES_DIR}{os.pathsep}{env.get('PATH', '')}",
+        "PYTHONPATH": str(root),
+        "PROV_RUN_ROOT": str(root / "run"),
+        "PROV_CACHE_DIR": str(root / "cache"),
+        "NO_CONFIRM": "true",
+        "TF_TOKEN_app_terraform_io": "fake",
+        "ARM_SUBSCRIPTION_ID": "00000000-0000-0000-0000-000000000000",
+        "ARM_CLIENT_ID": "00000000-0000-0000-0000-000000000000",
+        "ARM_TENANT_ID": "00000000-0000-0000-0000-000000000000",
+        "ARM_CLIENT_SECRET": "fake",
+        "AZURE_AKS_ADMIN_GROUP_OBJECT_IDS": "00000000-0000-0000-0000-000000000000",
+        "KUBE_CONFIG_PATH": str(root / "kubeconfig"),
+        "FAKE_LATENCY": str(latency),
+        "FAKE_OUTPUT_BYTES": str(output_bytes),
+        "FAKE_FAIL": fail,
+        "FAKE_LOG": str(root / "fake.log"),
+    }
+
+
+# Every run starts without a cache, so nothing is skipped or restored.
+def run_provisioner(root: Path, script: str, env: dict, args: list):
+    for name in ("run", "cache", "fake.log"):
+        path = root / name
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, str(root / script), *args],
+        cwd=root,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+    log_path = root / "fake.log"
+    tool_calls = len(log_path.read_text().splitlines()) if log_path.exists() else 0
+    return seconds, result.returncode, result.stderr, tool_calls
+
+
+def measure_run(
+    root: Path,
+    script: str,
+    env: dict,
+    args: list,
+    repeat: int,
+    expect_failure: bool = False,
+):
+    runs = [run_provisioner(root, script, env, args) for _ in range(repeat)]
+    for _, returncode, stderr, _ in runs:
+        if bool(returncode) != expect_failure:
+            raise RuntimeError(
+                f"{script} {' '.join(args)} exited with {returncode}:\n{stderr}"
+            )
+
+    seconds, _, _, tool_calls = min(runs, key=lambda run: run[0])
+    return {
+        "milliseconds": round(seconds * 1000, 1),
+        "tool_calls": tool_calls,
+    }
+
+
+@app.command()
+def overhead(repeat: int = 3, latency: float = 0):
+    with tempfile.TemporaryDirectory() as directory:
+        root = make_workspace(Path(directory))
+        env = get_fake_env(root, latency=latency)
+        return {
+            "azure": measure_run(
+                root,
+                "azure/provision.py",
+                env,
+                ["all"],
+                repeat,
+            ),
+            "kubernetes-shared": measure_run(
+                root,
+                "kubernetes-shared/provision.py",
+                env,
+                ["all"],
+                repeat,
+            ),
+            "pipeline": measure_run(
+                root,
+                "pipeline.py",
+                env,
+                ["all"],
+                repeat,
+            ),
+            "kubernetes-shared-failure": measure_run(
+                root,
+                "kubernetes-shared/provision.py",
+                {**env, "FAKE_FAIL": "apply:system"},
+                ["all"],
+                repeat,
+                expect_failure=True,
+            ),
+        }
+
+
+@app.command()
+def scaling(
+    counts: list[int] = DEFAULT_PROJECT_COUNTS,
+    repeat: int = 1,
+    parallelism: int = 4,
+    latency: float = 0,
+):
+    results = {}
+    for count in counts:
+        with tempfile.TemporaryDirectory() as directory:
+            root = make_workspace(Path(directory), project_count=count)
+            result = measure_run(
+                root,
+                "kubernetes-shared/provision.py",
+                get_fake_env(root, latency=latency),
+                ["all", "--parallelism", str(parallelism)],
+                repeat,
+            )
+        result["milliseconds_per_project"] = round(
+            result["milliseconds"] / count,
+            1,
+        )
+        results[str(count)] = result
+
+    return results
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+@app.command(hidden=True)
+def measure_output(root: Path):
+    from common.provisioner_utils import get_terraform_output, init_environment
+
+    tools = init_environment(root / "azure" / "provision.py", use_terraform=True)
+    before = get_peak_rss_mb()
+    outputs = get_terraform_output(tools.env)
+    return {
+        "peak_rss_mb": get_peak_rss_mb(),
+        "increase_mb": round(get_peak_rss_mb() - before, 1),
+        "kubeconfig_bytes": len(outputs["aks_kube_config"]["value"]),
+    }
+
+
+@app.command()
+def output_rss(sizes_mb: list[int] = DEFAULT_OUTPUT_SIZES_MB):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        root = make_workspace(Path(directory))
+        for size in sizes_mb:
+            result = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "measure-output",
+                    str(root),
+                ],
+                env={
+                    **get_fake_env(root, output_bytes=size * 1024 * 1024),
+                    "PYTHONPATH": str(BASE_DIR),
+                },
+                stdout=subprocess.PIPE,
+                text=True,
+                check=True,
+            )
+            results[str(size)] = json.loads(result.stdout)
+
+    return results
+
+
+def flatten_metrics(results: dict, prefix: str = ""):
+    metrics = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten_metrics(value, f"{prefix}{key}."))
+        elif key in ("milliseconds", "milliseconds_per_project", "peak_rss_mb"):
+            metrics[prefix + key] = value
+
+    return metrics
+
+
+# Metrics are compared with the saved baseline and fail the check when they
+# grow by more than `threshold`.
+def get_regressions(results: dict, baseline: dict, threshold: float):
+    current = flatten_metrics(results)
+    return [
+        f"{name}: {current[name]} (baseline {value})"
+        for name, value in flatten_metrics(baseline).items()
+        if name in current and current[name] > value * (1 + threshold)
+    ]
+
+
+@app.command()
+def check(
+    baseline: Path = DEFAULT_BASELINE,
+    threshold: float = 0.25,
+    update: bool = typer.Option(
+        False,
+        help="Save the results as the new baseline instead of comparing.",
+    ),
+):
+    results = {
+        "overhead": overhead(),
+        "scaling": scaling(),
+        "output_rss": output_rss(),
+    }
+
+    if update or not baseline.exists():
+        baseline.parent.mkdir(parents=True, exist_ok=True)
+        baseline.write_text(json.dumps(results, indent=2) + "\n")
+        return results
+
+    if regressions := get_regressions(
+        results,
+        json.loads(baseline.read_text()),
+        threshold,
+    ):
+        raise RuntimeError(
+            f"Slower than the baseline by more than {threshold:.0%}: "
+            + ", ".join(regressions)
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    app()
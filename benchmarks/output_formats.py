@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import yaml
+
+from common.cli_utils import TyperOutputFormat, default_print_retval, get_app
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+app = get_app(default_output_format=TyperOutputFormat.json)
+
+
+# A drift or history record, with the nesting and sets of real results
+def make_records(count: int):
+    for index in range(count):
+        yield {
+            "workspace": f"kubernetes-shared/project-{index % 200}",
+            "address": f"module.apps.helm_release.release[{index}]",
+            "action": "update",
+            "duration": index / 1000,
+            "tags": {"stack": "kubernetes-shared", "labels": {"drift"}},
+        }
+
+
+def print_pure_yaml(records, output_format):
+    print(yaml.dump(list(records), Dumper=yaml.Dumper, default_flow_style=False))
+
+
+# NDJSON gets the generator, the other formats a list, as commands that
+# build their result in memory return.
+FORMATS = {
+    "ndjson": (default_print_retval, TyperOutputFormat.ndjson, False),
+    "json": (default_print_retval, TyperOutputFormat.json, True),
+    "yaml": (default_print_retval, TyperOutputFormat.yaml, True),
+    "yaml_pure_python": (print_pure_yaml, TyperOutputFormat.yaml, True),
+}
+
+
+def write_records(name: str, count: int):
+    print_retval, output_format, collect = FORMATS[name]
+    records = make_records(count)
+    with open(os.devnull, "w") as output, redirect_stdout(output):
+        print_retval(list(records) if collect else records, output_format)
+
+
+def measure(name: str, count: int, measure_memory: bool):
+    start = time.perf_counter()
+    write_records(name, count)
+    result = {"seconds": round(time.perf_counter() - start, 3)}
+    result["records_per_second"] = round(count / result["seconds"])
+
+    if measure_memory:
+        tracemalloc.start()
+        write_records(name, count)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_memory_mb"] = round(peak / 1024 / 1024, 1)
+
+    return result
+
+
+# Pure-Python YAML takes minutes at a million records, so it stops at
+# `pure_python_max_records`. Peak memory is measured in a second run, which
+# tracing slows down, up to `memory_max_records`.
+@app.command()
+def compare(
+    sizes: list[int] = DEFAULT_SIZES,
+    pure_python_max_records: int = 100_000,
+    memory_max_records: int = 100_000,
+):
+    if not hasattr(yaml, "CDumper"):
+        print("PyYAML was built without libyaml, so yaml is pure Python too.")
+
+    results = {}
+    for count in sizes:
+        for name in FORMATS:
+            if name == "yaml_pure_python" and count > pure_python_max_records:
+                continue
+
+            results.setdefault(name, {})[count] = measure(
+                name,
+                count,
+                count <= memory_max_records,
+            )
+
+    return results
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from common.cli_utils import TyperOutputFormat, get_app
+
+BASE_DIR = Path(__file__).parent.parent
+DEFAULT_SCRIPTS = [
+    "azure/provision.py",
+    "kubernetes-shared/provision.py",
+]
+
+IMPORT_TIME_PATTERN = re.compile(
+    r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$",
+    re.MULTILINE,
+)
+
+app = get_app(default_output_format=TyperOutputFormat.json)
+
+
+# Every run is a fresh interpreter, like each `docker compose run` in CI.
+def run_help(script: str):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", script, "--help"],
+        cwd=BASE_DIR,
+        env={**os.environ, "PYTHONPATH": str(BASE_DIR)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    return time.perf_counter() - start, result.stderr
+
+
+def get_slowest_imports(importtime_output: str, count: int):
+    imports = [
+        (match.group(4), int(match.group(2)))
+        for match in IMPORT_TIME_PATTERN.finditer(importtime_output)
+        if len(match.group(3)) <= 3
+    ]
+    return {
+        name: round(microseconds / 1000, 1)
+        for name, microseconds in sorted(
+            imports,
+            key=lambda item: item[1],
+            reverse=True,
+        )[:count]
+    }
+
+
+@app.command()
+def startup(
+    scripts: list[str] = DEFAULT_SCRIPTS,
+    repeat: int = 5,
+    budget_ms: float = 600,
+    top: int = 10,
+):
+    results = {}
+    for script in scripts:
+        runs = [run_help(script) for _ in range(repeat)]
+        seconds, importtime_output = min(runs, key=lambda run: run[0])
+        results[script] = {
+            "milliseconds": round(seconds * 1000, 1),
+            "slowest_imports_ms": get_slowest_imports(importtime_output, top),
+        }
+
+    if over_budget := [
+        script
+        for script, result in results.items()
+        if result["milliseconds"] > budget_ms
+    ]:
+        raise RuntimeError(
+            f"Cold start of --help exceeds {budget_ms} ms: "
+            + ", ".join(
+                f"{script} ({results[script]['milliseconds']} ms)"
+                for script in over_budget
+            )
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    app()
@@ -1,15 +1,19 @@
 import json
 import os
 import sys
+from collections.abc import Iterator
 from enum import Enum
+from pathlib import Path
 
 import typer
-import yaml
+
+from common.trace_utils import start_tracing
 
 
 class TyperOutputFormat(str, Enum):
     yaml = "yaml"
     json = "json"
+    ndjson = "ndjson"
     raw = "raw"
 
 
@@ -22,9 +26,38 @@ class JSONSetEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def default_print_retval(ret: dict | list, output_format: TyperOutputFormat, **kwargs):
+# A mapping gives one record per entry, and a list or generator one per item.
+def iter_records(ret):
+    if isinstance(ret, dict):
+        return ({key: value} for key, value in ret.items())
+    if isinstance(ret, (list, tuple, set, Iterator)):
+        return iter(ret)
+    return iter([ret])
+
+
+def write_ndjson(records, output):
+    encoder = JSONSetEncoder(separators=(",", ":"))
+    for record in records:
+        output.write(encoder.encode(record) + "\n")
+
+
+# Generators are written record by record as NDJSON. The other formats need
+# the whole value, so they collect it first.
+def default_print_retval(ret: dict | list | Iterator, output_format: TyperOutputFormat, **kwargs):
+    if output_format == TyperOutputFormat.ndjson:
+        write_ndjson(iter_records(ret), sys.stdout)
+        return
+
+    if isinstance(ret, Iterator):
+        ret = list(ret)
+
     if output_format == TyperOutputFormat.yaml:
-        print(yaml.dump(ret, default_flow_style=False))
+        # Loaded here, because only YAML output needs it
+        import yaml
+
+        # libyaml's dumper is much faster where PyYAML was built with it
+        dumper = getattr(yaml, "CDumper", yaml.Dumper)
+        print(yaml.dump(ret, Dumper=dumper, default_flow_style=False))
     elif output_format == TyperOutputFormat.json:
         print(json.dumps(ret, indent=2, cls=JSONSetEncoder))
     elif output_format == TyperOutputFormat.raw:
@@ -45,8 +78,15 @@ def get_app(default_output_format: TyperOutputFormat = TyperOutputFormat.yaml, c
 
     if callback_fn is None:
         @app.callback()
-        def default_callback(output_format: TyperOutputFormat = default_output_format):
-            pass
+        def default_callback(
+            output_format: TyperOutputFormat = default_output_format,
+            trace_file: Path = typer.Option(
+                None,
+                help="Write a Chrome trace of the run to this file, and its spans as JSON lines to the same name with .jsonl (trace.json gives trace.jsonl).",
+            ),
+        ):
+            if trace_file:
+                start_tracing(trace_file)
     else:
         app.callback()(callback_fn)
 
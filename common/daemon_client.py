@@ -0,0 +1,162 @@
+import json
+import os
+import re
+import signal
+import socket
+import sys
+from pathlib import Path
+
+# Only the standard library is imported here, because the client runs before
+# the provisioner's own imports.
+
+BASE_DIR = Path(__file__).parent.parent
+DEFAULT_SOCKET_PATH = BASE_DIR / ".cache" / "provisioner.sock"
+# Variables that a request brings along, as docker-compose.yml passes them to
+# the provisioner. The daemon's own values of these are not used.
+FORWARDED_ENV_PATTERN = re.compile(
+    r"(ARM|AZURE|TF|PROV|FAKE|KUBE|AKS|INGRESS|KEY_VAULT|GITHUB)_\w+"
+    r"|KUBECONFIG|DRY_RUN|NO_CONFIRM|SAVED_PLAN|RESOURCE_TIMINGS|CI"
+)
+MESSAGE_LIMIT = 1024 * 1024
+
+
+def is_forwarded_env(name: str):
+    return bool(FORWARDED_ENV_PATTERN.fullmatch(name))
+
+
+# An empty PROV_DAEMON_SOCKET turns the daemon off.
+def get_socket_path():
+    value = os.environ.get("PROV_DAEMON_SOCKET")
+    if value is None:
+        return DEFAULT_SOCKET_PATH
+
+    return Path(value) if value else None
+
+
+def write_message(connection: socket.socket, message: dict, fds=None):
+    data = json.dumps(message).encode() + b"\n"
+    if fds:
+        socket.send_fds(connection, [data], fds)
+    else:
+        connection.sendall(data)
+
+
+# Reads one message per line, with the file descriptors that came with it.
+def read_message(connection: socket.socket, buffer: bytearray, max_fds=0):
+    fds = []
+    while b"\n" not in buffer:
+        if len(buffer) > MESSAGE_LIMIT:
+            raise RuntimeError("The daemon message is too long.")
+
+        data, received_fds, _, _ = socket.recv_fds(connection, 65536, max_fds)
+        fds.extend(received_fds)
+        if not data:
+            for fd in fds:
+                os.close(fd)
+            return None, []
+        buffer.extend(data)
+
+    line, _, rest = bytes(buffer).partition(b"\n")
+    buffer[:] = rest
+    return json.loads(line), fds
+
+
+def get_relative_path(path: Path):
+    try:
+        return str(path.resolve().relative_to(BASE_DIR.resolve()))
+    except ValueError:
+        return "."
+
+
+# Sends the command to the daemon, which starts to run it, and returns the
+# connection to wait on.
+def send_to_daemon(socket_path: Path, script: str, args: list, fds=(0, 1, 2)):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(str(socket_path))
+        write_message(
+            connection,
+            {
+                "script": script,
+                "args": args,
+                "cwd": get_relative_path(Path.cwd()),
+                "env": {
+                    name: value
+                    for name, value in os.environ.items()
+                    if is_forwarded_env(name)
+                },
+            },
+            list(fds),
+        )
+    except BaseException:
+        connection.close()
+        raise
+
+    return connection
+
+
+# Returns the exit code of the command, or None when the daemon asked the
+# client to run it itself.
+def wait_for_daemon(connection: socket.socket):
+    with connection:
+        # Interrupts go to the command, which stops its tools cleanly.
+        def forward_signal(signum, frame):
+            try:
+                write_message(connection, {"signal": signum})
+            except OSError:
+                pass
+
+        previous_handlers = {
+            signum: signal.signal(signum, forward_signal)
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        try:
+            return read_exit_code(connection)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+
+def run_in_daemon(socket_path: Path, script: str, args: list, fds=(0, 1, 2)):
+    return wait_for_daemon(send_to_daemon(socket_path, script, args, fds))
+
+
+def read_exit_code(connection: socket.socket):
+    buffer = bytearray()
+    while True:
+        message, _ = read_message(connection, buffer)
+        if message is None:
+            raise RuntimeError("The provisioner daemon closed the connection.")
+        if "fallback" in message:
+            print(message["fallback"], file=sys.stderr, flush=True)
+            return None
+        if "exit_code" in message:
+            return message["exit_code"]
+
+
+# Called first in each script. When a daemon listens on the socket, it runs the
+# command and the script exits with its code. Otherwise the script goes on.
+def forward_to_daemon(module_name: str, script_path: str):
+    socket_path = get_socket_path()
+    if module_name != "__main__" or not socket_path or not socket_path.exists():
+        return
+
+    script = get_relative_path(Path(script_path))
+    # The socket of another user, readable only by them, raises PermissionError.
+    try:
+        connection = send_to_daemon(socket_path, script, sys.argv[1:])
+    except OSError:
+        return
+
+    # Once the daemon runs the command, running it here as well could apply
+    # twice.
+    try:
+        exit_code = wait_for_daemon(connection)
+    except OSError as error:
+        raise RuntimeError(
+            "Lost the connection to the provisioner daemon while it ran the "
+            "command."
+        ) from error
+
+    if exit_code is not None:
+        sys.exit(exit_code)
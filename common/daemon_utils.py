@@ -0,0 +1,374 @@
+import atexit
+import importlib
+import importlib.util
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+from pathlib import Path
+
+from common.daemon_client import (
+    BASE_DIR,
+    is_forwarded_env,
+    read_message,
+    write_message,
+)
+
+DAEMON_SCRIPTS = [
+    "azure/provision.py",
+    "kubernetes-shared/provision.py",
+    "pipeline.py",
+]
+# Loaded before the first request, so that no command pays for them
+WARM_MODULES = [
+    "asyncio",
+    "sqlite3",
+    "yaml",
+    "common.event_utils",
+    "common.process_utils",
+]
+# Seconds that a new connection has to send its request
+REQUEST_TIMEOUT = 5
+
+
+def load_script_app(script: str):
+    name = script.removesuffix(".py").replace("/", ".").replace("-", "_")
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, BASE_DIR / script)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+
+    return sys.modules[name].app
+
+
+def load_apps(scripts: list):
+    for module in WARM_MODULES:
+        importlib.import_module(module)
+
+    return {script: load_script_app(script) for script in scripts}
+
+
+# The stacks that a script provisions. A script at the top, such as the
+# pipeline, may touch all of them.
+def get_request_workspaces(script: str):
+    stack = Path(script).parent.name
+    return {stack or "*"}
+
+
+def conflicts(workspaces: set, busy: set):
+    return bool(workspaces & busy) or (
+        bool(busy) and ("*" in workspaces or "*" in busy)
+    )
+
+
+# The provisioner code and the list of projects. A change means that the
+# daemon would run code or commands that are out of date.
+def get_source_fingerprint(scripts: list):
+    paths = [BASE_DIR / script for script in scripts]
+    paths += BASE_DIR.glob("common/*.py")
+    projects = sorted(str(path) for path in BASE_DIR.glob("*/*/terragrunt.hcl"))
+    return projects + sorted(
+        f"{path}:{path.stat().st_mtime_ns}" for path in paths if path.exists()
+    )
+
+
+def open_stdio(fd: int, mode: str):
+    buffering = 1 if os.isatty(fd) or fd == 2 else -1
+    return open(fd, mode, buffering=buffering, closefd=False)
+
+
+def get_exit_code(error: SystemExit):
+    if error.code is None or isinstance(error.code, int):
+        return error.code or 0
+
+    print(error.code, file=sys.stderr)
+    return 1
+
+
+# Runs in the forked child with the client's terminal, working directory and
+# variables, and never returns.
+def run_request(app, request: dict, base_env: dict):
+    exit_code = 1
+    try:
+        # Only the exit handlers of the command run, such as its reports.
+        atexit._clear()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for target, fd in enumerate(request["fds"]):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = open_stdio(0, "r")
+        sys.stdout = open_stdio(1, "w")
+        sys.stderr = open_stdio(2, "w")
+
+        message = request["message"]
+        os.chdir(BASE_DIR / message["cwd"])
+        os.environ.clear()
+        os.environ.update(
+            {
+                name: value
+                for name, value in base_env.items()
+                if not is_forwarded_env(name)
+            }
+        )
+        os.environ.update(
+            {
+                name: value
+                for name, value in message["env"].items()
+                if is_forwarded_env(name)
+            }
+        )
+        script_path = BASE_DIR / message["script"]
+        sys.argv = [str(script_path), *message["args"]]
+        try:
+            app(args=message["args"], prog_name=script_path.name)
+            exit_code = 0
+        except SystemExit as error:
+            exit_code = get_exit_code(error)
+        atexit._run_exitfuncs()
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        for output in (sys.stdout, sys.stderr):
+            try:
+                output.flush()
+            except OSError:
+                pass
+        os._exit(exit_code)
+
+
+def bind_socket(socket_path: Path):
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    if socket_path.exists():
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(str(socket_path))
+            except ConnectionRefusedError:
+                socket_path.unlink()
+            else:
+                raise RuntimeError(
+                    f"A provisioner daemon already listens on {socket_path}."
+                )
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(socket_path))
+    # Whoever can connect runs commands with the daemon's credentials, so the
+    # socket belongs to the owner of its directory only.
+    directory_stat = socket_path.parent.stat()
+    os.chown(socket_path, directory_stat.st_uid, directory_stat.st_gid)
+    os.chmod(socket_path, 0o600)
+    listener.listen()
+    return listener
+
+
+def print_request(request: dict, message: str):
+    command = " ".join(
+        [request["message"]["script"], *request["message"]["args"]]
+    )
+    print(f"{command}: {message}", flush=True)
+
+
+def close_request(daemon: dict, request: dict):
+    daemon["selector"].unregister(request["connection"])
+    request["connection"].close()
+    for fd in request["fds"]:
+        os.close(fd)
+    request["fds"] = []
+
+
+def reply(daemon: dict, request: dict, message: dict):
+    try:
+        write_message(request["connection"], message)
+    except OSError:
+        pass
+    close_request(daemon, request)
+
+
+def accept_request(daemon: dict):
+    connection, _ = daemon["listener"].accept()
+    connection.settimeout(REQUEST_TIMEOUT)
+    try:
+        message, fds = read_message(connection, bytearray(), max_fds=3)
+    except (OSError, ValueError, RuntimeError) as error:
+        print(f"Ignoring a request: {error}", flush=True)
+        connection.close()
+        return
+
+    if message is None or len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        connection.close()
+        return
+
+    connection.settimeout(None)
+    request = {
+        "connection": connection,
+        "message": message,
+        "fds": fds,
+        "workspaces": get_request_workspaces(message.get("script", "")),
+        "pid": None,
+        "started": None,
+    }
+    daemon["selector"].register(connection, selectors.EVENT_READ, request)
+    if message.get("script") not in daemon["apps"]:
+        reason = f"The daemon does not serve {message.get('script')}."
+        reply(daemon, request, {"fallback": f"{reason} Running it here."})
+    elif get_source_fingerprint(list(daemon["apps"])) != daemon["fingerprint"]:
+        reason = "The provisioner code changed since the daemon started."
+        stop_daemon(daemon, reason)
+        reply(daemon, request, {"fallback": f"{reason} Running it here."})
+    else:
+        daemon["waiting"].append(request)
+
+
+# Messages from a client while its command waits or runs
+def read_client(daemon: dict, request: dict):
+    try:
+        data = request["connection"].recv(4096)
+    except OSError:
+        data = b""
+
+    if data and request["pid"]:
+        for line in data.splitlines():
+            try:
+                os.kill(request["pid"], json.loads(line)["signal"])
+            except (ValueError, KeyError, TypeError):
+                pass
+    elif not data:
+        # The client is gone, so its command is stopped as on an interrupt.
+        if request["pid"]:
+            os.kill(request["pid"], signal.SIGTERM)
+        else:
+            daemon["waiting"].remove(request)
+            close_request(daemon, request)
+
+
+def start_request(daemon: dict, request: dict):
+    app = daemon["apps"][request["message"]["script"]]
+    pid = os.fork()
+    if pid == 0:
+        # The child keeps only the client's terminal.
+        for key in list(daemon["selector"].get_map().values()):
+            if isinstance(key.fileobj, int):
+                os.close(key.fileobj)
+            else:
+                key.fileobj.close()
+        daemon["selector"].close()
+        run_request(app, request, daemon["base_env"])
+
+    request["pid"] = pid
+    request["started"] = time.monotonic()
+    for fd in request["fds"]:
+        os.close(fd)
+    request["fds"] = []
+    pidfd = os.pidfd_open(pid)
+    daemon["running"][pidfd] = request
+    daemon["selector"].register(pidfd, selectors.EVENT_READ, "child")
+
+
+# Requests start in the order they came, unless an earlier one waits for the
+# same workspace.
+def start_ready_requests(daemon: dict):
+    claimed = set(daemon["busy"])
+    for request in list(daemon["waiting"]):
+        workspaces = request["workspaces"]
+        if conflicts(workspaces, claimed):
+            claimed |= workspaces
+            continue
+
+        daemon["waiting"].remove(request)
+        daemon["busy"] |= workspaces
+        claimed |= workspaces
+        start_request(daemon, request)
+
+
+def finish_request(daemon: dict, pidfd: int):
+    request = daemon["running"].pop(pidfd)
+    daemon["selector"].unregister(pidfd)
+    os.close(pidfd)
+    _, status = os.waitpid(request["pid"], 0)
+    exit_code = os.waitstatus_to_exitcode(status)
+    if exit_code < 0:
+        exit_code = 128 - exit_code
+
+    daemon["busy"] -= request["workspaces"]
+    print_request(
+        request,
+        f"exit code {exit_code} after "
+        f"{time.monotonic() - request['started']:.1f}s",
+    )
+    request["pid"] = None
+    reply(daemon, request, {"exit_code": exit_code})
+
+
+# Stops taking requests. Those that wait run in their clients instead, and
+# those that run finish.
+def stop_daemon(daemon: dict, reason: str):
+    if daemon["stopping"]:
+        return
+
+    print(f"Stopping: {reason}", flush=True)
+    daemon["stopping"] = True
+    daemon["selector"].unregister(daemon["listener"])
+    daemon["listener"].close()
+    daemon["socket_path"].unlink(missing_ok=True)
+    for request in daemon["waiting"]:
+        reply(daemon, request, {"fallback": f"{reason} Running it here."})
+    daemon["waiting"] = []
+
+
+def serve_requests(daemon: dict):
+    while not daemon["stopping"] or daemon["running"]:
+        for key, _ in daemon["selector"].select():
+            if key.data == "accept":
+                accept_request(daemon)
+            elif key.data == "child":
+                finish_request(daemon, key.fd)
+            else:
+                read_client(daemon, key.data)
+
+        if not daemon["stopping"]:
+            start_ready_requests(daemon)
+
+
+# Serves commands of `scripts` on the socket until it gets SIGTERM or SIGINT.
+# Each command runs in a fork of the daemon, so it starts with the modules and
+# projects loaded, and nothing it changes outlives it.
+def run_daemon(socket_path: Path, scripts: list = DAEMON_SCRIPTS, apps=None):
+    apps = apps or load_apps(scripts)
+    listener = bind_socket(socket_path)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ, "accept")
+    daemon = {
+        "socket_path": socket_path,
+        "listener": listener,
+        "selector": selector,
+        "apps": apps,
+        "base_env": dict(os.environ),
+        "fingerprint": get_source_fingerprint(list(apps)),
+        "waiting": [],
+        "running": {},
+        "busy": set(),
+        "stopping": False,
+    }
+
+    def handle_stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    print(f"Serving {', '.join(apps)} on {socket_path}", flush=True)
+    try:
+        serve_requests(daemon)
+    except KeyboardInterrupt:
+        stop_daemon(daemon, "The daemon was stopped.")
+        for request in daemon["running"].values():
+            os.kill(request["pid"], signal.SIGTERM)
+        while daemon["running"]:
+            finish_request(daemon, next(iter(daemon["running"])))
+    finally:
+        selector.close()
@@ -0,0 +1,167 @@
+import json
+import sys
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+
+from common.process_utils import run_process
+from common.utils import write_text_atomic
+
+SLOWEST_RESOURCES_SHOWN = 10
+
+# Hooks that open and close the timing of one resource, by phase.
+EVENT_PHASES = {
+    "apply_start": ("apply", "start"),
+    "apply_complete": ("apply", "complete"),
+    "apply_errored": ("apply", "complete"),
+    "refresh_start": ("refresh", "start"),
+    "refresh_complete": ("refresh", "complete"),
+}
+# Events that only repeat what other events already say.
+QUIET_EVENTS = {
+    "apply_progress",
+    "refresh_start",
+    "refresh_complete",
+    "outputs",
+    "version",
+}
+
+ResourceTiming = namedtuple(
+    "ResourceTiming",
+    ["address", "phase", "action", "seconds", "status"],
+)
+
+
+def get_event_time(event: dict):
+    return datetime.fromisoformat(event["@timestamp"]).timestamp()
+
+
+def render_event(event: dict):
+    if event.get("type") in QUIET_EVENTS:
+        return None
+
+    message = event.get("@message", "")
+    if detail := event.get("diagnostic", {}).get("detail"):
+        message += "\n" + detail
+
+    return message
+
+
+def track_event(event: dict, started: dict, timings: list):
+    phase, edge = EVENT_PHASES.get(event.get("type"), (None, None))
+    resource = event.get("hook", {}).get("resource", {})
+    if not phase or "addr" not in resource:
+        return
+
+    key = (resource["addr"], phase)
+    if edge == "start":
+        started[key] = get_event_time(event)
+    elif key in started:
+        timings.append(
+            ResourceTiming(
+                address=resource["addr"],
+                phase=phase,
+                action=event["hook"].get("action", "read"),
+                seconds=round(get_event_time(event) - started.pop(key), 3),
+                status="errored" if event["type"] == "apply_errored" else "ok",
+            )
+        )
+
+
+# Writes compact progress in place of one line of the -json event stream.
+# Lines that are not events, such as Terragrunt logs, pass through.
+def process_event_line(line: str, output, started: dict, timings: list):
+    try:
+        event = json.loads(line)
+    except json.JSONDecodeError:
+        event = None
+
+    if not isinstance(event, dict) or "@message" not in event:
+        output.write(line)
+        output.flush()
+        return
+
+    track_event(event, started, timings)
+    if (message := render_event(event)) is not None:
+        output.write(message + "\n")
+        output.flush()
+
+
+# Renders one line of a refresh-only plan like process_event_line, and
+# collects the resources that were changed outside of Terraform.
+def process_drift_line(line: str, output, drifted: list):
+    try:
+        event = json.loads(line)
+    except json.JSONDecodeError:
+        event = None
+
+    if isinstance(event, dict) and event.get("type") == "resource_drift":
+        change = event.get("change", {})
+        drifted.append(
+            {
+                "address": change.get("resource", {}).get("addr"),
+                "action": change.get("action"),
+            }
+        )
+
+    process_event_line(line, output, {}, [])
+
+
+def write_timing_report(report_path: Path, name: str, timings: list):
+    slowest = sorted(timings, key=lambda timing: timing.seconds, reverse=True)
+    write_text_atomic(
+        report_path,
+        json.dumps(
+            {
+                "name": name,
+                "resources": [timing._asdict() for timing in slowest],
+            },
+            indent=2,
+        ),
+    )
+    return slowest
+
+
+def print_slowest_resources(name: str, slowest: list, output):
+    if not slowest:
+        return
+
+    print(f"Slowest resources of {name}:", file=output)
+    for timing in slowest[:SLOWEST_RESOURCES_SHOWN]:
+        print(
+            f"  {timing.seconds:8.1f}s  {timing.phase:7}  {timing.address}",
+            file=output,
+        )
+    output.flush()
+
+
+# Same as run_process for a command that was given -json, but the event
+# stream is rendered while it arrives and the resource timings are written to
+# `report_path`. Progress goes where stdout would have gone.
+def run_with_events(
+    args: list,
+    name: str,
+    report_path: Path,
+    check: bool = False,
+    **kwargs,
+):
+    output = kwargs.pop("stdout", None) or sys.stdout
+    started = {}
+    timings = []
+    result = run_process(
+        args,
+        on_stdout_line=lambda line: process_event_line(
+            line,
+            output,
+            started,
+            timings,
+        ),
+        **kwargs,
+    )
+
+    slowest = write_timing_report(report_path, name, timings)
+    print_slowest_resources(name, slowest, output)
+    if check:
+        result.check_returncode()
+
+    return result
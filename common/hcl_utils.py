@@ -0,0 +1,52 @@
+import re
+from pathlib import Path
+
+# Only whole-line and block comments are stripped, so URLs inside strings are
+# left alone.
+COMMENT_PATTERN = re.compile(
+    r"/\*.*?\*/|^\s*(?:#|//)[^\n]*",
+    re.DOTALL | re.MULTILINE,
+)
+
+
+def strip_comments(content: str):
+    return COMMENT_PATTERN.sub("", content)
+
+
+def find_blocks(content: str, pattern: re.Pattern):
+    for match in pattern.finditer(content):
+        depth = 1
+        position = match.end()
+        while depth and position < len(content):
+            if content[position] == "{":
+                depth += 1
+            elif content[position] == "}":
+                depth -= 1
+            position += 1
+
+        yield match, position
+
+
+def get_block_bodies(content: str, pattern: re.Pattern):
+    for match, end in find_blocks(content, pattern):
+        yield content[match.end() : end - 1]
+
+
+def get_blocks(content: str, pattern: re.Pattern):
+    for match, end in find_blocks(content, pattern):
+        yield content[match.start() : end].strip()
+
+
+TERRAFORM_BLOCK_PATTERN = re.compile(r"^\s*terraform\s*\{", re.MULTILINE)
+MODULE_BLOCK_PATTERN = re.compile(r'^\s*module\s+"[^"]*"\s*\{', re.MULTILINE)
+
+
+# The terraform and module blocks decide what `terraform init` does: backend
+# configuration, required providers, and module sources.
+def get_init_blocks(directory: Path):
+    return [
+        block
+        for path in sorted(directory.glob("*.tf"))
+        for pattern in (TERRAFORM_BLOCK_PATTERN, MODULE_BLOCK_PATTERN)
+        for block in get_blocks(strip_comments(path.read_text()), pattern)
+    ]
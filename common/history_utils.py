@@ -0,0 +1,323 @@
+import atexit
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from common.impact_utils import run_git
+from common.manifest_utils import get_tool_version
+from common.trace_utils import get_trace_spans
+
+BASE_DIR = Path(__file__).parent.parent
+HISTORY_RETENTION_DAYS = 90
+# A phase counts as regressed when its median grew by this factor and by at
+# least REGRESSION_MIN_SECONDS between two commits.
+REGRESSION_FACTOR = 1.25
+REGRESSION_MIN_SECONDS = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS phases (
+    run_id TEXT NOT NULL,
+    recorded_at TEXT NOT NULL,
+    stack TEXT NOT NULL,
+    project TEXT,
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL,
+    exit_code INTEGER NOT NULL,
+    cache_hit INTEGER NOT NULL,
+    tool_versions TEXT NOT NULL,
+    git_commit TEXT
+);
+CREATE INDEX IF NOT EXISTS phases_by_stack ON phases (stack, recorded_at);
+"""
+
+HISTORY_FILES = []
+
+
+def get_history_path(cache_dir: Path):
+    return cache_dir / "history.sqlite"
+
+
+def connect_history(history_path: Path):
+    import sqlite3
+
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(history_path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+    return connection
+
+
+# The phases of this process are written when it exits, so a run that fails
+# is recorded too.
+def start_history(cache_dir: Path):
+    history_path = get_history_path(cache_dir)
+    if not HISTORY_FILES:
+        atexit.register(write_history)
+    if history_path not in HISTORY_FILES:
+        HISTORY_FILES.append(history_path)
+
+
+def get_git_commit():
+    if commit := os.environ.get("GITHUB_SHA"):
+        return commit
+
+    try:
+        return run_git(BASE_DIR, ["rev-parse", "HEAD"]).strip()
+    except (OSError, RuntimeError):
+        return None
+
+
+def get_tool_versions(spans: list):
+    tools = ["terraform"]
+    if any(span["attributes"].get("project") for span in spans):
+        tools.append("terragrunt")
+
+    versions = {}
+    for tool in tools:
+        try:
+            versions[tool] = get_tool_version(tool)
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+    return versions
+
+
+def get_phase_rows(spans: list, run_id: str, tool_versions: dict, commit):
+    rows = []
+    for span in spans:
+        attributes = span["attributes"]
+        if not attributes.get("stack"):
+            continue
+
+        exit_code = attributes.get("exit_code")
+        if exit_code is None:
+            exit_code = 1 if "error" in attributes else 0
+        cache_hit = attributes.get("cached") or attributes.get("restored")
+        rows.append(
+            (
+                run_id,
+                datetime.fromtimestamp(span["start"], timezone.utc).isoformat(),
+                attributes["stack"],
+                attributes.get("project") or None,
+                span["name"],
+                round(span["duration"], 3),
+                exit_code,
+                int(bool(cache_hit)),
+                json.dumps(tool_versions, sort_keys=True),
+                commit,
+            )
+        )
+
+    return rows
+
+
+def get_cutoff(days: int):
+    return (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+
+
+def write_phase_rows(history_path: Path, rows: list):
+    connection = connect_history(history_path)
+    try:
+        with connection:
+            connection.executemany(
+                "INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            connection.execute(
+                "DELETE FROM phases WHERE recorded_at < ?",
+                (get_cutoff(HISTORY_RETENTION_DAYS),),
+            )
+    finally:
+        connection.close()
+
+
+def write_history():
+    spans = get_trace_spans()
+    if not any(span["attributes"].get("stack") for span in spans):
+        return
+
+    rows = get_phase_rows(
+        spans,
+        f"{int(time.time())}-{os.getpid()}",
+        get_tool_versions(spans),
+        get_git_commit(),
+    )
+    for history_path in HISTORY_FILES:
+        try:
+            write_phase_rows(history_path, rows)
+        except Exception as error:
+            print(
+                f"Unable to record the run history in {history_path}: {error}",
+                file=sys.stderr,
+                flush=True,
+            )
+
+
+# Rows are read from the cursor as they are used. A limit of -1 reads all.
+def iter_phase_rows(
+    history_path: Path,
+    stack: str | None,
+    days: int,
+    newest_first: bool = False,
+    limit: int = -1,
+):
+    if not history_path.is_file():
+        return
+
+    query = "SELECT * FROM phases WHERE recorded_at >= ?"
+    parameters = [get_cutoff(days)]
+    if stack:
+        query += " AND stack = ?"
+        parameters.append(stack)
+    order = "DESC" if newest_first else "ASC"
+    query += f" ORDER BY recorded_at {order}, rowid {order} LIMIT ?"
+    parameters.append(limit)
+
+    connection = connect_history(history_path)
+    try:
+        for row in connection.execute(query, parameters):
+            yield dict(row)
+    finally:
+        connection.close()
+
+
+def get_workspace_name(stack: str, project: str | None):
+    return f"{stack}/{project}" if project else stack
+
+
+def get_percentile(values: list, percent: float):
+    values = sorted(values)
+    return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+def summarize_durations(durations: list):
+    return {
+        "runs": len(durations),
+        "p50": round(get_percentile(durations, 50), 1),
+        "p95": round(get_percentile(durations, 95), 1),
+    }
+
+
+def group_rows(rows: list, get_key):
+    groups = {}
+    for row in rows:
+        groups.setdefault(get_key(row), []).append(row)
+
+    return groups
+
+
+def get_phase_stats(rows: list):
+    return {
+        phase: {
+            **summarize_durations([row["duration"] for row in phase_rows]),
+            "cache_hits": sum(row["cache_hit"] for row in phase_rows),
+            "failures": sum(1 for row in phase_rows if row["exit_code"]),
+        }
+        for phase, phase_rows in sorted(
+            group_rows(rows, lambda row: row["phase"]).items()
+        )
+    }
+
+
+# Projects by the median duration of their applies
+def get_slowest_projects(rows: list, count: int):
+    groups = group_rows(
+        [row for row in rows if row["project"] and row["phase"] == "apply"],
+        lambda row: get_workspace_name(row["stack"], row["project"]),
+    )
+    projects = [
+        {
+            "workspace": workspace,
+            **summarize_durations([row["duration"] for row in project_rows]),
+        }
+        for workspace, project_rows in groups.items()
+    ]
+    return sorted(projects, key=lambda project: -project["p50"])[:count]
+
+
+# Compares the median of each phase at the last two commits that ran it.
+def get_regressions(rows: list):
+    regressions = []
+    groups = group_rows(
+        [row for row in rows if row["git_commit"] and not row["cache_hit"]],
+        lambda row: (row["stack"], row["project"] or "", row["phase"]),
+    )
+    for (stack, project, phase), phase_rows in sorted(groups.items()):
+        by_commit = group_rows(phase_rows, lambda row: row["git_commit"])
+        commits = sorted(
+            by_commit,
+            key=lambda commit: by_commit[commit][-1]["recorded_at"],
+        )
+        if len(commits) < 2:
+            continue
+
+        before, after = (
+            get_percentile([row["duration"] for row in by_commit[commit]], 50)
+            for commit in commits[-2:]
+        )
+        if (
+            after > before * REGRESSION_FACTOR
+            and after - before >= REGRESSION_MIN_SECONDS
+        ):
+            regressions.append(
+                {
+                    "workspace": get_workspace_name(stack, project),
+                    "phase": phase,
+                    "from": commits[-2][:12],
+                    "to": commits[-1][:12],
+                    "before": round(before, 1),
+                    "after": round(after, 1),
+                }
+            )
+
+    return regressions
+
+
+def get_stats(history_path: Path, stack: str | None, days: int, slowest: int):
+    rows = list(iter_phase_rows(history_path, stack, days))
+    return {
+        "phases": get_phase_stats(rows),
+        "slowest_projects": get_slowest_projects(rows, slowest),
+        "regressions": get_regressions(rows),
+    }
+
+
+# The latest phases first
+def get_history(history_path: Path, stack: str | None, days: int, limit: int):
+    return (
+        {
+            "recorded_at": row["recorded_at"],
+            "workspace": get_workspace_name(row["stack"], row["project"]),
+            "phase": row["phase"],
+            "duration": row["duration"],
+            "exit_code": row["exit_code"],
+            "cache_hit": bool(row["cache_hit"]),
+            "git_commit": row["git_commit"],
+            "tool_versions": json.loads(row["tool_versions"]),
+        }
+        for row in iter_phase_rows(
+            history_path,
+            stack,
+            days,
+            newest_first=True,
+            limit=limit,
+        )
+    )
+
+
+# `stack` limits the commands to one stack; without it they cover all of them.
+def add_history_commands(app, get_cache_dir, stack: str | None = None):
+    @app.command()
+    def stats(days: int = 30, slowest: int = 10):
+        history_path = get_history_path(get_cache_dir())
+        return get_stats(history_path, stack, days, slowest)
+
+    @app.command()
+    def history(days: int = 30, limit: int = 50):
+        history_path = get_history_path(get_cache_dir())
+        return get_history(history_path, stack, days, limit)
@@ -0,0 +1,96 @@
+import subprocess
+from pathlib import Path, PurePosixPath
+
+# Changes to these paths can change how every stack is provisioned.
+SHARED_PATHS = {
+    "common",
+    "pipeline.py",
+    "Dockerfile",
+    "docker-compose.yml",
+    "requirements.txt",
+}
+# Stacks that read the outputs of another stack. kubernetes-shared connects to
+# the AKS cluster and ingress IP that the Azure stack creates.
+STACK_CONSUMERS = {"azure": ["kubernetes-shared"]}
+DOC_SUFFIXES = {".md"}
+
+
+def run_git(base_dir: Path, args: list):
+    result = subprocess.run(
+        ["git", *args],
+        cwd=base_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if result.returncode:
+        raise RuntimeError(
+            f"git {' '.join(args)} failed: {result.stderr.strip()}"
+        )
+
+    return result.stdout
+
+
+# Paths changed since the common ancestor of `ref` and HEAD, including changes
+# that are not committed yet. Changes made on `ref` since then are not ours.
+def get_changed_paths(base_dir: Path, ref: str):
+    merge_base = run_git(base_dir, ["merge-base", ref, "HEAD"]).strip()
+    return sorted(
+        set(run_git(base_dir, ["diff", "--name-only", merge_base]).splitlines())
+    )
+
+
+def get_dependents(graph: dict, projects: set):
+    selected = set(projects)
+    while added := {
+        project
+        for project, dependencies in graph.items()
+        if dependencies & selected
+    } - selected:
+        selected |= added
+
+    return selected
+
+
+# Maps changed paths to the stacks and projects they affect. `stacks` has the
+# project graph of each Terragrunt stack, and None for Terraform stacks. A
+# change inside a project also affects the projects that depend on it, and a
+# change anywhere else in a stack affects all of its projects.
+def get_affected(paths: list, stacks: dict):
+    changed = {}
+
+    def add_change(stack: str, path: str, projects):
+        entry = changed.setdefault(stack, {"paths": set(), "projects": set()})
+        entry["paths"].add(path)
+        entry["projects"] |= projects
+
+    def add_stack_change(stack: str, path: str):
+        add_change(stack, path, set(stacks[stack] or []))
+        for consumer in STACK_CONSUMERS.get(stack, []):
+            if consumer in stacks:
+                add_stack_change(consumer, path)
+
+    for path in paths:
+        parts = PurePosixPath(path).parts
+        if not parts or PurePosixPath(path).suffix in DOC_SUFFIXES:
+            continue
+
+        if parts[0] in SHARED_PATHS:
+            for stack in stacks:
+                add_stack_change(stack, path)
+        elif parts[0] in stacks:
+            graph = stacks[parts[0]]
+            if graph and len(parts) > 2 and parts[1] in graph:
+                add_change(parts[0], path, {parts[1]})
+            else:
+                add_stack_change(parts[0], path)
+
+    affected = {}
+    for stack, entry in sorted(changed.items()):
+        affected[stack] = {"paths": sorted(entry["paths"])}
+        if stacks[stack] is not None:
+            affected[stack]["projects"] = sorted(
+                get_dependents(stacks[stack], entry["projects"])
+            )
+
+    return affected
@@ -0,0 +1,74 @@
+import re
+from json import JSONDecodeError, JSONDecoder
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# A brace can only start an object when the closing brace or a key and its
+# colon follow it, or when the text read so far ends before they could. Other
+# braces are skipped without decoding, because every failed decode counts the
+# lines before the error position.
+OBJECT_START_PATTERN = re.compile(
+    r'\{(?=\s*(?:\}|"(?:[^"\\\n]|\\.)*(?:"\s*(?::|\Z)|\\?\Z)|\Z))'
+)
+
+
+def read_chunks(stream, chunk_size: int = READ_CHUNK_SIZE):
+    return iter(lambda: stream.read(chunk_size), "")
+
+
+# A decode error at the very end of the text, or in a string that never
+# closes, may only mean that the rest of the object has not been read yet.
+def is_truncation_error(error: JSONDecodeError, text: str):
+    return error.msg.startswith("Unterminated string") or (
+        error.pos >= len(text) - len("\\u0000")
+    )
+
+
+# Finds top-level JSON objects in text that may be surrounded by diagnostics,
+# reading the chunks in a single pass. Like a retry at every "{", a failed
+# decode moves on to the next brace, but decoding starts at an index instead
+# of a copy of the remaining text. An object that is still incomplete is
+# retried each time the text after its brace has doubled, which bounds the
+# total decoding work to a small multiple of the input size. Objects are
+# yielded as soon as they decode, so callers can stop reading early.
+def iter_json_objects(chunks):
+    decoder = JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    finished = False
+
+    while True:
+        match = OBJECT_START_PATTERN.search(buffer, position)
+        if match is None:
+            chunk = None if finished else next(chunks, None)
+            if chunk is None:
+                return
+            buffer = chunk
+            position = 0
+            continue
+
+        start = match.start()
+        try:
+            value, position = decoder.raw_decode(buffer, start)
+        except JSONDecodeError as error:
+            if finished or not is_truncation_error(error, buffer):
+                position = start + 1
+                continue
+
+            parts = [buffer[start:]]
+            size = len(parts[0])
+            while size < 2 * len(parts[0]):
+                chunk = next(chunks, None)
+                if chunk is None:
+                    finished = True
+                    break
+                parts.append(chunk)
+                size += len(chunk)
+
+            buffer = "".join(parts)
+            position = 0
+            continue
+
+        if isinstance(value, dict):
+            yield value
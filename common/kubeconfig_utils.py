@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from common.utils import get_run_root, write_text_atomic
+
+
+# kubelogin keeps its tokens here, so that every project that uses a
+# converted kubeconfig shares them.
+def get_kubelogin_cache_dir():
+    return get_run_root() / "kubelogin"
+
+
+def get_kubeconfig_key(kubeconfig: str, login_args: list):
+    return hashlib.sha256(
+        json.dumps({"kubeconfig": kubeconfig, "login": login_args}).encode()
+    ).hexdigest()
+
+
+def get_kubeconfig_key_path(path: Path):
+    return path.with_name(f".{path.name}.key")
+
+
+# Writes `content` to a temporary file next to `path`, lets `convert` rewrite
+# it, and moves it into place owned like its directory and readable only by
+# the owner.
+def write_private_file(path: Path, content: str, convert=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w",
+        dir=path.parent,
+        prefix=f".{path.name}.",
+        delete=False,
+    ) as file:
+        file.write(content)
+
+    temporary_path = Path(file.name)
+    try:
+        if convert:
+            convert(temporary_path)
+        owner = path.parent.stat()
+        os.chown(temporary_path, owner.st_uid, owner.st_gid)
+        temporary_path.chmod(0o600)
+        os.replace(temporary_path, path)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+
+# The kubeconfig is converted and written only when the raw kubeconfig or the
+# login arguments differ from the last write, whose key is kept next to it.
+# The converted file itself stays out of the cache directory, because it is
+# saved between CI runs. Returns whether the file was written.
+def write_kubeconfig(
+    path: Path,
+    kubeconfig: str,
+    login_args: list | None = None,
+    convert=None,
+):
+    key = get_kubeconfig_key(kubeconfig, login_args or [])
+    key_path = get_kubeconfig_key_path(path)
+    try:
+        if path.is_file() and key_path.read_text() == key:
+            return False
+    except OSError:
+        pass
+
+    write_private_file(path, kubeconfig, convert)
+    write_text_atomic(key_path, key)
+    return True
@@ -0,0 +1,190 @@
+import atexit
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# Terraform waits this long for a held state lock before it fails. Longer
+# waits are left to the provisioner, which can run other projects meanwhile.
+LOCK_TIMEOUT_ARG = "-lock-timeout=10s"
+# Seconds before the first retry, doubled after each attempt
+LOCK_BACKOFF_SECONDS = 15
+MAX_LOCK_BACKOFF_SECONDS = 120
+# Seconds that a workspace may wait for its lock, overridden by
+# PROV_LOCK_WAIT_LIMIT. Zero fails on the first contention.
+DEFAULT_LOCK_WAIT_LIMIT = 20 * 60
+# Commands that take the state lock
+LOCKING_COMMANDS = {"init", "plan", "apply", "refresh", "import"}
+# Lines kept from the lock error on, which include the lock info.
+LOCK_INFO_LINES = 20
+
+LOCK_ERROR_PATTERN = re.compile(
+    r"Error acquiring the state lock|Error locking state"
+)
+LOCK_INFO_PATTERN = re.compile(r"\b(ID|Who|Operation|Created):\s+(\S.*?)\s*$")
+COLOR_PATTERN = re.compile(r"\x1b\[[0-9;]*m")
+
+LockInfo = namedtuple("LockInfo", ["id", "who", "operation", "created"])
+
+LOCK_WAITS = {}
+LOCK_WAITS_LOCK = threading.Lock()
+
+
+class StateLockedError(RuntimeError):
+    def __init__(self, workspace: str, lock_info: LockInfo):
+        self.workspace = workspace
+        self.lock_info = lock_info
+        super().__init__(
+            f"The state of {workspace} is locked by {describe_lock(lock_info)}."
+        )
+
+
+def describe_lock(lock_info: LockInfo):
+    description = lock_info.who or "another run"
+    if lock_info.operation:
+        description += f" for {lock_info.operation}"
+    if lock_info.created:
+        description += f" since {lock_info.created}"
+    if lock_info.id:
+        description += f" (lock {lock_info.id})"
+
+    return description
+
+
+def parse_lock_info(lines: list):
+    fields = {}
+    for line in lines:
+        if match := LOCK_INFO_PATTERN.search(COLOR_PATTERN.sub("", line)):
+            fields.setdefault(match.group(1).lower(), match.group(2))
+
+    return LockInfo(**{field: fields.get(field) for field in LockInfo._fields})
+
+
+def get_lock_wait_limit():
+    value = os.environ.get("PROV_LOCK_WAIT_LIMIT")
+    return DEFAULT_LOCK_WAIT_LIMIT if value is None else float(value)
+
+
+def get_lock_backoff(attempt: int):
+    return min(LOCK_BACKOFF_SECONDS * 2**attempt, MAX_LOCK_BACKOFF_SECONDS)
+
+
+# Returns how long to wait before the next attempt, or raises once waiting
+# that long would go over the limit.
+def get_lock_retry_delay(error: StateLockedError, attempt: int, waited: float):
+    delay = get_lock_backoff(attempt)
+    if waited + delay > get_lock_wait_limit():
+        raise RuntimeError(
+            f"{error} Gave up after waiting {waited:.0f}s for it."
+        ) from error
+
+    print(f"{error} Retrying in {delay:.0f}s.", flush=True)
+    return delay
+
+
+def read_lock_lines(path: str, offset: int):
+    try:
+        with open(path, errors="replace") as file:
+            file.seek(offset)
+            lines = file.read().splitlines()
+    except OSError:
+        return []
+
+    for index, line in enumerate(lines):
+        if LOCK_ERROR_PATTERN.search(line):
+            return lines[index : index + LOCK_INFO_LINES]
+
+    return []
+
+
+def write_stderr(line: str):
+    sys.stderr.write(line)
+    sys.stderr.flush()
+
+
+# Passes the lines on to `forward` and keeps the lock error and the lines after
+# it.
+def make_lock_watcher(forward, lines: list):
+    def on_line(line):
+        forward(line)
+        if len(lines) < LOCK_INFO_LINES and (
+            lines or LOCK_ERROR_PATTERN.search(line)
+        ):
+            lines.append(line)
+
+    return on_line
+
+
+# Runs `run(subprocess_args)` and raises StateLockedError when the command
+# failed because another run holds the state lock. Terraform prints the error
+# on stderr, which is watched on its way to the terminal, or read back from
+# the file that it was redirected to.
+def run_detecting_lock(workspace: str, run, subprocess_args=None):
+    options = dict(subprocess_args or {})
+    output = options.get("stderr")
+    if output == subprocess.STDOUT:
+        output = options.get("stdout")
+
+    lines = []
+    path = None
+    offset = 0
+    if output is None:
+        options["on_stderr_line"] = make_lock_watcher(
+            options.get("on_stderr_line") or write_stderr,
+            lines,
+        )
+    elif isinstance(getattr(output, "name", None), str):
+        output.flush()
+        path = output.name
+        offset = os.fstat(output.fileno()).st_size
+
+    try:
+        return run(options)
+    except subprocess.CalledProcessError as error:
+        if path:
+            lines = read_lock_lines(path, offset)
+        if lines:
+            raise StateLockedError(workspace, parse_lock_info(lines)) from error
+        raise
+
+
+def record_lock_wait(workspace: str, seconds: float):
+    with LOCK_WAITS_LOCK:
+        if not LOCK_WAITS:
+            atexit.register(report_lock_waits)
+        LOCK_WAITS[workspace] = LOCK_WAITS.get(workspace, 0.0) + seconds
+
+
+def report_lock_waits():
+    print(
+        "State lock waits: "
+        + ", ".join(
+            f"{workspace} {seconds:.1f}s"
+            for workspace, seconds in sorted(LOCK_WAITS.items())
+        ),
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+# For a stack that has nothing else to run, waits in place and runs
+# `function` again until it gets the lock. Attempts that fail on the lock
+# count as waiting.
+def retry_on_lock(function):
+    attempt = 0
+    waited = 0.0
+    while True:
+        start = time.monotonic()
+        try:
+            return function()
+        except StateLockedError as error:
+            failed_attempt = time.monotonic() - start
+            waited += failed_attempt
+            delay = get_lock_retry_delay(error, attempt, waited)
+            time.sleep(delay)
+            waited += delay
+            record_lock_wait(error.workspace, failed_attempt + delay)
+            attempt += 1
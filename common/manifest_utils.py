@@ -0,0 +1,72 @@
+import functools
+import hashlib
+import json
+import subprocess
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+from common.utils import write_text_atomic
+
+MANIFEST_LOCK = threading.Lock()
+
+
+@functools.cache
+def get_tool_version(tool: str):
+    result = subprocess.run(
+        [tool, "--version"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip().splitlines()[0]
+
+
+def hash_inputs(files: dict, values: dict):
+    digest = hashlib.sha256()
+    for name, path in sorted(files.items()):
+        digest.update(name.encode() + b"\0")
+        digest.update(path.read_bytes() if path.is_file() else b"<missing>")
+        digest.update(b"\0")
+
+    digest.update(json.dumps(values, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def read_manifest(manifest_path: Path):
+    try:
+        return json.loads(manifest_path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def is_manifest_entry_current(manifest_path: Path, key: str, digest: str):
+    entry = read_manifest(manifest_path).get(key)
+    return isinstance(entry, dict) and entry.get("digest") == digest
+
+
+def record_manifest_entry(manifest_path: Path, key: str, digest: str):
+    with MANIFEST_LOCK:
+        manifest = read_manifest(manifest_path)
+        manifest[key] = {
+            "digest": digest,
+            "applied_at": datetime.now(timezone.utc).isoformat(),
+        }
+        write_text_atomic(
+            manifest_path,
+            json.dumps(manifest, indent=2, sort_keys=True),
+        )
+
+
+# Called before an apply, so that an apply that fails halfway is not taken for
+# the last successful one.
+def remove_manifest_entry(manifest_path: Path, key: str):
+    with MANIFEST_LOCK:
+        manifest = read_manifest(manifest_path)
+        if manifest.pop(key, None) is None:
+            return
+
+        write_text_atomic(
+            manifest_path,
+            json.dumps(manifest, indent=2, sort_keys=True),
+        )
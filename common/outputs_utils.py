@@ -0,0 +1,122 @@
+import json
+import os
+import re
+from collections import namedtuple
+from pathlib import Path
+
+from common.hcl_utils import get_init_blocks, strip_comments
+from common.utils import write_text_atomic
+
+DEFAULT_HOSTNAME = "app.terraform.io"
+API_TIMEOUT_SECONDS = 30
+
+HOSTNAME_PATTERN = re.compile(r'\bhostname\s*=\s*"([^"]+)"')
+ORGANIZATION_PATTERN = re.compile(r'\borganization\s*=\s*"([^"]+)"')
+WORKSPACE_NAME_PATTERN = re.compile(
+    r'\bworkspaces\s*\{[^}]*?\bname\s*=\s*"([^"]+)"'
+)
+
+Workspace = namedtuple("Workspace", ["hostname", "organization", "name"])
+
+
+def find_workspace(content: str, source: str):
+    organization = ORGANIZATION_PATTERN.search(content)
+    name = WORKSPACE_NAME_PATTERN.search(content)
+    if not organization or not name:
+        raise RuntimeError(f"No Terraform Cloud workspace found in {source}")
+
+    hostname = HOSTNAME_PATTERN.search(content)
+    return Workspace(
+        hostname=hostname.group(1) if hostname else DEFAULT_HOSTNAME,
+        organization=organization.group(1),
+        name=name.group(1),
+    )
+
+
+def get_terraform_workspace(code_dir: Path):
+    return find_workspace("\n".join(get_init_blocks(code_dir)), str(code_dir))
+
+
+# The root terragrunt.hcl generates the backend of every project, with the
+# project's path in the workspace name.
+def get_terragrunt_workspace(code_dir: Path, project: str):
+    root_config = code_dir / "terragrunt.hcl"
+    return find_workspace(
+        strip_comments(root_config.read_text()).replace(
+            "${path_relative_to_include()}",
+            project,
+        ),
+        str(root_config),
+    )
+
+
+def get_api_token(hostname: str):
+    variable = "TF_TOKEN_" + hostname.replace("-", "__").replace(".", "_")
+    if token := os.environ.get(variable):
+        return token
+
+    raise RuntimeError(f"Missing {variable}.")
+
+
+# Asks Terraform Cloud for the serial of the workspace's current state, which
+# is much cheaper than initializing and reading the state itself.
+def get_state_serial(workspace: Workspace):
+    import urllib.error
+    import urllib.request
+
+    request = urllib.request.Request(
+        f"https://{workspace.hostname}/api/v2/organizations/"
+        f"{workspace.organization}/workspaces/{workspace.name}"
+        "?include=current_state_version",
+        headers={
+            "Authorization": f"Bearer {get_api_token(workspace.hostname)}",
+            "Content-Type": "application/vnd.api+json",
+        },
+    )
+    try:
+        with urllib.request.urlopen(
+            request,
+            timeout=API_TIMEOUT_SECONDS,
+        ) as response:
+            document = json.load(response)
+    except urllib.error.URLError as error:
+        raise RuntimeError(
+            f"Unable to read the state version of {workspace.name}: {error}"
+        ) from error
+
+    for resource in document.get("included", []):
+        if resource.get("type") == "state-versions":
+            return resource["attributes"]["serial"]
+
+    return None
+
+
+def get_outputs_cache_path(cache_dir: Path, workspace: Workspace):
+    return cache_dir / "outputs" / f"{workspace.name}.json"
+
+
+def read_outputs_cache(cache_path: Path):
+    try:
+        return json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+# Sensitive outputs, such as the AKS kubeconfig, are left out, because the
+# cache directory is saved between CI runs.
+def write_outputs_cache(cache_path: Path, workspace: Workspace, state: dict):
+    outputs = state.get("outputs", {})
+    entry = {
+        "workspace": workspace.name,
+        "serial": state["serial"],
+        "outputs": {
+            name: output["value"]
+            for name, output in outputs.items()
+            if not output.get("sensitive")
+        },
+        "sensitive": sorted(
+            name for name, output in outputs.items() if output.get("sensitive")
+        ),
+    }
+    write_text_atomic(cache_path, json.dumps(entry, indent=2))
+    return entry
@@ -0,0 +1,245 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+
+from common.utils import write_text_atomic
+
+# Terraform's own default, used until a workspace has a recorded apply.
+DEFAULT_PARALLELISM = 10
+MIN_PARALLELISM = 2
+MAX_PARALLELISM = 32
+# A graph counts as wide when it has more resources than this per operation.
+RESOURCES_PER_OPERATION = 4
+# Total -parallelism of the runs in one process, overridden by
+# PROV_PARALLELISM_BUDGET.
+DEFAULT_PARALLELISM_BUDGET = 40
+# Commands that walk the graph and take -parallelism
+TUNED_COMMANDS = {"plan", "apply"}
+
+THROTTLE_PATTERN = re.compile(
+    r"StatusCode=429|TooManyRequests|429 Too Many Requests",
+    re.IGNORECASE,
+)
+
+HISTORY_LOCK = threading.Lock()
+BUDGET_CONDITION = threading.Condition()
+BUDGET_IN_USE = {"operations": 0}
+# The run whose commands are executing in this thread
+CURRENT_RUN = ContextVar("CURRENT_RUN", default=None)
+
+
+def get_parallelism_path(cache_dir: Path):
+    return cache_dir / "parallelism.json"
+
+
+def read_parallelism_history(history_path: Path):
+    try:
+        return json.loads(history_path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def count_resources(state: dict):
+    return sum(
+        len(resource.get("instances", []))
+        for resource in state.get("resources", [])
+        if resource.get("mode") == "managed"
+    )
+
+
+# Returns the -parallelism for the next run of a workspace and why. A run
+# that was throttled halves the value, and later runs stay below the value
+# that was throttled. Wide graphs get more than Terraform's default.
+def choose_parallelism(entry: dict | None):
+    if not entry:
+        return DEFAULT_PARALLELISM, "no recorded apply"
+
+    last = entry["parallelism"]
+    if entry["throttled"]:
+        return (
+            max(last // 2, MIN_PARALLELISM),
+            f"{entry['throttled']} throttled requests at {last} in the last run",
+        )
+
+    resources = entry["resources"]
+    wanted = min(
+        max(resources // RESOURCES_PER_OPERATION, DEFAULT_PARALLELISM),
+        MAX_PARALLELISM,
+    )
+    reason = f"{resources} resources"
+    if (ceiling := entry.get("ceiling")) and wanted >= ceiling:
+        wanted = max(ceiling - 1, MIN_PARALLELISM)
+        reason += f", below {ceiling} where requests were throttled"
+
+    return wanted, reason
+
+
+def get_parallelism_budget():
+    value = os.environ.get("PROV_PARALLELISM_BUDGET")
+    budget = DEFAULT_PARALLELISM_BUDGET if value is None else int(value)
+    return max(budget, MIN_PARALLELISM)
+
+
+# Runs that start while others use most of the budget get what is left, and
+# wait when less than MIN_PARALLELISM is left.
+@contextmanager
+def reserve_parallelism(wanted: int):
+    budget = get_parallelism_budget()
+    with BUDGET_CONDITION:
+        BUDGET_CONDITION.wait_for(
+            lambda: budget - BUDGET_IN_USE["operations"] >= MIN_PARALLELISM
+        )
+        granted = min(wanted, budget - BUDGET_IN_USE["operations"])
+        BUDGET_IN_USE["operations"] += granted
+
+    try:
+        yield granted
+    finally:
+        with BUDGET_CONDITION:
+            BUDGET_IN_USE["operations"] -= granted
+            BUDGET_CONDITION.notify_all()
+
+
+def record_parallelism_run(
+    history_path: Path,
+    name: str,
+    run: dict,
+    duration: float,
+):
+    with HISTORY_LOCK:
+        history = read_parallelism_history(history_path)
+        previous = history.get(name) or {}
+        history[name] = {
+            "parallelism": run["parallelism"],
+            "reason": run["reason"],
+            "resources": (
+                previous.get("resources", 0)
+                if run["resources"] is None
+                else run["resources"]
+            ),
+            "throttled": run["throttled"],
+            "duration": round(duration, 1),
+            "ceiling": (
+                run["parallelism"]
+                if run["throttled"]
+                else previous.get("ceiling")
+            ),
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+        }
+        write_text_atomic(
+            history_path,
+            json.dumps(history, indent=2, sort_keys=True),
+        )
+
+
+# Picks -parallelism for a run of `name` from its last recorded run, within
+# the budget that concurrent runs share, and records how this run went. The
+# caller sets `resources` in the yielded run after a successful apply. The
+# choice is reported to `output`, such as the log of a buffered run.
+@contextmanager
+def tuned_parallelism(
+    cache_dir: Path,
+    name: str,
+    record: bool = True,
+    output=None,
+):
+    history_path = get_parallelism_path(cache_dir)
+    wanted, reason = choose_parallelism(
+        read_parallelism_history(history_path).get(name)
+    )
+    with reserve_parallelism(wanted) as parallelism:
+        if parallelism < wanted:
+            reason += f", {wanted} limited by the shared budget"
+        print(
+            f"Running {name} with -parallelism={parallelism}: {reason}.",
+            file=output,
+            flush=True,
+        )
+
+        run = {
+            "parallelism": parallelism,
+            "reason": reason,
+            "args": [f"-parallelism={parallelism}"],
+            "throttled": 0,
+            "resources": None,
+        }
+        token = CURRENT_RUN.set(run)
+        start = time.monotonic()
+        try:
+            yield run
+        finally:
+            CURRENT_RUN.reset(token)
+            if record:
+                record_parallelism_run(
+                    history_path,
+                    name,
+                    run,
+                    time.monotonic() - start,
+                )
+
+
+def count_throttling_in_file(path: str, offset: int):
+    try:
+        with open(path, errors="replace") as file:
+            file.seek(offset)
+            return sum(1 for line in file if THROTTLE_PATTERN.search(line))
+    except OSError:
+        return 0
+
+
+# Counts throttled requests in the output of a command of the current run,
+# on its way to the terminal or in the file it was redirected to.
+@contextmanager
+def watch_throttling(command: str, subprocess_args=None):
+    run = CURRENT_RUN.get()
+    options = dict(subprocess_args or {})
+    output = options.get("stderr")
+    if output == subprocess.STDOUT:
+        output = options.get("stdout")
+
+    if run is None or command not in TUNED_COMMANDS:
+        yield options
+    elif output is None and "on_stderr_line" not in options:
+
+        def on_stderr_line(line):
+            sys.stderr.write(line)
+            sys.stderr.flush()
+            if THROTTLE_PATTERN.search(line):
+                run["throttled"] += 1
+
+        options["on_stderr_line"] = on_stderr_line
+        yield options
+    elif isinstance(getattr(output, "name", None), str):
+        output.flush()
+        offset = os.fstat(output.fileno()).st_size
+        try:
+            yield options
+        finally:
+            output.flush()
+            run["throttled"] += count_throttling_in_file(output.name, offset)
+    else:
+        yield options
+
+
+def get_parallelism_report(cache_dir: Path, stack: str):
+    history = read_parallelism_history(get_parallelism_path(cache_dir))
+    report = {}
+    for name, entry in sorted(history.items()):
+        if name != stack and not name.startswith(f"{stack}/"):
+            continue
+
+        parallelism, reason = choose_parallelism(entry)
+        report[name] = {
+            "next": {"parallelism": parallelism, "reason": reason},
+            "last": entry,
+        }
+
+    return report
@@ -0,0 +1,62 @@
+import json
+from pathlib import Path
+
+from common.kubeconfig_utils import write_private_file
+
+# Actions of `terraform show -json` that leave the infrastructure as it is
+UNCHANGED_ACTIONS = (["no-op"], ["read"])
+
+
+def get_change_action(actions: list):
+    if sorted(actions) == ["create", "delete"]:
+        return "replace"
+
+    return "-".join(actions)
+
+
+# The changes of a saved plan by address, such as {"helm_release.release":
+# "update"}, with outputs as output.NAME. Empty when an apply does nothing.
+def get_plan_changes(plan: dict):
+    changes = {
+        change["address"]: get_change_action(change["change"]["actions"])
+        for change in plan.get("resource_changes") or []
+        if change["change"]["actions"] not in UNCHANGED_ACTIONS
+    }
+    changes.update(
+        {
+            f"output.{name}": get_change_action(change["actions"])
+            for name, change in (plan.get("output_changes") or {}).items()
+            if change["actions"] not in UNCHANGED_ACTIONS
+        }
+    )
+    return changes
+
+
+# The outputs before the plan, as `terraform output -json` prints them. They
+# are the outputs after the apply when the plan has no changes.
+def get_plan_outputs(plan: dict):
+    outputs = (plan.get("prior_state") or {}).get("values", {}).get("outputs")
+    if outputs is None:
+        return None
+
+    return {
+        name: {
+            "value": output.get("value"),
+            "sensitive": output.get("sensitive", False),
+        }
+        for name, output in outputs.items()
+    }
+
+
+# The outputs hold credentials, so they stay in the run directory and are
+# readable only by the owner.
+def write_plan_outputs(path: Path, outputs: dict | None):
+    if outputs is not None:
+        write_private_file(path, json.dumps(outputs))
+
+
+def read_plan_outputs(path: Path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
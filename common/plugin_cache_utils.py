@@ -0,0 +1,288 @@
+import atexit
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+from common.utils import write_text_atomic
+
+DEFAULT_PLUGIN_CACHE_MAX_MB = 2048
+
+LOCKFILE_PROVIDER_PATTERN = re.compile(
+    r'provider\s+"([^"]+)"\s*\{(.*?)\n\}',
+    re.DOTALL,
+)
+LOCKFILE_VERSION_PATTERN = re.compile(r'version\s*=\s*"([^"]+)"')
+LOCKFILE_HASH_PATTERN = re.compile(r'"(h1:[^"]+)"')
+
+PLATFORM_ARCHITECTURES = {
+    "x86_64": "amd64",
+    "aarch64": "arm64",
+    "arm64": "arm64",
+}
+
+PLUGIN_CACHE_STATS = Counter()
+PLUGIN_CACHE_LOCK = threading.Lock()
+# Provider versions used by this process are never evicted, because Terraform
+# links the working directories into the cache.
+PLUGIN_CACHE_USED = set()
+
+
+def get_plugin_cache_dir(cache_dir: Path):
+    return cache_dir / "plugins"
+
+
+def init_plugin_cache(cache_dir: Path):
+    plugin_cache_dir = get_plugin_cache_dir(cache_dir)
+    plugin_cache_dir.mkdir(parents=True, exist_ok=True)
+    if os.environ.get("TF_PLUGIN_CACHE_DIR") != str(plugin_cache_dir):
+        os.environ["TF_PLUGIN_CACHE_DIR"] = str(plugin_cache_dir)
+        atexit.register(report_plugin_cache, plugin_cache_dir)
+
+    return plugin_cache_dir
+
+
+def get_plugin_platform():
+    machine = platform.machine().lower()
+    return f"{sys.platform}_{PLATFORM_ARCHITECTURES.get(machine, machine)}"
+
+
+def read_lockfile_providers(lockfile: Path):
+    if not lockfile.is_file():
+        return {}
+
+    providers = {}
+    content = lockfile.read_text()
+    for source, body in LOCKFILE_PROVIDER_PATTERN.findall(content):
+        if version := LOCKFILE_VERSION_PATTERN.search(body):
+            providers[f"{source}/{version.group(1)}"] = set(
+                LOCKFILE_HASH_PATTERN.findall(body)
+            )
+
+    return providers
+
+
+# Same algorithm as Terraform's "h1:" package hashes (Go's dirhash.Hash1).
+def get_package_hash(package_dir: Path):
+    summary = hashlib.sha256()
+    for path in sorted(
+        path for path in package_dir.rglob("*") if path.is_file()
+    ):
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                file_hash.update(chunk)
+        name = path.relative_to(package_dir).as_posix()
+        summary.update(f"{file_hash.hexdigest()}  {name}\n".encode())
+
+    return "h1:" + base64.b64encode(summary.digest()).decode()
+
+
+def get_package_signature(package_dir: Path):
+    return [
+        [
+            path.relative_to(package_dir).as_posix(),
+            path.stat().st_size,
+            path.stat().st_mtime_ns,
+        ]
+        for path in sorted(package_dir.rglob("*"))
+        if path.is_file()
+    ]
+
+
+def get_package_dir(plugin_cache_dir: Path, provider: str):
+    return plugin_cache_dir / provider / get_plugin_platform()
+
+
+def get_usage_index_path(plugin_cache_dir: Path):
+    return plugin_cache_dir / ".usage.json"
+
+
+def read_usage_index(plugin_cache_dir: Path):
+    try:
+        return json.loads(get_usage_index_path(plugin_cache_dir).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def update_usage_index(plugin_cache_dir: Path, entries: dict):
+    with PLUGIN_CACHE_LOCK:
+        index = read_usage_index(plugin_cache_dir)
+        index.update(entries)
+        write_text_atomic(
+            get_usage_index_path(plugin_cache_dir),
+            json.dumps(index, indent=2, sort_keys=True),
+        )
+
+
+# A cached package only counts as a hit when its hash is listed in the lock
+# file. Verified hashes are remembered until the package files change.
+def is_cached_package_valid(
+    plugin_cache_dir: Path,
+    provider: str,
+    hashes: set,
+):
+    package_dir = get_package_dir(plugin_cache_dir, provider)
+    if not package_dir.is_dir():
+        return False
+
+    entry = read_usage_index(plugin_cache_dir).get(provider, {})
+    signature = get_package_signature(package_dir)
+    if entry.get("signature") == signature and entry.get("hash"):
+        package_hash = entry["hash"]
+    else:
+        package_hash = get_package_hash(package_dir)
+        update_usage_index(
+            plugin_cache_dir,
+            {provider: {**entry, "signature": signature, "hash": package_hash}},
+        )
+
+    return package_hash in hashes
+
+
+def check_plugin_cache(plugin_cache_dir: Path, lockfile: Path):
+    providers = read_lockfile_providers(lockfile)
+    misses = [
+        provider
+        for provider, hashes in providers.items()
+        if not is_cached_package_valid(plugin_cache_dir, provider, hashes)
+    ]
+
+    with PLUGIN_CACHE_LOCK:
+        PLUGIN_CACHE_STATS["hits"] += len(providers) - len(misses)
+        PLUGIN_CACHE_STATS["misses"] += len(misses)
+        PLUGIN_CACHE_USED.update(providers)
+
+    return misses
+
+
+def touch_plugin_cache(plugin_cache_dir: Path, lockfile: Path):
+    index = read_usage_index(plugin_cache_dir)
+    now = time.time()
+    update_usage_index(
+        plugin_cache_dir,
+        {
+            provider: {**index.get(provider, {}), "last_used": now}
+            for provider in read_lockfile_providers(lockfile)
+        },
+    )
+
+
+# Terraform does not guarantee that concurrent writes to the plugin cache are
+# safe, so an init that has to download providers holds an exclusive lock.
+# Inits that only read from the cache run without it.
+@contextmanager
+def lock_plugin_cache(plugin_cache_dir: Path, lockfile: Path):
+    plugin_cache_dir.mkdir(parents=True, exist_ok=True)
+    if not check_plugin_cache(plugin_cache_dir, lockfile):
+        yield
+    else:
+        with open(plugin_cache_dir / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    touch_plugin_cache(plugin_cache_dir, lockfile)
+
+
+def use_plugin_cache(lockfile: Path):
+    if plugin_cache_dir := os.environ.get("TF_PLUGIN_CACHE_DIR"):
+        return lock_plugin_cache(Path(plugin_cache_dir), lockfile)
+
+    return nullcontext()
+
+
+def get_plugin_cache_max_bytes():
+    max_mb = os.environ.get("PROV_PLUGIN_CACHE_MAX_MB")
+    return int(max_mb or DEFAULT_PLUGIN_CACHE_MAX_MB) * 1024 * 1024
+
+
+def get_cached_packages(plugin_cache_dir: Path):
+    platform_name = get_plugin_platform()
+    return {
+        path.parent.relative_to(plugin_cache_dir).as_posix(): path
+        for path in plugin_cache_dir.glob(f"*/*/*/*/{platform_name}")
+        if path.is_dir()
+    }
+
+
+def get_directory_size(directory: Path):
+    return sum(
+        path.stat().st_size for path in directory.rglob("*") if path.is_file()
+    )
+
+
+def evict_plugin_cache(plugin_cache_dir: Path, max_bytes: int):
+    packages = get_cached_packages(plugin_cache_dir)
+    sizes = {
+        provider: get_directory_size(package_dir)
+        for provider, package_dir in packages.items()
+    }
+    index = read_usage_index(plugin_cache_dir)
+    total = sum(sizes.values())
+
+    evicted = []
+    for provider in sorted(
+        set(packages) - PLUGIN_CACHE_USED,
+        key=lambda provider: index.get(provider, {}).get("last_used", 0),
+    ):
+        if total <= max_bytes:
+            break
+
+        shutil.rmtree(packages[provider])
+        total -= sizes[provider]
+        evicted.append(provider)
+
+    if evicted:
+        with PLUGIN_CACHE_LOCK:
+            index = read_usage_index(plugin_cache_dir)
+            for provider in evicted:
+                index.pop(provider, None)
+            write_text_atomic(
+                get_usage_index_path(plugin_cache_dir),
+                json.dumps(index, indent=2, sort_keys=True),
+            )
+
+    return evicted
+
+
+def report_plugin_cache(plugin_cache_dir: Path):
+    evicted = evict_plugin_cache(
+        plugin_cache_dir,
+        get_plugin_cache_max_bytes(),
+    )
+    if not PLUGIN_CACHE_STATS and not evicted:
+        return
+
+    print(
+        f"Provider plugin cache: {PLUGIN_CACHE_STATS['hits']} hits, "
+        f"{PLUGIN_CACHE_STATS['misses']} misses, {len(evicted)} evicted",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+def render_required_providers(providers: dict):
+    lines = ["terraform {", "  required_providers {"]
+    for index, provider in enumerate(sorted(providers)):
+        source, version = provider.rsplit("/", 1)
+        lines += [
+            f"    provider_{index} = {{",
+            f'      source  = "{source}"',
+            f'      version = "{version}"',
+            "    }",
+        ]
+
+    return "\n".join(lines + ["  }", "}", ""])
@@ -0,0 +1,142 @@
+import functools
+import importlib.util
+import json
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from common.manifest_utils import hash_inputs
+from common.trace_utils import trace_span
+from common.utils import write_text_atomic
+
+# Hooks mostly wait for Azure or the cluster, so they run in threads.
+PREPROVISION_PARALLELISM = 8
+
+HookResult = namedtuple(
+    "HookResult",
+    ["project", "variables", "duration", "cached"],
+)
+
+
+# Each hook is imported once per process, however many commands use it.
+@functools.cache
+def import_preprovision_module(script_path: Path, project: str):
+    module_path = script_path.parent / project / "preprovision.py"
+    if not module_path.is_file():
+        return None
+
+    module_name = f"{script_path.parent.name}_{project}_preprovision".replace(
+        "-",
+        "_",
+    )
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    if not spec or not spec.loader:
+        raise RuntimeError(f"Unable to load preprovision module: {module_path}")
+
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_hook_cache_path(cache_dir: Path, stack: str, project: str):
+    return cache_dir / "preprovision" / f"{stack}-{project}.json"
+
+
+def read_hook_cache(cache_path: Path, key: str):
+    try:
+        entry = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        return None
+
+    if isinstance(entry, dict) and entry.get("key") == key:
+        return entry
+
+    return None
+
+
+# A hook may define `get_cache_key(tools, project)`. While that returns the
+# same value and preprovision.py is unchanged, the variables of the last run
+# are used instead of calling `get_vars`. They are kept in the cache
+# directory, which is saved between CI runs, so hooks that return secrets must
+# not define it.
+def run_preprovision_hook(script_path: Path, tools, project: str):
+    start = time.monotonic()
+    with trace_span(
+        "preprovision",
+        stack=tools.env.PROV_PROJ_NAME,
+        project=project,
+    ) as span:
+        module = import_preprovision_module(script_path, project)
+        if not module:
+            return HookResult(project, None, 0.0, False)
+
+        get_cache_key = getattr(module, "get_cache_key", None)
+        if not get_cache_key:
+            variables = module.get_vars(tools, project)
+            return HookResult(
+                project,
+                variables,
+                time.monotonic() - start,
+                False,
+            )
+
+        key = hash_inputs(
+            {"preprovision.py": Path(module.__file__)},
+            {"key": get_cache_key(tools, project)},
+        )
+        cache_path = get_hook_cache_path(
+            tools.env.PROV_CACHE_DIR,
+            tools.env.PROV_PROJ_NAME,
+            project,
+        )
+        if entry := read_hook_cache(cache_path, key):
+            span["cached"] = True
+            return HookResult(
+                project,
+                entry["variables"],
+                time.monotonic() - start,
+                True,
+            )
+
+        variables = module.get_vars(tools, project)
+        write_text_atomic(
+            cache_path,
+            json.dumps({"key": key, "variables": variables}, indent=2),
+        )
+        return HookResult(project, variables, time.monotonic() - start, False)
+
+
+def print_hook_times(results: list):
+    print(
+        "Preprovision hooks: "
+        + ", ".join(
+            f"{result.project} {result.duration:.1f}s"
+            + (" (cached)" if result.cached else "")
+            for result in results
+        ),
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+# Runs the hooks of `projects` concurrently and returns their results in the
+# same order. Projects without a hook get no variables.
+def run_preprovision_hooks(script_path: Path, tools, projects: list):
+    with ThreadPoolExecutor(max_workers=PREPROVISION_PARALLELISM) as executor:
+        results = list(
+            executor.map(
+                lambda project: run_preprovision_hook(
+                    script_path,
+                    tools,
+                    project,
+                ),
+                projects,
+            )
+        )
+
+    if hooks := [result for result in results if result.variables is not None]:
+        print_hook_times(hooks)
+
+    return results
@@ -0,0 +1,333 @@
+import asyncio
+import codecs
+import os
+import signal
+import subprocess
+import sys
+import threading
+from contextlib import suppress
+from contextvars import ContextVar
+
+from common.trace_utils import update_current_span
+
+READ_CHUNK_SIZE = 64 * 1024
+# Terraform prints whole -json events and kubeconfigs on a single line.
+STREAM_LINE_LIMIT = 16 * 1024 * 1024
+# Terraform releases the state lock after an interrupt, which takes a while.
+TERMINATE_GRACE_SECONDS = 30
+
+# Seconds, overridden by PROV_TIMEOUT_<COMMAND>. Zero means no timeout.
+COMMAND_TIMEOUTS = {
+    "init": 30 * 60,
+    "plan": 60 * 60,
+    "apply": 3 * 60 * 60,
+    "output": 10 * 60,
+    "state": 10 * 60,
+    "kubelogin": 5 * 60,
+}
+
+# Process group IDs of the running commands, mapped to their cancel scopes.
+RUNNING_PROCESSES = {}
+PROCESS_LOCK = threading.Lock()
+CANCEL_SCOPE = ContextVar("CANCEL_SCOPE", default=None)
+
+
+def get_command_timeout(command: str):
+    value = os.environ.get(f"PROV_TIMEOUT_{command.upper()}")
+    if value is not None:
+        return float(value) or None
+
+    return COMMAND_TIMEOUTS.get(command)
+
+
+def signal_process_group(process_id: int, signum: int):
+    with suppress(ProcessLookupError):
+        os.killpg(process_id, signum)
+
+
+# Commands run in their own process groups, so that an interrupt does not
+# reach them before the provisioner can pass it on. The provisioner itself
+# only stops on its own when nothing is running.
+def forward_signal(signum, frame):
+    with PROCESS_LOCK:
+        process_ids = list(RUNNING_PROCESSES)
+
+    if not process_ids:
+        if signum == signal.SIGINT:
+            signal.default_int_handler(signum, frame)
+        raise SystemExit(128 + signum)
+
+    for process_id in process_ids:
+        signal_process_group(process_id, signum)
+
+
+def install_signal_forwarding():
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        if signal.getsignal(signum) is not forward_signal:
+            signal.signal(signum, forward_signal)
+
+
+def is_scope_cancelled(scope):
+    while scope:
+        if scope["cancelled"]:
+            return True
+        scope = scope["parent"]
+
+    return False
+
+
+def is_in_scope(scope, ancestor):
+    while scope:
+        if scope is ancestor:
+            return True
+        scope = scope["parent"]
+
+    return False
+
+
+def cancel_scope(scope):
+    with PROCESS_LOCK:
+        scope["cancelled"] = True
+        process_ids = [
+            process_id
+            for process_id, process_scope in RUNNING_PROCESSES.items()
+            if is_in_scope(process_scope, scope)
+        ]
+
+    for process_id in process_ids:
+        signal_process_group(process_id, signal.SIGINT)
+
+
+def get_file_size(file):
+    try:
+        return os.fstat(file.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+async def copy_stream(reader, destination, on_line=None):
+    size = 0
+    if on_line:
+        while line := await reader.readline():
+            size += len(line)
+            on_line(line.decode(errors="replace"))
+        return size
+
+    destination.flush()
+    target = getattr(destination, "buffer", None)
+    while chunk := await reader.read(READ_CHUNK_SIZE):
+        size += len(chunk)
+        if target:
+            target.write(chunk)
+            target.flush()
+        else:
+            destination.write(chunk.decode(errors="replace"))
+            destination.flush()
+
+    return size
+
+
+# Passes the output to `read_stdout` as text chunks, in a worker thread while
+# it is read. A reader that returns before the end of the output has all it
+# needs, so the command is killed.
+async def read_stream(process, read_stdout):
+    loop = asyncio.get_running_loop()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    size = 0
+
+    def iter_chunks():
+        nonlocal size
+        while chunk := asyncio.run_coroutine_threadsafe(
+            process.stdout.read(READ_CHUNK_SIZE),
+            loop,
+        ).result():
+            size += len(chunk)
+            if text := decoder.decode(chunk):
+                yield text
+
+        if text := decoder.decode(b"", final=True):
+            yield text
+
+    value = await asyncio.to_thread(read_stdout, iter_chunks())
+    stopped = not process.stdout.at_eof()
+    if stopped:
+        signal_process_group(process.pid, signal.SIGKILL)
+
+    return value, size, stopped
+
+
+async def stop_process(process):
+    signal_process_group(process.pid, signal.SIGINT)
+    try:
+        await asyncio.wait_for(process.wait(), TERMINATE_GRACE_SECONDS)
+    except TimeoutError:
+        signal_process_group(process.pid, signal.SIGKILL)
+        await process.wait()
+
+
+async def no_output():
+    return None
+
+
+# Runs a command like subprocess.run. Output that is not redirected is copied
+# to this process's stdout and stderr while the command runs, or passed line
+# by line to `on_stdout_line` and `on_stderr_line`. With `read_stdout`, the
+# stdout of the result is what it returns for the output. A command that times
+# out or whose task is cancelled is interrupted, and killed if it does not stop
+# in time.
+async def run_process_async(
+    args: list,
+    check: bool = False,
+    timeout: float | None = None,
+    stdin=None,
+    stdout=None,
+    stderr=None,
+    env=None,
+    cwd=None,
+    text: bool = False,
+    on_stdout_line=None,
+    on_stderr_line=None,
+    read_stdout=None,
+):
+    scope = CANCEL_SCOPE.get()
+    if is_scope_cancelled(scope):
+        raise RuntimeError(f"Not running {args[0]}: its task was cancelled.")
+
+    size_before = get_file_size(stdout)
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=stdin,
+        stdout=subprocess.PIPE if stdout is None else stdout,
+        stderr=subprocess.PIPE if stderr is None else stderr,
+        env=env,
+        cwd=cwd,
+        start_new_session=True,
+        limit=STREAM_LINE_LIMIT,
+    )
+    # The task may have been cancelled while the process was starting.
+    with PROCESS_LOCK:
+        RUNNING_PROCESSES[process.pid] = scope
+        cancelled = is_scope_cancelled(scope)
+
+    try:
+        if cancelled:
+            signal_process_group(process.pid, signal.SIGINT)
+
+        if stdout is None and read_stdout:
+            stdout_reader = read_stream(process, read_stdout)
+        elif stdout is None:
+            stdout_reader = copy_stream(
+                process.stdout,
+                sys.stdout,
+                on_stdout_line,
+            )
+        elif stdout == subprocess.PIPE:
+            stdout_reader = process.stdout.read()
+        else:
+            stdout_reader = no_output()
+
+        if stderr is None:
+            stderr_reader = copy_stream(
+                process.stderr,
+                sys.stderr,
+                on_stderr_line,
+            )
+        elif stderr == subprocess.PIPE:
+            stderr_reader = process.stderr.read()
+        else:
+            stderr_reader = no_output()
+
+        stdout_result, stderr_result, returncode = await asyncio.wait_for(
+            asyncio.gather(stdout_reader, stderr_reader, process.wait()),
+            timeout,
+        )
+    except TimeoutError:
+        await stop_process(process)
+        raise subprocess.TimeoutExpired(args, timeout)
+    except asyncio.CancelledError:
+        await stop_process(process)
+        raise
+    finally:
+        with PROCESS_LOCK:
+            RUNNING_PROCESSES.pop(process.pid, None)
+
+    stopped = False
+    if stdout is None and read_stdout:
+        stdout_result, output_bytes, stopped = stdout_result
+    elif stdout is None:
+        output_bytes = stdout_result
+    elif stdout == subprocess.PIPE:
+        output_bytes = len(stdout_result)
+    elif size_before is not None:
+        output_bytes = get_file_size(stdout) - size_before
+    else:
+        output_bytes = None
+
+    if text:
+        stdout_result, stderr_result = (
+            value.decode() if isinstance(value, bytes) else None
+            for value in (stdout_result, stderr_result)
+        )
+
+    update_current_span(exit_code=returncode, output_bytes=output_bytes)
+    result = subprocess.CompletedProcess(
+        args,
+        returncode,
+        stdout_result if stdout == subprocess.PIPE or read_stdout else None,
+        stderr_result if stderr == subprocess.PIPE else None,
+    )
+    # A command that was killed after its output was read did not fail.
+    if check and not stopped:
+        result.check_returncode()
+
+    return result
+
+
+# Blocking facade for callers that are not coroutines. Each call runs its own
+# event loop, so it can be used from worker threads as well.
+def run_process(args: list, **kwargs):
+    install_signal_forwarding()
+    return asyncio.run(run_process_async(args, **kwargs))
+
+
+# Runs a blocking function in a worker thread under its own cancel scope.
+# Cancelling the task interrupts the commands the function is running and
+# makes its next command fail, then waits for the function to return.
+async def run_in_scope(function):
+    scope = {"cancelled": False, "parent": CANCEL_SCOPE.get()}
+
+    def run():
+        CANCEL_SCOPE.set(scope)
+        return function()
+
+    future = asyncio.ensure_future(asyncio.to_thread(run))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        cancel_scope(scope)
+        with suppress(Exception):
+            await future
+        raise
+
+
+async def run_tasks_async(functions):
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [
+                group.create_task(run_in_scope(function))
+                for function in functions
+            ]
+    except ExceptionGroup as error:
+        raise error.exceptions[0]
+
+    return [task.result() for task in tasks]
+
+
+# Runs blocking functions concurrently and returns their results in order.
+# The first failure cancels the others and is raised once they have stopped.
+def run_tasks(*functions):
+    install_signal_forwarding()
+    return asyncio.run(run_tasks_async(functions))
@@ -1,38 +1,129 @@
-import importlib.util
 import json
 import os
+import shutil
 import subprocess
+import sys
+import tempfile
 from collections import namedtuple
-from itertools import chain
-from json import JSONDecodeError, JSONDecoder
+from contextlib import nullcontext, redirect_stdout
+from itertools import chain, islice
 from pathlib import Path
 
 from common.cli_utils import get_app
+from common.hcl_utils import get_init_blocks
+from common.history_utils import add_history_commands, start_history
+from common.impact_utils import get_affected, get_changed_paths
+from common.json_utils import iter_json_objects
+from common.lock_utils import (
+    LOCK_TIMEOUT_ARG,
+    LOCKING_COMMANDS,
+    retry_on_lock,
+    run_detecting_lock,
+)
+from common.manifest_utils import (
+    get_tool_version,
+    hash_inputs,
+    is_manifest_entry_current,
+    record_manifest_entry,
+    remove_manifest_entry,
+)
+from common.outputs_utils import (
+    get_outputs_cache_path,
+    get_state_serial,
+    get_terraform_workspace,
+    get_terragrunt_workspace,
+    read_outputs_cache,
+    write_outputs_cache,
+)
+from common.plan_utils import (
+    get_plan_changes,
+    get_plan_outputs,
+    read_plan_outputs,
+    write_plan_outputs,
+)
+from common.parallelism_utils import (
+    count_resources,
+    get_parallelism_report,
+    tuned_parallelism,
+    watch_throttling,
+)
+from common.plugin_cache_utils import (
+    PLUGIN_CACHE_STATS,
+    init_plugin_cache,
+    read_lockfile_providers,
+    render_required_providers,
+    use_plugin_cache,
+)
+from common.preprovision_utils import run_preprovision_hooks
+from common.scheduler_utils import (
+    SUCCESS_STATUSES,
+    get_project_graph,
+    load_projects,
+    run_project_graph,
+)
+from common.snapshot_utils import get_snapshot_dir, run_with_snapshot
+from common.target_utils import get_target_args, print_target_warning
+from common.trace_utils import trace_span, update_current_span
+from common.utils import get_run_root
 
 
 BASE_DIR = Path(__file__).parent.parent
 
 ProvisionerEnvironment = namedtuple(
     "ProvisionerEnvironment",
-    ["PROV_PROJ_NAME", "PROV_BASE_DIR", "PROV_CODE_DIR", "PROV_RUN_DIR"],
+    [
+        "PROV_PROJ_NAME",
+        "PROV_BASE_DIR",
+        "PROV_CODE_DIR",
+        "PROV_RUN_DIR",
+        "PROV_CACHE_DIR",
+    ],
 )
 ProvisionerTools = namedtuple("ProvisionerTools", ["env"])
 
+TERRAGRUNT_INIT_ARGS = ["-lockfile=readonly"]
+# Drift checks do not take the state lock, so they can run next to applies.
+DRIFT_PLAN_ARGS = [
+    "-json",
+    "-refresh-only",
+    "-detailed-exitcode",
+    "-lock=false",
+    "-input=false",
+]
+# Exit codes of `plan -detailed-exitcode` other than errors
+DRIFT_STATUSES = {0: "clean", 2: "drifted"}
 
+
+# /run is a tmpfs, so anything that must survive the container lives in the
+# mounted cache directory instead.
+def get_cache_dir():
+    return Path(os.environ.get("PROV_CACHE_DIR") or BASE_DIR / ".cache")
+
+
+@trace_span("env")
 def init_environment(
     script_path: Path,
     use_terraform: bool = False,
     use_terragrunt: bool = False,
 ):
     project_name = script_path.parent.name
+    update_current_span(stack=project_name)
     env = ProvisionerEnvironment(
         PROV_PROJ_NAME=project_name,
         PROV_BASE_DIR=BASE_DIR,
         PROV_CODE_DIR=script_path.parent,
-        PROV_RUN_DIR=Path("/run") / project_name,
+        PROV_RUN_DIR=get_run_root() / project_name,
+        PROV_CACHE_DIR=get_cache_dir(),
     )
 
+    # The process engine and event streams load asyncio, so they are imported
+    # only when a command is about to run tools.
+    from common.process_utils import install_signal_forwarding
+
+    install_signal_forwarding()
     env.PROV_RUN_DIR.mkdir(parents=True, exist_ok=True)
+    env.PROV_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    start_history(env.PROV_CACHE_DIR)
     for key, value in env._asdict().items():
         os.environ[key] = str(value)
 
@@ -41,6 +132,9 @@ def init_environment(
     ):
         raise RuntimeError("Missing TF_TOKEN_app_terraform_io.")
 
+    if use_terraform or use_terragrunt:
+        init_plugin_cache(env.PROV_CACHE_DIR)
+
     if use_terraform:
         os.environ["TF_DATA_DIR"] = str(env.PROV_RUN_DIR / ".terraform")
 
@@ -52,11 +146,57 @@ def init_environment(
     return ProvisionerTools(env=env)
 
 
+@trace_span("vars")
 def write_terraform_vars(env: ProvisionerEnvironment, variables: dict):
+    update_current_span(stack=env.PROV_PROJ_NAME)
     with open(env.PROV_RUN_DIR / "terraform.tfvars.json", "w") as file:
         json.dump(variables, file, indent=2)
 
 
+def get_code_files(directory: Path, label: str):
+    return {
+        f"{label}/{path.relative_to(directory)}": path
+        for pattern in ("*.tf", "*.hcl")
+        for path in directory.rglob(pattern)
+        if not {".terraform", ".terragrunt-cache"} & set(
+            path.relative_to(directory).parts
+        )
+    }
+
+
+# Variables such as kube_config_path point at files whose content matters as
+# much as the path, so those files are hashed together with the variables.
+def get_var_file_inputs(variables_file: Path, label: str):
+    files = {label: variables_file}
+    if not variables_file.is_file():
+        return files
+
+    variables = json.loads(variables_file.read_text())
+    for name, value in variables.items():
+        if isinstance(value, str) and value.startswith("/"):
+            if Path(value).is_file():
+                files[f"{label}:{name}"] = Path(value)
+
+    return files
+
+
+def get_manifest_path(env: ProvisionerEnvironment):
+    return env.PROV_CACHE_DIR / "manifest.json"
+
+
+def get_terraform_inputs_digest(env: ProvisionerEnvironment):
+    return hash_inputs(
+        {
+            **get_code_files(env.PROV_CODE_DIR, "code"),
+            **get_var_file_inputs(
+                env.PROV_RUN_DIR / "terraform.tfvars.json",
+                "vars",
+            ),
+        },
+        {"terraform": get_tool_version("terraform")},
+    )
+
+
 def get_terraform_var_flags(env: ProvisionerEnvironment):
     var_files = chain(
         env.PROV_RUN_DIR.glob("*.tfvars"),
@@ -65,18 +205,79 @@ def get_terraform_var_flags(env: ProvisionerEnvironment):
     return [f"-var-file={var_file}" for var_file in var_files]
 
 
+# Apply only accepts -json when it cannot prompt, that is with automatic
+# approval or a saved plan.
+def use_event_stream(command: str):
+    if not os.environ.get("RESOURCE_TIMINGS") or command not in (
+        "plan",
+        "apply",
+    ):
+        return False
+
+    return (
+        command == "plan"
+        or bool(os.environ.get("NO_CONFIRM"))
+        or use_saved_plan()
+    )
+
+
+def get_timing_report_path(
+    env: ProvisionerEnvironment,
+    name: str,
+    command: str,
+):
+    return (
+        env.PROV_CACHE_DIR
+        / "timings"
+        / f"{name.replace('/', '-')}-{command}.json"
+    )
+
+
 def run_terraform_generic(
     env: ProvisionerEnvironment,
     command: str,
     additional_args=None,
     subprocess_args=None,
 ):
-    return subprocess.run(
-        ["terraform", f"-chdir={env.PROV_CODE_DIR}", command]
-        + (additional_args or []),
-        check=True,
-        **(subprocess_args or {}),
-    )
+    from common.event_utils import run_with_events
+    from common.process_utils import get_command_timeout, run_process
+
+    lockfile = env.PROV_CODE_DIR / ".terraform.lock.hcl"
+    with (
+        trace_span(command, stack=env.PROV_PROJ_NAME, command=command),
+        use_plugin_cache(lockfile) if command == "init" else nullcontext(),
+    ):
+        def run(options):
+            # Callers that read the lines themselves get them unchanged.
+            if use_event_stream(command) and "on_stdout_line" not in options:
+                return run_with_events(
+                    [
+                        "terraform",
+                        f"-chdir={env.PROV_CODE_DIR}",
+                        command,
+                        "-json",
+                    ]
+                    + (additional_args or []),
+                    env.PROV_PROJ_NAME,
+                    get_timing_report_path(env, env.PROV_PROJ_NAME, command),
+                    check=True,
+                    timeout=get_command_timeout(command),
+                    **options,
+                )
+
+            return run_process(
+                ["terraform", f"-chdir={env.PROV_CODE_DIR}", command]
+                + (additional_args or []),
+                check=True,
+                timeout=get_command_timeout(command),
+                **options,
+            )
+
+        with watch_throttling(command, subprocess_args) as options:
+            if command not in LOCKING_COMMANDS:
+                return run(options)
+
+            return run_detecting_lock(env.PROV_PROJ_NAME, run, options)
 
 
 def run_terraform_generic_with_var_files(
@@ -91,11 +292,35 @@ def run_terraform_generic_with_var_files(
     )
 
 
+def get_terraform_init_key(
+    env: ProvisionerEnvironment,
+    data_dir: Path,
+    args: list,
+):
+    return hash_inputs(
+        {"lockfile": env.PROV_CODE_DIR / ".terraform.lock.hcl"},
+        {
+            "blocks": get_init_blocks(env.PROV_CODE_DIR),
+            "args": args,
+            "terraform": get_tool_version("terraform"),
+            "plugin_cache_dir": os.environ.get("TF_PLUGIN_CACHE_DIR"),
+            "data_dir": str(data_dir),
+        },
+    )
+
+
 def run_terraform_init(env: ProvisionerEnvironment, additional_args=None):
-    return run_terraform_generic(
-        env,
-        "init",
-        ["-lock-timeout=20m"] + (additional_args or []),
+    args = [LOCK_TIMEOUT_ARG] + (additional_args or [])
+    data_dir = Path(
+        os.environ.get("TF_DATA_DIR") or env.PROV_CODE_DIR / ".terraform"
+    )
+    return run_with_snapshot(
+        get_snapshot_dir(env.PROV_CACHE_DIR),
+        env.PROV_PROJ_NAME,
+        get_terraform_init_key(env, data_dir, args),
+        data_dir,
+        lambda: run_terraform_generic(env, "init", args),
+        stack=env.PROV_PROJ_NAME,
     )
 
 
@@ -103,7 +328,7 @@ def run_terraform_plan(env: ProvisionerEnvironment, additional_args=None):
     return run_terraform_generic_with_var_files(
         env,
         "plan",
-        ["-lock-timeout=20m", "-refresh=false"] + (additional_args or []),
+        [LOCK_TIMEOUT_ARG, "-refresh=false"] + (additional_args or []),
     )
 
 
@@ -111,38 +336,166 @@ def run_terraform_apply(env: ProvisionerEnvironment, additional_args=None):
     return run_terraform_generic_with_var_files(
         env,
         "apply",
-        ["-lock-timeout=20m"] + (additional_args or []),
+        [LOCK_TIMEOUT_ARG] + (additional_args or []),
     )
 
 
-def get_terraform_output(env: ProvisionerEnvironment):
+def use_saved_plan():
+    return bool(os.environ.get("SAVED_PLAN")) and not os.environ.get("DRY_RUN")
+
+
+def check_saved_plan(plan_path: Path):
+    if not plan_path.is_file():
+        raise RuntimeError(f"Terraform did not write the plan: {plan_path}")
+
+
+def run_terraform_saved_plan(
+    env: ProvisionerEnvironment,
+    plan_path: Path,
+    additional_args=None,
+):
+    plan_path.unlink(missing_ok=True)
+    run_terraform_generic_with_var_files(
+        env,
+        "plan",
+        [LOCK_TIMEOUT_ARG, f"-out={plan_path}"] + (additional_args or []),
+    )
+    check_saved_plan(plan_path)
+
+
+# Terraform rejects variables when applying a saved plan, because the plan
+# already contains them.
+def run_terraform_apply_plan(
+    env: ProvisionerEnvironment,
+    plan_path: Path,
+    additional_args=None,
+):
+    return run_terraform_generic(
+        env,
+        "apply",
+        [LOCK_TIMEOUT_ARG] + (additional_args or []) + [str(plan_path)],
+    )
+
+
+def show_terraform_plan(env: ProvisionerEnvironment, plan_path: Path):
     result = run_terraform_generic(
+        env,
+        "show",
+        ["-json", str(plan_path)],
+        subprocess_args={"stdout": subprocess.PIPE},
+    )
+    return json.loads(result.stdout)
+
+
+def get_plan_outputs_path(env: ProvisionerEnvironment):
+    return env.PROV_RUN_DIR / "plan-outputs.json"
+
+
+# The outputs of the stack when its last run skipped the apply because the
+# plan had no changes, and otherwise None
+def read_unchanged_outputs(env: ProvisionerEnvironment):
+    return read_plan_outputs(get_plan_outputs_path(env))
+
+
+def print_no_changes(name: str, output=None):
+    print(
+        f"Skipping the apply of {name}: the plan has no changes.",
+        file=output,
+        flush=True,
+    )
+
+
+# Applying a saved plan never prompts, so interactive runs ask here instead.
+def confirm_saved_plan(name: str):
+    if os.environ.get("NO_CONFIRM"):
+        return
+
+    answer = input(
+        f"Apply the plan above to {name}? Only 'yes' will be accepted: "
+    )
+    if answer.strip() != "yes":
+        raise RuntimeError(f"Apply of {name} cancelled.")
+
+
+# Terraform may print diagnostics around the JSON document, so the output is
+# scanned for top-level objects while it is read. A second object shows that
+# it is ambiguous, and stops the command.
+def get_terraform_output(env: ProvisionerEnvironment):
+    objects = run_terraform_generic(
         env,
         "output",
         ["-json"],
-        subprocess_args={"capture_output": True, "text": True},
+        subprocess_args={
+            "read_stdout": lambda chunks: list(
+                islice(iter_json_objects(chunks), 2)
+            )
+        },
+    ).stdout
+    if len(objects) == 1:
+        return objects[0]
+
+    raise RuntimeError(
+        "Terraform output did not contain exactly one JSON object."
+    )
+
+
+def pull_terraform_state(env: ProvisionerEnvironment):
+    result = run_terraform_generic(
+        env,
+        "state",
+        ["pull"],
+        subprocess_args={"stdout": subprocess.PIPE},
     )
+    return json.loads(result.stdout)
+
+
+# The outputs cache is only a shortcut, so an apply does not fail when it
+# cannot be updated. `outputs --refresh` reads the state again.
+def update_outputs_cache(
+    env: ProvisionerEnvironment,
+    get_workspace,
+    pull_state,
+):
     try:
-        return json.loads(result.stdout)
-    except JSONDecodeError as error:
-        decoder = JSONDecoder()
-        objects = []
-        position = 0
-        while (start := result.stdout.find("{", position)) != -1:
-            try:
-                value, length = decoder.raw_decode(result.stdout[start:])
-                if isinstance(value, dict):
-                    objects.append(value)
-                position = start + length
-            except JSONDecodeError:
-                position = start + 1
-
-        if len(objects) == 1:
-            return objects[0]
+        workspace = get_workspace()
+        state = pull_state()
+        write_outputs_cache(
+            get_outputs_cache_path(env.PROV_CACHE_DIR, workspace),
+            workspace,
+            state,
+        )
+        return state
+    except (
+        subprocess.CalledProcessError,
+        subprocess.TimeoutExpired,
+        RuntimeError,
+        OSError,
+        ValueError,
+        KeyError,
+    ) as error:
+        print(f"Unable to cache the outputs: {error}", flush=True)
+        return None
 
-        raise RuntimeError(
-            "Terraform output did not contain exactly one JSON object."
-        ) from error
+
+def cache_terraform_outputs(env: ProvisionerEnvironment):
+    return update_outputs_cache(
+        env,
+        lambda: get_terraform_workspace(env.PROV_CODE_DIR),
+        lambda: pull_terraform_state(env),
+    )
+
+
+def get_terraform_target_args(env: ProvisionerEnvironment, patterns: list):
+    return get_target_args(
+        env.PROV_PROJ_NAME,
+        patterns,
+        lambda command, args: run_terraform_generic(
+            env,
+            command,
+            args,
+            subprocess_args={"stdout": subprocess.PIPE, "text": True},
+        ),
+    )
 
 
 def run_terraform(
@@ -151,25 +504,133 @@ def run_terraform(
     additional_init_args=None,
     additional_plan_args=None,
     additional_apply_args=None,
+    force: bool = False,
+    targets=None,
 ):
     write_terraform_vars(tools.env, variables)
-    run_terraform_init(tools.env, additional_init_args)
+    return retry_on_lock(
+        lambda: run_terraform_steps(
+            tools,
+            additional_init_args,
+            additional_plan_args,
+            additional_apply_args,
+            force,
+            targets,
+        )
+    )
 
-    if os.environ.get("DRY_RUN"):
-        run_terraform_plan(tools.env, additional_plan_args)
-        return
 
-    approval_args = ["-auto-approve"] if os.environ.get("NO_CONFIRM") else []
-    run_terraform_apply(
-        tools.env,
-        (additional_apply_args or []) + approval_args,
+# A targeted run always plans. Like any apply it removes the manifest entry,
+# but its inputs are not recorded, because the rest of the stack may still
+# differ from them. The next full run then plans again.
+def run_terraform_steps(
+    tools: ProvisionerTools,
+    additional_init_args=None,
+    additional_plan_args=None,
+    additional_apply_args=None,
+    force: bool = False,
+    targets=None,
+):
+    # Outputs are read after every run, so init happens even when the apply is
+    # skipped.
+    run_terraform_init(tools.env, additional_init_args)
+    get_plan_outputs_path(tools.env).unlink(missing_ok=True)
+    target_args = (
+        get_terraform_target_args(tools.env, targets) if targets else []
     )
 
+    manifest_key = tools.env.PROV_PROJ_NAME
+    with trace_span("manifest", stack=manifest_key) as span:
+        digest = get_terraform_inputs_digest(tools.env)
+        span["cached"] = not (force or targets) and is_manifest_entry_current(
+            get_manifest_path(tools.env),
+            manifest_key,
+            digest,
+        )
+
+    if span["cached"]:
+        print(
+            f"Skipping {manifest_key}: inputs are unchanged since the last "
+            "successful apply. Use --force to run anyway.",
+            flush=True,
+        )
+        return False
+
+    with tuned_parallelism(
+        tools.env.PROV_CACHE_DIR,
+        manifest_key,
+        record=not (os.environ.get("DRY_RUN") or targets),
+    ) as run:
+        plan_args = run["args"] + target_args + (additional_plan_args or [])
+        apply_args = run["args"] + (additional_apply_args or [])
+        if os.environ.get("DRY_RUN"):
+            run_terraform_plan(tools.env, plan_args)
+            return True
+
+        remove_manifest_entry(get_manifest_path(tools.env), manifest_key)
+        if use_saved_plan():
+            plan_path = tools.env.PROV_RUN_DIR / "terraform.tfplan"
+            run_terraform_saved_plan(tools.env, plan_path, plan_args)
+            plan = show_terraform_plan(tools.env, plan_path)
+            if not get_plan_changes(plan):
+                print_no_changes(manifest_key)
+                if not targets:
+                    record_manifest_entry(
+                        get_manifest_path(tools.env),
+                        manifest_key,
+                        digest,
+                    )
+                write_plan_outputs(
+                    get_plan_outputs_path(tools.env),
+                    get_plan_outputs(plan),
+                )
+                return False
+
+            confirm_saved_plan(manifest_key)
+            run_terraform_apply_plan(tools.env, plan_path, apply_args)
+        else:
+            approval_args = (
+                ["-auto-approve"] if os.environ.get("NO_CONFIRM") else []
+            )
+            run_terraform_apply(
+                tools.env,
+                apply_args + target_args + approval_args,
+            )
+
+        if not targets:
+            record_manifest_entry(
+                get_manifest_path(tools.env),
+                manifest_key,
+                digest,
+            )
+        if state := cache_terraform_outputs(tools.env):
+            run["resources"] = count_resources(state)
+
+    return True
+
 
 def run_terragrunt_generic(args=None, subprocess_args=None):
-    return subprocess.run(
+    from common.process_utils import get_command_timeout, run_process
+
+    command = next(
+        (arg for arg in args or [] if arg != "run-all"),
+        "terragrunt",
+    )
+    return run_process(
         ["terragrunt"] + (args or []),
         check=True,
+        timeout=get_command_timeout(command),
+        **(subprocess_args or {}),
+    )
+
+
+def run_kubelogin(args=None, subprocess_args=None):
+    from common.process_utils import get_command_timeout, run_process
+
+    return run_process(
+        ["kubelogin"] + (args or []),
+        check=True,
+        timeout=get_command_timeout("kubelogin"),
         **(subprocess_args or {}),
     )
 
@@ -185,6 +646,14 @@ def run_terragrunt_generic_with_project(
     if subprocess_args and subprocess_args.get("env"):
         command_env = subprocess_args["env"]
 
+    # Stacks can share a process, so the variables of the stack that was
+    # initialized last may not be this one's. Terragrunt keeps each project's
+    # Terraform data in its download directory.
+    command_env.update(
+        {key: str(value) for key, value in env._asdict().items()}
+    )
+    command_env.pop("TF_DATA_DIR", None)
+
     args = additional_args or []
     if project == "__all__":
         command_env["TERRAGRUNT_WORKING_DIR"] = str(env.PROV_CODE_DIR)
@@ -196,37 +665,188 @@ def run_terragrunt_generic_with_project(
         ]
     else:
         command_env["TERRAGRUNT_WORKING_DIR"] = str(env.PROV_CODE_DIR / project)
+        # Each project gets its own download directory, so that it can be
+        # snapshotted on its own.
+        command_env["TERRAGRUNT_DOWNLOAD"] = str(
+            get_terragrunt_download_dir(env, project)
+        )
         command_args = [command, *args]
 
     options = dict(subprocess_args or {})
     options["env"] = command_env
-    return run_terragrunt_generic(command_args, options)
 
+    def run(options):
+        if (
+            project != "__all__"
+            and use_event_stream(command)
+            and "on_stdout_line" not in options
+        ):
+            from common.event_utils import run_with_events
+            from common.process_utils import get_command_timeout
+
+            name = get_terragrunt_manifest_key(env, project)
+            return run_with_events(
+                ["terragrunt", command, "-json", *args],
+                name,
+                get_timing_report_path(env, name, command),
+                check=True,
+                timeout=get_command_timeout(command),
+                **options,
+            )
+
+        return run_terragrunt_generic(command_args, options)
+
+    def run_command():
+        with trace_span(
+            command,
+            stack=env.PROV_PROJ_NAME,
+            project=project,
+            command=command,
+        ):
+            with watch_throttling(command, options) as watched_options:
+                if project == "__all__" or command not in LOCKING_COMMANDS:
+                    return run(watched_options)
+
+                return run_detecting_lock(
+                    get_terragrunt_manifest_key(env, project),
+                    run,
+                    watched_options,
+                )
 
+    if command != "init" or project == "__all__":
+        return run_command()
+
+    with use_plugin_cache(env.PROV_CODE_DIR / project / ".terraform.lock.hcl"):
+        return run_with_snapshot(
+            get_snapshot_dir(env.PROV_CACHE_DIR),
+            get_terragrunt_manifest_key(env, project),
+            get_terragrunt_init_key(env, project, args),
+            get_terragrunt_download_dir(env, project),
+            run_command,
+            stack=env.PROV_PROJ_NAME,
+            project=project,
+        )
+
+
+def get_terragrunt_download_dir(env: ProvisionerEnvironment, project: str):
+    return env.PROV_RUN_DIR / ".terragrunt-cache" / project
+
+
+def get_terragrunt_init_key(
+    env: ProvisionerEnvironment,
+    project: str,
+    args: list,
+):
+    common_dir = env.PROV_CODE_DIR / "_common"
+    return hash_inputs(
+        {
+            "lockfile": env.PROV_CODE_DIR / project / ".terraform.lock.hcl",
+            "root/terragrunt.hcl": env.PROV_CODE_DIR / "terragrunt.hcl",
+            "terragrunt.hcl": env.PROV_CODE_DIR / project / "terragrunt.hcl",
+            **{
+                f"common/{path.name}": path
+                for path in common_dir.glob("*.hcl")
+            },
+        },
+        {
+            "blocks": get_init_blocks(env.PROV_CODE_DIR / project)
+            + get_init_blocks(common_dir),
+            "args": args,
+            "terraform": get_tool_version("terraform"),
+            "terragrunt": get_tool_version("terragrunt"),
+            "plugin_cache_dir": os.environ.get("TF_PLUGIN_CACHE_DIR"),
+            "download_dir": str(get_terragrunt_download_dir(env, project)),
+        },
+    )
+
+
+@trace_span("vars")
 def write_terragrunt_vars(
     env: ProvisionerEnvironment,
     project: str,
     variables: dict,
 ):
+    update_current_span(stack=env.PROV_PROJ_NAME, project=project)
     variables_file = env.PROV_RUN_DIR / project / "terraform.tfvars.json"
     variables_file.parent.mkdir(parents=True, exist_ok=True)
     with open(variables_file, "w") as file:
         json.dump(variables, file, indent=2)
 
 
+def get_terragrunt_inputs_digest(env: ProvisionerEnvironment, project: str):
+    return hash_inputs(
+        {
+            **get_code_files(env.PROV_CODE_DIR / project, "code"),
+            **get_code_files(env.PROV_CODE_DIR / "_common", "common"),
+            "root/terragrunt.hcl": env.PROV_CODE_DIR / "terragrunt.hcl",
+            **get_var_file_inputs(
+                env.PROV_RUN_DIR / "terraform.tfvars.json",
+                "vars",
+            ),
+            **get_var_file_inputs(
+                env.PROV_RUN_DIR / project / "terraform.tfvars.json",
+                "project-vars",
+            ),
+        },
+        {
+            "terraform": get_tool_version("terraform"),
+            "terragrunt": get_tool_version("terragrunt"),
+        },
+    )
+
+
+def get_terragrunt_manifest_key(env: ProvisionerEnvironment, project: str):
+    return f"{env.PROV_PROJ_NAME}/{project}"
+
+
+def get_terragrunt_target_args(
+    env: ProvisionerEnvironment,
+    project: str,
+    patterns: list,
+):
+    return get_target_args(
+        get_terragrunt_manifest_key(env, project),
+        patterns,
+        lambda command, args: run_terragrunt_generic_with_project(
+            env,
+            project,
+            command,
+            args,
+            subprocess_args={
+                "stdin": subprocess.DEVNULL,
+                "stdout": subprocess.PIPE,
+                "text": True,
+            },
+        ),
+    )
+
+
+# A saved plan already holds the targets, so they only go to its plan. Returns
+# False when the saved plan had no changes, so that nothing was applied.
 def run_terragrunt(
     tools: ProvisionerTools,
     project: str,
     additional_init_args=None,
     additional_plan_args=None,
     additional_apply_args=None,
+    subprocess_args=None,
+    targets=None,
 ):
     run_terragrunt_generic_with_project(
         tools.env,
         project,
         "init",
-        ["-lockfile=readonly", *(additional_init_args or [])],
+        [*TERRAGRUNT_INIT_ARGS, *(additional_init_args or [])],
+        subprocess_args=subprocess_args,
     )
+    if targets:
+        target_args = get_terragrunt_target_args(tools.env, project, targets)
+        additional_plan_args = [*(additional_plan_args or []), *target_args]
+        if not use_saved_plan():
+            additional_apply_args = [
+                *(additional_apply_args or []),
+                *target_args,
+            ]
 
     if os.environ.get("DRY_RUN"):
         run_terragrunt_generic_with_project(
@@ -234,8 +854,18 @@ def run_terragrunt(
             project,
             "plan",
             additional_plan_args,
+            subprocess_args=subprocess_args,
+        )
+        return True
+
+    if use_saved_plan() and project != "__all__":
+        return run_terragrunt_saved_plan(
+            tools,
+            project,
+            additional_plan_args,
+            additional_apply_args,
+            subprocess_args,
         )
-        return
 
     approval_args = (
         ["--terragrunt-non-interactive", "-auto-approve"]
@@ -247,25 +877,649 @@ def run_terragrunt(
         project,
         "apply",
         (additional_apply_args or []) + approval_args,
+        subprocess_args=subprocess_args,
     )
+    return True
 
 
-def import_preprovision_module(script_path: Path, project: str):
-    module_path = script_path.parent / project / "preprovision.py"
-    if not module_path.is_file():
-        return None
+def pull_terragrunt_state(env: ProvisionerEnvironment, project: str):
+    result = run_terragrunt_generic_with_project(
+        env,
+        project,
+        "state",
+        ["pull"],
+        subprocess_args={
+            "stdin": subprocess.DEVNULL,
+            "stdout": subprocess.PIPE,
+        },
+    )
+    return json.loads(result.stdout)
+
 
-    module_name = f"{script_path.parent.name}_{project}_preprovision".replace(
-        "-",
-        "_",
+def cache_terragrunt_outputs(env: ProvisionerEnvironment, project: str):
+    return update_outputs_cache(
+        env,
+        lambda: get_terragrunt_workspace(env.PROV_CODE_DIR, project),
+        lambda: pull_terragrunt_state(env, project),
     )
-    spec = importlib.util.spec_from_file_location(module_name, module_path)
-    if not spec or not spec.loader:
-        raise RuntimeError(f"Unable to load preprovision module: {module_path}")
 
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-    return module
+
+def get_drift_log_path(env: ProvisionerEnvironment, name: str):
+    return env.PROV_RUN_DIR / "drift" / f"{name.replace('/', '-')}.log"
+
+
+# Runs a refresh-only plan with `run_plan(log, subprocess_args)` and returns
+# whether the workspace drifted, with the resources that did. Its output goes
+# to `log_path`, so that plans can run side by side.
+def run_drift_check(log_path: Path, run_plan):
+    from common.event_utils import process_drift_line
+
+    drifted = []
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_path, "w") as log:
+        try:
+            run_plan(
+                log,
+                {
+                    "stdin": subprocess.DEVNULL,
+                    "stderr": log,
+                    "on_stdout_line": lambda line: process_drift_line(
+                        line,
+                        log,
+                        drifted,
+                    ),
+                },
+            )
+            returncode = 0
+        except subprocess.CalledProcessError as error:
+            returncode = error.returncode
+
+    if returncode not in DRIFT_STATUSES:
+        raise RuntimeError(
+            f"Refresh-only plan exited with {returncode}, see {log_path}"
+        )
+
+    return DRIFT_STATUSES[returncode], drifted
+
+
+def check_terraform_drift(env: ProvisionerEnvironment):
+    return run_drift_check(
+        get_drift_log_path(env, env.PROV_PROJ_NAME),
+        lambda log, subprocess_args: run_terraform_generic(
+            env,
+            "plan",
+            get_terraform_var_flags(env) + DRIFT_PLAN_ARGS,
+            subprocess_args,
+        ),
+    )
+
+
+def check_terragrunt_drift(env: ProvisionerEnvironment, project: str):
+    def run_plan(log, subprocess_args):
+        run_terragrunt_generic_with_project(
+            env,
+            project,
+            "init",
+            TERRAGRUNT_INIT_ARGS,
+            subprocess_args={
+                "stdin": subprocess.DEVNULL,
+                "stdout": log,
+                "stderr": subprocess.STDOUT,
+            },
+        )
+        run_terragrunt_generic_with_project(
+            env,
+            project,
+            "plan",
+            DRIFT_PLAN_ARGS,
+            subprocess_args=subprocess_args,
+        )
+
+    return run_drift_check(
+        get_drift_log_path(env, get_terragrunt_manifest_key(env, project)),
+        run_plan,
+    )
+
+
+# Runs the drift checks by name, at most `parallelism` at a time. A check that
+# fails does not stop the others.
+def run_drift_checks(checks: dict, parallelism: int = 8):
+    resources = {}
+
+    def run_check(name):
+        status, resources[name] = checks[name]()
+        return status
+
+    runs = run_project_graph(
+        {name: set() for name in checks},
+        run_check,
+        parallelism=max(parallelism, 1),
+        on_complete=lambda run: print(
+            f"==> {run.project}: {run.status} in {run.duration:.1f}s",
+            flush=True,
+        ),
+    )
+
+    return {
+        run.project: {
+            "status": run.status,
+            "duration": round(run.duration, 1),
+            "resources": resources.get(run.project, []),
+            **({"error": str(run.error)} if run.error else {}),
+        }
+        for run in sorted(runs)
+    }
+
+
+# Whether a run would change anything, for CI. Workspaces whose inputs are
+# unchanged since their last apply count as unchanged without a plan, as in a
+# run. The others are planned in turn until one has changes. `checks` maps
+# each workspace to its inputs digest and a function that returns its plan.
+def find_changes(env: ProvisionerEnvironment, checks: dict):
+    workspaces = {}
+    # The result is printed on stdout, so command output goes to stderr.
+    with redirect_stdout(sys.stderr):
+        for name, (digest, get_plan) in checks.items():
+            if is_manifest_entry_current(get_manifest_path(env), name, digest):
+                workspaces[name] = {}
+                continue
+
+            workspaces[name] = get_plan_changes(get_plan())
+            if workspaces[name]:
+                break
+
+    return {"changed": any(workspaces.values()), "workspaces": workspaces}
+
+
+def plan_terraform(env: ProvisionerEnvironment):
+    run_terraform_init(env)
+    plan_path = env.PROV_RUN_DIR / "terraform.tfplan"
+    run_terraform_saved_plan(env, plan_path)
+    return show_terraform_plan(env, plan_path)
+
+
+def get_terraform_changes(tools: ProvisionerTools, variables: dict):
+    write_terraform_vars(tools.env, variables)
+    return find_changes(
+        tools.env,
+        {
+            tools.env.PROV_PROJ_NAME: (
+                get_terraform_inputs_digest(tools.env),
+                lambda: plan_terraform(tools.env),
+            )
+        },
+    )
+
+
+def plan_terragrunt(env: ProvisionerEnvironment, project: str):
+    run_terragrunt_generic_with_project(
+        env,
+        project,
+        "init",
+        TERRAGRUNT_INIT_ARGS,
+    )
+    plan_path = write_terragrunt_plan(env, project)
+    return show_terragrunt_plan(env, project, plan_path)
+
+
+def get_terragrunt_changes(tools: ProvisionerTools, projects: list):
+    return find_changes(
+        tools.env,
+        {
+            get_terragrunt_manifest_key(tools.env, project): (
+                get_terragrunt_inputs_digest(tools.env, project),
+                lambda project=project: plan_terragrunt(tools.env, project),
+            )
+            for project in projects
+        },
+    )
+
+
+def get_terragrunt_plan_path(env: ProvisionerEnvironment, project: str):
+    return env.PROV_RUN_DIR / project / "terraform.tfplan"
+
+
+def write_terragrunt_plan(
+    env: ProvisionerEnvironment,
+    project: str,
+    additional_args=None,
+    subprocess_args=None,
+):
+    plan_path = get_terragrunt_plan_path(env, project)
+    plan_path.parent.mkdir(parents=True, exist_ok=True)
+    plan_path.unlink(missing_ok=True)
+    run_terragrunt_generic_with_project(
+        env,
+        project,
+        "plan",
+        [f"-out={plan_path}", *(additional_args or [])],
+        subprocess_args=subprocess_args,
+    )
+    check_saved_plan(plan_path)
+    return plan_path
+
+
+# Diagnostics go where the rest of the run's output goes, out of the JSON.
+def show_terragrunt_plan(
+    env: ProvisionerEnvironment,
+    project: str,
+    plan_path: Path,
+    subprocess_args=None,
+):
+    result = run_terragrunt_generic_with_project(
+        env,
+        project,
+        "show",
+        ["-json", str(plan_path)],
+        subprocess_args={
+            "stdin": subprocess.DEVNULL,
+            "stdout": subprocess.PIPE,
+            "stderr": (subprocess_args or {}).get("stdout"),
+        },
+    )
+    return json.loads(result.stdout)
+
+
+# Terragrunt leaves out the var files of extra_arguments when apply is given a
+# plan file. Returns whether the plan had changes to apply.
+def run_terragrunt_saved_plan(
+    tools: ProvisionerTools,
+    project: str,
+    additional_plan_args=None,
+    additional_apply_args=None,
+    subprocess_args=None,
+):
+    name = get_terragrunt_manifest_key(tools.env, project)
+    plan_path = write_terragrunt_plan(
+        tools.env,
+        project,
+        additional_plan_args,
+        subprocess_args,
+    )
+    plan = show_terragrunt_plan(tools.env, project, plan_path, subprocess_args)
+    if not get_plan_changes(plan):
+        print_no_changes(name, (subprocess_args or {}).get("stdout"))
+        return False
+
+    confirm_saved_plan(name)
+    approval_args = (
+        ["--terragrunt-non-interactive"] if os.environ.get("NO_CONFIRM") else []
+    )
+    run_terragrunt_generic_with_project(
+        tools.env,
+        project,
+        "apply",
+        [*(additional_apply_args or []), *approval_args, str(plan_path)],
+        subprocess_args=subprocess_args,
+    )
+    return True
+
+
+def get_terragrunt_log_path(env: ProvisionerEnvironment, project: str):
+    return env.PROV_RUN_DIR / project / "terragrunt.log"
+
+
+def get_terragrunt_init_log_path(env: ProvisionerEnvironment, project: str):
+    return env.PROV_RUN_DIR / project / "init.log"
+
+
+# Initializes projects before their runs, for example while another stack is
+# applied. The snapshot key of each project then matches, and its run skips
+# init. A failed init is only reported, because the run tries it again.
+def init_terragrunt_projects(tools: ProvisionerTools, projects: list):
+    for project in projects:
+        log_path = get_terragrunt_init_log_path(tools.env, project)
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(log_path, "w") as log:
+                run_terragrunt_generic_with_project(
+                    tools.env,
+                    project,
+                    "init",
+                    TERRAGRUNT_INIT_ARGS,
+                    subprocess_args={
+                        "stdin": subprocess.DEVNULL,
+                        "stdout": log,
+                        "stderr": subprocess.STDOUT,
+                    },
+                )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            print(
+                f"Early init of {project} failed, see {log_path}. It runs "
+                "again with the project.",
+                flush=True,
+            )
+
+
+# Messages of a buffered run go to its log as well, so that they are printed
+# with the rest of its output instead of among the other projects.
+def open_terragrunt_log(env: ProvisionerEnvironment, project: str):
+    log_path = get_terragrunt_log_path(env, project)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    return open(log_path, "w")
+
+
+def run_terragrunt_buffered(
+    tools: ProvisionerTools,
+    project: str,
+    log,
+    additional_args=None,
+):
+    return run_terragrunt(
+        tools,
+        project,
+        additional_plan_args=additional_args,
+        additional_apply_args=additional_args,
+        subprocess_args={
+            "stdin": subprocess.DEVNULL,
+            "stdout": log,
+            "stderr": subprocess.STDOUT,
+        },
+    )
+
+
+# Like run_terraform_steps, a targeted run removes the manifest entry without
+# recording a new one.
+def run_terragrunt_project(
+    tools: ProvisionerTools,
+    project: str,
+    force: bool = False,
+    buffered: bool = False,
+    targets=None,
+):
+    manifest_key = get_terragrunt_manifest_key(tools.env, project)
+    with trace_span(
+        "manifest",
+        stack=tools.env.PROV_PROJ_NAME,
+        project=project,
+    ) as span:
+        digest = get_terragrunt_inputs_digest(tools.env, project)
+        span["cached"] = not (force or targets) and is_manifest_entry_current(
+            get_manifest_path(tools.env),
+            manifest_key,
+            digest,
+        )
+
+    if span["cached"]:
+        if not buffered:
+            print(
+                f"Skipping {manifest_key}: inputs are unchanged since the last "
+                "successful apply. Use --force to run anyway.",
+                flush=True,
+            )
+        return "unchanged"
+
+    dry_run = bool(os.environ.get("DRY_RUN"))
+    log_context = (
+        open_terragrunt_log(tools.env, project) if buffered else nullcontext()
+    )
+    with (
+        log_context as log,
+        tuned_parallelism(
+            tools.env.PROV_CACHE_DIR,
+            manifest_key,
+            record=not (dry_run or targets),
+            output=log,
+        ) as run,
+    ):
+        if not dry_run:
+            remove_manifest_entry(get_manifest_path(tools.env), manifest_key)
+        if buffered:
+            applied = run_terragrunt_buffered(tools, project, log, run["args"])
+        else:
+            applied = run_terragrunt(
+                tools,
+                project,
+                additional_plan_args=run["args"],
+                additional_apply_args=run["args"],
+                targets=targets,
+            )
+
+        if not dry_run:
+            if not targets:
+                record_manifest_entry(
+                    get_manifest_path(tools.env),
+                    manifest_key,
+                    digest,
+                )
+            # Dependents are not forced after a plan without changes.
+            if not applied:
+                return "unchanged"
+            if state := cache_terragrunt_outputs(tools.env, project):
+                run["resources"] = count_resources(state)
+
+    return "succeeded"
+
+
+def print_project_run(tools: ProvisionerTools, run, buffered: bool):
+    lock_wait = ""
+    if run.lock_wait:
+        lock_wait = f" after waiting {run.lock_wait:.1f}s for the state lock"
+    print(
+        f"==> {run.project}: {run.status} in {run.duration:.1f}s{lock_wait}",
+        flush=True,
+    )
+
+    log_path = get_terragrunt_log_path(tools.env, run.project)
+    if buffered and run.status in ("succeeded", "failed"):
+        if log_path.is_file():
+            print(log_path.read_text(), end="", flush=True)
+
+
+def run_terragrunt_projects(
+    tools: ProvisionerTools,
+    graph: dict,
+    parallelism: int = 1,
+    force: bool = False,
+):
+    # Apply prompts need the terminal, so interactive runs go one project at a
+    # time without buffering the output.
+    buffered = bool(os.environ.get("DRY_RUN") or os.environ.get("NO_CONFIRM"))
+    # Dependents of a project that ran may read changed outputs from it.
+    changed = set()
+
+    def run_project(project):
+        return run_terragrunt_project(
+            tools,
+            project,
+            force=force or bool(graph[project] & changed),
+            buffered=buffered,
+        )
+
+    def on_complete(run):
+        if run.status == "succeeded":
+            changed.add(run.project)
+        print_project_run(tools, run, buffered)
+
+    runs = run_project_graph(
+        graph,
+        run_project,
+        parallelism=max(parallelism, 1) if buffered else 1,
+        on_complete=on_complete,
+    )
+
+    if failed := [
+        run.project for run in runs if run.status not in SUCCESS_STATUSES
+    ]:
+        raise RuntimeError(
+            "Terragrunt projects did not succeed: " + ", ".join(failed)
+        )
+
+    return {
+        run.project: {
+            "status": run.status,
+            "duration": round(run.duration, 1),
+            "lock_wait": round(run.lock_wait, 1),
+        }
+        for run in runs
+    }
+
+
+def find_lockfiles():
+    return sorted(
+        path
+        for path in BASE_DIR.rglob(".terraform.lock.hcl")
+        if not {".terraform", ".terragrunt-cache", ".cache"}
+        & set(path.relative_to(BASE_DIR).parts)
+    )
+
+
+# Fills the shared plugin cache by initializing a scratch configuration that
+# requires exactly the providers pinned in each lock file.
+def prewarm_plugin_cache(tools: ProvisionerTools):
+    init_plugin_cache(tools.env.PROV_CACHE_DIR)
+    lockfiles = find_lockfiles()
+    for lockfile in lockfiles:
+        with tempfile.TemporaryDirectory() as directory:
+            work_dir = Path(directory)
+            shutil.copy(lockfile, work_dir / ".terraform.lock.hcl")
+            (work_dir / "providers.tf").write_text(
+                render_required_providers(read_lockfile_providers(lockfile))
+            )
+            run_terraform_generic(
+                tools.env._replace(PROV_CODE_DIR=work_dir),
+                "init",
+                ["-backend=false", "-input=false", "-lockfile=readonly"],
+                subprocess_args={
+                    "env": {
+                        **os.environ,
+                        "TF_DATA_DIR": str(work_dir / ".terraform"),
+                    },
+                },
+            )
+
+    return {
+        "lockfiles": [str(path.relative_to(BASE_DIR)) for path in lockfiles],
+        "hits": PLUGIN_CACHE_STATS["hits"],
+        "misses": PLUGIN_CACHE_STATS["misses"],
+    }
+
+
+def is_terragrunt_stack(code_dir: Path):
+    return (code_dir / "terragrunt.hcl").is_file()
+
+
+def get_stack_workspaces(script_path: Path):
+    code_dir = script_path.parent
+    if not is_terragrunt_stack(code_dir):
+        return {code_dir.name: (None, get_terraform_workspace(code_dir))}
+
+    return {
+        f"{code_dir.name}/{project}": (
+            project,
+            get_terragrunt_workspace(code_dir, project),
+        )
+        for project in load_stack_projects(script_path)
+    }
+
+
+def pull_stack_state(env: ProvisionerEnvironment, project: str | None):
+    if project is None:
+        run_terraform_init(env)
+        return pull_terraform_state(env)
+
+    run_terragrunt_generic_with_project(
+        env,
+        project,
+        "init",
+        TERRAGRUNT_INIT_ARGS,
+    )
+    return pull_terragrunt_state(env, project)
+
+
+# Outputs come from the cache that each apply writes. With `refresh`, the
+# state of a workspace is read again when its serial has changed since.
+def get_stack_outputs(script_path: Path, refresh: bool = False):
+    outputs = {}
+    tools = None
+    for name, (project, workspace) in get_stack_workspaces(script_path).items():
+        cache_path = get_outputs_cache_path(get_cache_dir(), workspace)
+        entry = read_outputs_cache(cache_path)
+        if refresh and (
+            not entry or entry["serial"] != get_state_serial(workspace)
+        ):
+            if tools is None:
+                tools = init_environment(
+                    script_path,
+                    use_terraform=project is None,
+                    use_terragrunt=project is not None,
+                )
+            # Outputs are printed on stdout, so command output goes to stderr.
+            with redirect_stdout(sys.stderr):
+                state = pull_stack_state(tools.env, project)
+            entry = write_outputs_cache(cache_path, workspace, state)
+
+        if not entry:
+            raise RuntimeError(
+                f"No cached outputs of {name}. Apply it or run "
+                "`outputs --refresh`."
+            )
+
+        outputs[name] = entry["outputs"]
+
+    return outputs
+
+
+def get_stack_graphs():
+    return {
+        script_path.parent.name: (
+            get_project_graph(
+                script_path.parent,
+                load_stack_projects(script_path),
+            )
+            if is_terragrunt_stack(script_path.parent)
+            else None
+        )
+        for script_path in sorted(BASE_DIR.glob("*/provision.py"))
+    }
+
+
+def get_affected_stacks(ref: str):
+    return get_affected(get_changed_paths(BASE_DIR, ref), get_stack_graphs())
+
+
+def print_unaffected(name: str, ref: str):
+    print(
+        f"Skipping {name}: nothing it depends on has changed since {ref}.",
+        flush=True,
+    )
+
+
+def add_provisioner_commands(app, script_path: Path):
+    @app.command()
+    def prewarm():
+        return prewarm_plugin_cache(init_environment(script_path))
+
+    @app.command()
+    def affected(ref: str):
+        return get_affected_stacks(ref)
+
+    @app.command()
+    def outputs(refresh: bool = False):
+        return get_stack_outputs(script_path, refresh)
+
+    @app.command()
+    def parallelism():
+        return get_parallelism_report(get_cache_dir(), script_path.parent.name)
+
+    add_history_commands(app, get_cache_dir, script_path.parent.name)
+
+
+def write_global_vars(tools: ProvisionerTools, get_global_vars):
+    with trace_span("preprovision", stack=tools.env.PROV_PROJ_NAME):
+        variables = get_global_vars(tools)
+
+    write_terragrunt_vars(tools.env, "", variables)
+
+
+def write_preprovision_vars(
+    script_path: Path,
+    tools: ProvisionerTools,
+    projects: list,
+):
+    for result in run_preprovision_hooks(script_path, tools, projects):
+        if result.variables is not None:
+            write_terragrunt_vars(tools.env, result.project, result.variables)
 
 
 def make_terragrunt_command(
@@ -273,33 +1527,70 @@ def make_terragrunt_command(
     project: str,
     get_global_vars,
 ):
-    def command():
+    def command(force: bool = False, target: list[str] = None):
         tools = init_environment(script_path, use_terragrunt=True)
-        write_terragrunt_vars(tools.env, "", get_global_vars(tools))
+        write_global_vars(tools, get_global_vars)
+        write_preprovision_vars(script_path, tools, [project])
 
-        preprovision = import_preprovision_module(script_path, project)
-        if preprovision:
-            write_terragrunt_vars(
-                tools.env,
+        status = retry_on_lock(
+            lambda: run_terragrunt_project(
+                tools,
                 project,
-                preprovision.get_vars(tools, project),
+                force=force,
+                targets=target,
             )
+        )
+        # CI jobs of dependent projects read this to decide whether to force.
+        if status_file := os.environ.get("PROV_STATUS_FILE"):
+            Path(status_file).write_text(status)
 
-        run_terragrunt(tools, project)
+        if target:
+            print_target_warning(
+                get_terragrunt_manifest_key(tools.env, project),
+                target,
+            )
 
     return command
 
 
+def load_stack_projects(script_path: Path):
+    return load_projects(script_path.parent, get_cache_dir() / "projects.json")
+
+
+def run_terragrunt_stack(
+    script_path: Path,
+    tools: ProvisionerTools,
+    projects: list,
+    get_global_vars,
+    parallelism: int = 4,
+    force: bool = False,
+    affected: dict | None = None,
+):
+    graph = get_project_graph(tools.env.PROV_CODE_DIR, projects)
+    # Dependencies that are left out count as satisfied.
+    if affected is not None:
+        graph = {
+            project: graph[project]
+            for project in affected.get(tools.env.PROV_PROJ_NAME, {}).get(
+                "projects",
+                [],
+            )
+        }
+
+    write_global_vars(tools, get_global_vars)
+
+    write_preprovision_vars(script_path, tools, list(graph))
+
+    return run_terragrunt_projects(tools, graph, parallelism, force)
+
+
 def make_terragrunt_app(
     script_path: Path,
     get_global_vars,
 ):
     app = get_app()
-    projects = [
-        file.parent.name
-        for file in script_path.parent.glob("*/terragrunt.hcl")
-        if not file.parent.name.startswith("_")
-    ]
+    add_provisioner_commands(app, script_path)
+    projects = load_stack_projects(script_path)
 
     for project in projects:
         app.command(name=project)(
@@ -311,19 +1602,34 @@ def make_terragrunt_app(
         )
 
     @app.command()
-    def all():
+    def changes():
         tools = init_environment(script_path, use_terragrunt=True)
-        write_terragrunt_vars(tools.env, "", get_global_vars(tools))
+        write_global_vars(tools, get_global_vars)
+        write_preprovision_vars(script_path, tools, projects)
+        return get_terragrunt_changes(tools, projects)
 
-        for project in projects:
-            preprovision = import_preprovision_module(script_path, project)
-            if preprovision:
-                write_terragrunt_vars(
-                    tools.env,
-                    project,
-                    preprovision.get_vars(tools, project),
-                )
+    @app.command()
+    def all(
+        parallelism: int = 4,
+        force: bool = False,
+        changed_since: str = None,
+    ):
+        affected = None
+        if changed_since:
+            affected = get_affected_stacks(changed_since)
+            if script_path.parent.name not in affected:
+                print_unaffected(script_path.parent.name, changed_since)
+                return {}
 
-        run_terragrunt(tools, "__all__")
+        tools = init_environment(script_path, use_terragrunt=True)
+        return run_terragrunt_stack(
+            script_path,
+            tools,
+            projects,
+            get_global_vars,
+            parallelism,
+            force,
+            affected,
+        )
 
     return app
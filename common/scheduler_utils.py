@@ -0,0 +1,270 @@
+import json
+import os
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from common.hcl_utils import get_block_bodies, strip_comments
+from common.lock_utils import (
+    StateLockedError,
+    get_lock_retry_delay,
+    record_lock_wait,
+)
+from common.utils import write_text_atomic
+
+DEPENDENCY_BLOCK_PATTERN = re.compile(
+    r'^\s*dependency\s+"[^"]*"\s*\{',
+    re.MULTILINE,
+)
+DEPENDENCIES_BLOCK_PATTERN = re.compile(r"^\s*dependencies\s*\{", re.MULTILINE)
+CONFIG_PATH_PATTERN = re.compile(r'config_path\s*=\s*"([^"]+)"')
+PATHS_PATTERN = re.compile(r"paths\s*=\s*\[([^\]]*)\]")
+STRING_PATTERN = re.compile(r'"([^"]+)"')
+
+# Projects whose inputs are unchanged since their last apply count as
+# successful for their dependents.
+SUCCESS_STATUSES = {"succeeded", "unchanged"}
+
+# `duration` leaves out `lock_wait`, the time spent in attempts that failed on
+# the state lock and waiting between them.
+ProjectRun = namedtuple(
+    "ProjectRun",
+    ["project", "status", "duration", "error", "lock_wait"],
+    defaults=[0.0],
+)
+
+
+def discover_projects(code_dir: Path):
+    return sorted(
+        file.parent.name
+        for file in code_dir.glob("*/terragrunt.hcl")
+        if not file.parent.name.startswith("_")
+    )
+
+
+def get_directory_mtimes(code_dir: Path, names: list):
+    return {name: (code_dir / name).stat().st_mtime_ns for name in names}
+
+
+# Project discovery is cached in `registry_path`. An entry stays valid while
+# the code directory and each of its subdirectories keep their modification
+# times, which change whenever an entry is added, removed or renamed in them.
+def load_projects(code_dir: Path, registry_path: Path):
+    key = str(code_dir)
+    try:
+        entry = json.loads(registry_path.read_text()).get(key)
+        if entry and get_directory_mtimes(
+            code_dir,
+            list(entry["mtimes"]),
+        ) == entry["mtimes"]:
+            return entry["projects"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    # The times are read first, so that changes made during the discovery
+    # invalidate the entry.
+    names = ["."] + sorted(
+        directory.name
+        for directory in os.scandir(code_dir)
+        if directory.is_dir()
+    )
+    mtimes = get_directory_mtimes(code_dir, names)
+    projects = discover_projects(code_dir)
+
+    try:
+        try:
+            registry = json.loads(registry_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            registry = {}
+        registry[key] = {"mtimes": mtimes, "projects": projects}
+        write_text_atomic(registry_path, json.dumps(registry, indent=2))
+    except OSError:
+        pass
+
+    return projects
+
+
+def get_project_dependencies(code_dir: Path, project: str):
+    project_dir = code_dir / project
+    content = strip_comments((project_dir / "terragrunt.hcl").read_text())
+
+    paths = [
+        path
+        for body in get_block_bodies(content, DEPENDENCY_BLOCK_PATTERN)
+        for path in CONFIG_PATH_PATTERN.findall(body)
+    ] + [
+        path
+        for body in get_block_bodies(content, DEPENDENCIES_BLOCK_PATTERN)
+        for paths in PATHS_PATTERN.findall(body)
+        for path in STRING_PATTERN.findall(paths)
+    ]
+
+    dependencies = set()
+    for path in paths:
+        dependency_dir = (project_dir / path).resolve()
+        if dependency_dir.parent != code_dir.resolve():
+            raise RuntimeError(
+                f"Unsupported dependency path in project {project}: {path}"
+            )
+        dependencies.add(dependency_dir.name)
+
+    return dependencies
+
+
+def get_project_order(graph: dict):
+    order = []
+    remaining = {
+        project: set(dependencies) & graph.keys()
+        for project, dependencies in graph.items()
+    }
+    while remaining:
+        ready = sorted(
+            project
+            for project, dependencies in remaining.items()
+            if not dependencies
+        )
+        if not ready:
+            raise RuntimeError(
+                "Dependency cycle between projects: "
+                + ", ".join(sorted(remaining))
+            )
+
+        order.extend(ready)
+        for project in ready:
+            del remaining[project]
+        for dependencies in remaining.values():
+            dependencies.difference_update(ready)
+
+    return order
+
+
+def get_project_graph(code_dir: Path, projects: list):
+    graph = {
+        project: get_project_dependencies(code_dir, project)
+        for project in projects
+    }
+
+    for project, dependencies in graph.items():
+        if unknown := dependencies - graph.keys():
+            raise RuntimeError(
+                f"Project {project} depends on unknown projects: "
+                + ", ".join(sorted(unknown))
+            )
+
+    get_project_order(graph)
+    return graph
+
+
+def run_timed(run_project, project: str):
+    start = time.monotonic()
+    try:
+        status = run_project(project) or "succeeded"
+    except Exception as error:
+        return ProjectRun(project, "failed", time.monotonic() - start, error)
+
+    return ProjectRun(project, status, time.monotonic() - start, None)
+
+
+# Runs every project once all of its dependencies have succeeded, with at most
+# `parallelism` projects in flight. Dependencies outside the graph are treated
+# as satisfied, so callers can schedule a subset of the projects. Projects that
+# depend on a failed project are skipped. A project whose state is locked is
+# tried again after a backoff, and other projects run in the meantime.
+def run_project_graph(
+    graph: dict,
+    run_project,
+    parallelism: int = 1,
+    on_complete=None,
+):
+    order = get_project_order(graph)
+    pending = {
+        project: set(graph[project]) & graph.keys() for project in order
+    }
+    runs = {}
+    running = {}
+    # Locked projects, with the time of their next attempt
+    deferred = {}
+    attempts = {}
+    lock_waits = {}
+    # Locked workspaces of deferred projects, and when their wait started
+    locked_at = {}
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        while pending or running or deferred:
+            now = time.monotonic()
+            for project, retry_at in sorted(
+                deferred.items(),
+                key=lambda item: item[1],
+            ):
+                if retry_at <= now and len(running) < parallelism:
+                    del deferred[project]
+                    workspace, since = locked_at[project]
+                    lock_waits[project] += now - since
+                    record_lock_wait(workspace, now - since)
+                    future = executor.submit(run_timed, run_project, project)
+                    running[future] = project
+
+            for project, dependencies in list(pending.items()):
+                statuses = {
+                    runs[dependency].status
+                    for dependency in dependencies
+                    if dependency in runs
+                }
+                if statuses - SUCCESS_STATUSES:
+                    del pending[project]
+                    runs[project] = ProjectRun(project, "skipped", 0.0, None)
+                    if on_complete:
+                        on_complete(runs[project])
+                elif (
+                    all(dependency in runs for dependency in dependencies)
+                    and len(running) < parallelism
+                ):
+                    del pending[project]
+                    future = executor.submit(run_timed, run_project, project)
+                    running[future] = project
+
+            next_retry = min(deferred.values(), default=None)
+            if not running:
+                if next_retry is not None:
+                    time.sleep(max(next_retry - time.monotonic(), 0))
+                continue
+
+            done, _ = wait(
+                running,
+                timeout=(
+                    None
+                    if next_retry is None
+                    else max(next_retry - time.monotonic(), 0)
+                ),
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                project = running.pop(future)
+                run = future.result()
+                lock_wait = lock_waits.setdefault(project, 0.0)
+                if isinstance(run.error, StateLockedError):
+                    try:
+                        delay = get_lock_retry_delay(
+                            run.error,
+                            attempts.get(project, 0),
+                            lock_wait + run.duration,
+                        )
+                    except RuntimeError as error:
+                        lock_wait += run.duration
+                        run = run._replace(duration=0.0, error=error)
+                    else:
+                        attempts[project] = attempts.get(project, 0) + 1
+                        locked_at[project] = (
+                            run.error.workspace,
+                            time.monotonic() - run.duration,
+                        )
+                        deferred[project] = time.monotonic() + delay
+                        continue
+
+                runs[project] = run._replace(lock_wait=lock_wait)
+                if on_complete:
+                    on_complete(runs[project])
+
+    return list(runs.values())
@@ -0,0 +1,146 @@
+import atexit
+import json
+import re
+import shutil
+import sys
+import tarfile
+import threading
+import time
+from pathlib import Path
+
+from common.trace_utils import trace_span
+from common.utils import write_text_atomic
+
+SNAPSHOT_KEY_FILE = ".prov-snapshot-key"
+
+SNAPSHOT_SAVINGS = {}
+SNAPSHOT_LOCK = threading.Lock()
+
+# Python releases before 3.11.4 do not know about extraction filters.
+EXTRACT_ARGS = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+
+
+def get_snapshot_dir(cache_dir: Path):
+    return cache_dir / "snapshots"
+
+
+def get_snapshot_stem(name: str):
+    return name.replace("/", "-")
+
+
+def get_snapshot_paths(snapshot_dir: Path, name: str, key: str):
+    stem = f"{get_snapshot_stem(name)}-{key}"
+    return snapshot_dir / f"{stem}.tar.gz", snapshot_dir / f"{stem}.json"
+
+
+def has_broken_links(directory: Path):
+    return any(
+        path.is_symlink() and not path.exists()
+        for path in directory.rglob("*")
+    )
+
+
+def record_snapshot_savings(name: str, saved: float):
+    with SNAPSHOT_LOCK:
+        if not SNAPSHOT_SAVINGS:
+            atexit.register(report_snapshot_savings)
+        SNAPSHOT_SAVINGS[name] = saved
+
+
+def restore_snapshot(snapshot_dir: Path, name: str, key: str, target: Path):
+    key_file = target / SNAPSHOT_KEY_FILE
+    if key_file.is_file() and key_file.read_text() == key:
+        return True
+
+    archive_path, metadata_path = get_snapshot_paths(snapshot_dir, name, key)
+    if not archive_path.is_file() or not metadata_path.is_file():
+        return False
+
+    start = time.monotonic()
+    shutil.rmtree(target, ignore_errors=True)
+    target.mkdir(parents=True)
+    with tarfile.open(archive_path) as archive:
+        archive.extractall(target, **EXTRACT_ARGS)
+
+    # Provider directories link into the plugin cache, which may have evicted
+    # the version since the snapshot was taken.
+    if has_broken_links(target):
+        shutil.rmtree(target)
+        return False
+
+    metadata = json.loads(metadata_path.read_text())
+    record_snapshot_savings(
+        name,
+        metadata["init_duration"] - (time.monotonic() - start),
+    )
+    return True
+
+
+def save_snapshot(
+    snapshot_dir: Path,
+    name: str,
+    key: str,
+    target: Path,
+    init_duration: float,
+):
+    archive_path, metadata_path = get_snapshot_paths(snapshot_dir, name, key)
+    (target / SNAPSHOT_KEY_FILE).write_text(key)
+
+    # Only the latest snapshot of each working directory is kept.
+    stale_pattern = re.compile(
+        re.escape(get_snapshot_stem(name)) + r"-[0-9a-f]{64}\.(tar\.gz|json)"
+    )
+    for path in snapshot_dir.glob("*"):
+        if stale_pattern.fullmatch(path.name):
+            path.unlink()
+
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    temporary_path = archive_path.with_name(f".{archive_path.name}")
+    with tarfile.open(temporary_path, "w:gz") as archive:
+        archive.add(target, arcname=".")
+    temporary_path.replace(archive_path)
+    write_text_atomic(
+        metadata_path,
+        json.dumps({"init_duration": init_duration}),
+    )
+
+
+# Runs `run_init` unless a snapshot of the initialized working directory with
+# the same key can be restored, and snapshots the directory afterwards. The
+# span attributes name the stack and project, so that the run history counts
+# restores as cache hits.
+def run_with_snapshot(
+    snapshot_dir: Path,
+    name: str,
+    key: str,
+    target: Path,
+    run_init,
+    **span_attributes,
+):
+    with trace_span("snapshot", name=name, **span_attributes) as span:
+        span["restored"] = restore_snapshot(snapshot_dir, name, key, target)
+
+    if span["restored"]:
+        print(
+            f"Restored the initialized working directory of {name}.",
+            file=sys.stderr,
+            flush=True,
+        )
+        return None
+
+    start = time.monotonic()
+    result = run_init()
+    save_snapshot(snapshot_dir, name, key, target, time.monotonic() - start)
+    return result
+
+
+def report_snapshot_savings():
+    print(
+        "Init snapshots: "
+        + ", ".join(
+            f"{name} saved {saved:.1f}s"
+            for name, saved in sorted(SNAPSHOT_SAVINGS.items())
+        ),
+        file=sys.stderr,
+        flush=True,
+    )
@@ -0,0 +1,124 @@
+import re
+import sys
+from fnmatch import fnmatchcase
+
+GRAPH_NODE_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"')
+RESOURCE_PATTERN = re.compile(r"(?:data\.)?[\w-]+\.[\w-]+")
+NOT_RESOURCES = {"var", "local", "output", "module", "provider", "meta"}
+
+
+# Older versions of Terraform name the nodes "[root] address (expand)".
+def get_node_address(node: str):
+    address = node.replace('\\"', '"').removeprefix("[root] ")
+    return re.sub(r" \([^)]*\)$", "", address)
+
+
+def is_resource_address(address: str):
+    name = re.sub(r"^(module\.[\w-]+\.)+", "", address)
+    return (
+        bool(RESOURCE_PATTERN.fullmatch(name))
+        and name.split(".")[0] not in NOT_RESOURCES
+    )
+
+
+# Instances such as helm_release.release["ingress"] belong to the resource
+# that the configuration, and so the graph, names.
+def get_config_address(address: str):
+    return re.sub(r"\[[^\]]*\]", "", address)
+
+
+# The nodes of `terraform graph` with the nodes that each one depends on
+def parse_graph(text: str):
+    graph = {}
+    for line in text.splitlines():
+        nodes = [
+            get_node_address(node) for node in GRAPH_NODE_PATTERN.findall(line)
+        ]
+        if "->" in line and len(nodes) >= 2:
+            graph.setdefault(nodes[0], set()).add(nodes[1])
+            graph.setdefault(nodes[1], set())
+        elif nodes:
+            graph.setdefault(nodes[0], set())
+
+    return graph
+
+
+# Resources that `address` depends on, also through variables, locals,
+# modules and providers
+def get_dependencies(graph: dict, address: str):
+    dependencies = set()
+    seen = {address}
+    pending = [address]
+    while pending:
+        for node in graph.get(pending.pop(), ()):
+            if node in seen:
+                continue
+
+            seen.add(node)
+            pending.append(node)
+            if is_resource_address(node):
+                dependencies.add(node)
+
+    return dependencies
+
+
+# Patterns may use * and ?, while brackets are part of instance keys. A module
+# matches all the resources in it.
+def matches_target(address: str, pattern: str):
+    pattern = pattern.replace("[", "[[]")
+    return fnmatchcase(address, pattern) or (
+        pattern.startswith("module.") and fnmatchcase(address, f"{pattern}.*")
+    )
+
+
+def expand_targets(patterns: list, graph: dict, state_addresses: list):
+    candidates = set(state_addresses) | {
+        address for address in graph if is_resource_address(address)
+    }
+    targets = set()
+    for pattern in patterns:
+        matches = {
+            address
+            for address in candidates
+            if matches_target(address, pattern)
+        }
+        # A new instance of a resource is not in the state yet.
+        if not matches and get_config_address(pattern) in graph:
+            matches = {pattern}
+        if not matches:
+            raise RuntimeError(f"No resource matches the target {pattern}")
+
+        targets |= matches
+
+    for address in list(targets):
+        targets |= get_dependencies(graph, get_config_address(address))
+
+    # A resource covers all its instances.
+    return sorted(
+        address
+        for address in targets
+        if address == get_config_address(address)
+        or get_config_address(address) not in targets
+    )
+
+
+# Terraform takes the dependencies of -target along by itself. Expanding them
+# here resolves the patterns and shows the whole scope before the plan.
+def get_target_args(name: str, patterns: list, run_command):
+    graph = parse_graph(run_command("graph", []).stdout)
+    state_addresses = run_command("state", ["list"]).stdout.splitlines()
+    targets = expand_targets(patterns, graph, state_addresses)
+    print(
+        f"Targeting {len(targets)} resources in {name}: " + ", ".join(targets),
+        flush=True,
+    )
+    return [f"-target={target}" for target in targets]
+
+
+def print_target_warning(name: str, patterns: list):
+    print(
+        f"Warning: only {', '.join(patterns)} and their dependencies were "
+        f"planned in {name}. Drift outside the target was not checked.",
+        file=sys.stderr,
+        flush=True,
+    )
@@ -0,0 +1,116 @@
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+TRACE_SPANS = []
+TRACE_LOCK = threading.Lock()
+TRACE_STATE = threading.local()
+TRACE_FILES = []
+
+
+def start_tracing(trace_file: Path):
+    if not TRACE_FILES:
+        atexit.register(write_trace_files)
+    TRACE_FILES.append(Path(trace_file))
+
+
+def is_tracing():
+    return bool(TRACE_FILES)
+
+
+def get_span_stack():
+    if not hasattr(TRACE_STATE, "spans"):
+        TRACE_STATE.spans = []
+    return TRACE_STATE.spans
+
+
+def update_current_span(**attributes):
+    if spans := get_span_stack():
+        spans[-1].update(attributes)
+
+
+# Records how long the block takes. Attributes can be added while the span is
+# open, by the block itself or by update_current_span in the commands it runs.
+@contextmanager
+def trace_span(name: str, /, **attributes):
+    span = dict(attributes)
+    spans = get_span_stack()
+    spans.append(span)
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException as error:
+        span.setdefault("error", type(error).__name__)
+        raise
+    finally:
+        spans.pop()
+        with TRACE_LOCK:
+            TRACE_SPANS.append(
+                {
+                    "name": name,
+                    "start": start,
+                    "duration": time.perf_counter() - started,
+                    "thread": threading.current_thread().name,
+                    "thread_id": threading.get_native_id(),
+                    "attributes": span,
+                }
+            )
+
+
+def get_chrome_trace(spans: list):
+    threads = {span["thread_id"]: span["thread"] for span in spans}
+    return {
+        "traceEvents": [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": thread_id,
+                "args": {"name": name},
+            }
+            for thread_id, name in threads.items()
+        ]
+        + [
+            {
+                "name": span["name"],
+                "cat": "provisioner",
+                "ph": "X",
+                "ts": round(span["start"] * 1e6),
+                "dur": round(span["duration"] * 1e6),
+                "pid": os.getpid(),
+                "tid": span["thread_id"],
+                "args": span["attributes"],
+            }
+            for span in spans
+        ],
+        "displayTimeUnit": "ms",
+    }
+
+
+def get_trace_spans():
+    with TRACE_LOCK:
+        return sorted(TRACE_SPANS, key=lambda span: span["start"])
+
+
+# The spans of trace.json go to trace.jsonl, and those of any other trace file
+# to a .jsonl file with its name.
+def get_spans_file(trace_file: Path):
+    if trace_file.suffix == ".json":
+        return trace_file.with_name(trace_file.name + "l")
+
+    return trace_file.with_name(trace_file.name + ".jsonl")
+
+
+def write_trace_files():
+    spans = get_trace_spans()
+    for trace_file in TRACE_FILES:
+        trace_file.parent.mkdir(parents=True, exist_ok=True)
+        trace_file.write_text(json.dumps(get_chrome_trace(spans), indent=2))
+        get_spans_file(trace_file).write_text(
+            "".join(json.dumps(span) + "\n" for span in spans)
+        )
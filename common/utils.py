@@ -1,4 +1,6 @@
 import os
+import tempfile
+from pathlib import Path
 
 
 def get_env_value(*names):
@@ -7,3 +9,32 @@ def get_env_value(*names):
             return value
 
     return None
+
+
+def write_text_atomic(path: Path, content: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w",
+        dir=path.parent,
+        prefix=f".{path.name}.",
+        delete=False,
+    ) as file:
+        file.write(content)
+
+    os.replace(file.name, path)
+
+
+def write_text_if_changed(path: Path, content: str):
+    try:
+        if path.read_text() == content:
+            return False
+    except OSError:
+        pass
+
+    write_text_atomic(path, content)
+    return True
+
+
+# Run directories are on a tmpfs, so nothing in them outlives the container.
+def get_run_root():
+    return Path(os.environ.get("PROV_RUN_ROOT") or "/run")
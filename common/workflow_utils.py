@@ -6,29 +6,93 @@ import rjsonnet
 import json
 
 from common.cli_utils import TyperOutputFormat, get_app
+from common.impact_utils import STACK_CONSUMERS
+from common.provisioner_utils import get_stack_graphs
+from common.scheduler_utils import get_project_order
 
-PROVISION_JOBS = [
-    {
-        "name": "Provision infrastructure",
+PROVISION_ENV = {
+    "TF_TOKEN_app_terraform_io": "${{ secrets.TF_TOKEN_APP_TERRAFORM_IO }}",
+    "ARM_SUBSCRIPTION_ID": "${{ secrets.ARM_SUBSCRIPTION_ID }}",
+    "ARM_CLIENT_ID": "${{ secrets.ARM_CLIENT_ID }}",
+    "ARM_TENANT_ID": "${{ secrets.ARM_TENANT_ID }}",
+    "ARM_CLIENT_SECRET": "${{ secrets.ARM_CLIENT_SECRET }}",
+    "AZURE_KEY_VAULT_ADMIN_OBJECT_IDS": "${{ vars.AZURE_KEY_VAULT_ADMIN_OBJECT_IDS }}",
+    "AZURE_AKS_ADMIN_GROUP_OBJECT_IDS": "${{ vars.AZURE_AKS_ADMIN_GROUP_OBJECT_IDS }}",
+}
+PROVISIONER_RUN = "docker compose run --rm provisioner"
+STATUS_FILE = "outputs/provision-status"
+# A dependent project reads the outputs of its dependencies, so it runs even
+# when its own inputs are unchanged if one of them applied changes.
+FORCE_IF_APPLIED = "${{ contains(needs.*.outputs.applied, 'true') && ' --force' || '' }}"
+
+
+def get_job_name(stack: str, project: str | None = None):
+    return " ".join(["Provision", stack] + ([project] if project else []))
+
+
+def make_stack_job(stack: str, producers: list, command: list, **spec):
+    return {
+        "name": spec.pop("name", get_job_name(stack)),
         "command": "\n".join(
-            [
-                "docker compose run --rm provisioner ./azure/provision.py all",
-                "cat outputs/azure.env >> .env",
-                "docker compose run --rm provisioner ./kubernetes-shared/provision.py all",
-                "git diff --exit-code",
-            ]
+            [f"cat outputs/{producer}.env >> .env" for producer in producers]
+            + command
+            + ["git diff --exit-code"]
         ),
-        "env": {
-            "TF_TOKEN_app_terraform_io": "${{ secrets.TF_TOKEN_APP_TERRAFORM_IO }}",
-            "ARM_SUBSCRIPTION_ID": "${{ secrets.ARM_SUBSCRIPTION_ID }}",
-            "ARM_CLIENT_ID": "${{ secrets.ARM_CLIENT_ID }}",
-            "ARM_TENANT_ID": "${{ secrets.ARM_TENANT_ID }}",
-            "ARM_CLIENT_SECRET": "${{ secrets.ARM_CLIENT_SECRET }}",
-            "AZURE_KEY_VAULT_ADMIN_OBJECT_IDS": "${{ vars.AZURE_KEY_VAULT_ADMIN_OBJECT_IDS }}",
-            "AZURE_AKS_ADMIN_GROUP_OBJECT_IDS": "${{ vars.AZURE_AKS_ADMIN_GROUP_OBJECT_IDS }}",
-        },
-    },
-]
+        "dependencies": [get_job_name(producer) for producer in producers]
+        + spec.pop("dependencies", []),
+        "download_outputs": [get_job_name(producer) for producer in producers],
+        "upload_outputs": stack in STACK_CONSUMERS,
+        "persist_cache": True,
+        "env": PROVISION_ENV,
+        **spec,
+    }
+
+
+# One job for each Terraform stack and for each Terragrunt project. Jobs wait
+# for the stacks whose outputs they read and for the projects they depend on,
+# so independent projects run at the same time.
+def get_provision_jobs():
+    graphs = get_stack_graphs()
+    jobs = []
+    for stack, graph in graphs.items():
+        producers = sorted(
+            producer
+            for producer, consumers in STACK_CONSUMERS.items()
+            if stack in consumers and producer in graphs
+        )
+        if graph is None:
+            jobs.append(
+                make_stack_job(
+                    stack,
+                    producers,
+                    [f"{PROVISIONER_RUN} ./{stack}/provision.py all"],
+                )
+            )
+            continue
+
+        for project in get_project_order(graph):
+            force = FORCE_IF_APPLIED if graph[project] else ""
+            jobs.append(
+                make_stack_job(
+                    stack,
+                    producers,
+                    [
+                        f"echo 'PROV_STATUS_FILE={STATUS_FILE}' >> .env",
+                        f"{PROVISIONER_RUN} ./{stack}/provision.py {project}{force}",
+                        f'if [ "$(cat {STATUS_FILE})" = succeeded ]; then '
+                        'echo applied=true >> "$GITHUB_OUTPUT"; fi',
+                    ],
+                    name=get_job_name(stack, project),
+                    dependencies=[
+                        get_job_name(stack, dependency)
+                        for dependency in sorted(graph[project])
+                    ],
+                    outputs=["applied"],
+                )
+            )
+
+    return jobs
+
 
 app = get_app(default_output_format=TyperOutputFormat.raw)
 
@@ -38,7 +102,7 @@ def generate_provision_workflow(jsonnet_file: str):
         str(jsonnet_file),
         preserve_order=True,
         tla_codes={
-            "provision_jobs": json.dumps(PROVISION_JOBS)
+            "provision_jobs": json.dumps(get_provision_jobs())
         }
     )
 
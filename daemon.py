@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+
+from common.cli_utils import get_app
+from common.daemon_client import get_socket_path
+from common.daemon_utils import run_daemon
+
+app = get_app()
+
+
+@app.command()
+def serve(socket: Path = None):
+    socket_path = socket or get_socket_path()
+    if not socket_path:
+        raise RuntimeError("PROV_DAEMON_SOCKET is empty, so there is no socket")
+
+    run_daemon(socket_path)
+
+
+if __name__ == "__main__":
+    app()
@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
 
+from common.daemon_client import forward_to_daemon
+
+# Runs the command in the provisioner daemon when one is listening, before the
+# imports that the daemon already has.
+forward_to_daemon(__name__, __file__)
+
 from pathlib import Path
 
+from common.kubeconfig_utils import write_kubeconfig
 from common.provisioner_utils import ProvisionerTools, make_terragrunt_app
 from common.utils import get_env_value
 
 SCRIPT_PATH = Path(__file__)
 
 
-def write_kubeconfig(tools: ProvisionerTools, kubeconfig: str):
+# All projects read the same file, which keeps its modification time while
+# KUBE_CONFIG is unchanged.
+def write_stack_kubeconfig(tools: ProvisionerTools, kubeconfig: str):
     kube_config_path = tools.env.PROV_RUN_DIR / "kubeconfig"
-    with open(kube_config_path, "w") as f:
-        f.write(kubeconfig)
+    write_kubeconfig(kube_config_path, kubeconfig)
 
     return str(kube_config_path)
 
@@ -31,14 +39,24 @@ def require_var(name: str, value: str | None, hint: str):
     raise RuntimeError(f"Missing {name}. {hint}")
 
 
-def get_vars(tools: ProvisionerTools):
+# `azure_outputs` are the outputs of the Azure stack when both stacks run in
+# one pipeline. Otherwise they come from the environment.
+def get_vars(tools: ProvisionerTools, azure_outputs=None):
+    if azure_outputs:
+        return {
+            "kube_config_path": resolve_kubeconfig_path(
+                str(azure_outputs.kube_config_path)
+            ),
+            "ingress_external_ip": azure_outputs.ingress_external_ip,
+        }
+
     kube_config_path = get_env_value("KUBE_CONFIG_PATH", "KUBECONFIG")
     if kube_config_path:
         kube_config_path = resolve_kubeconfig_path(kube_config_path)
     else:
         kubeconfig = get_env_value("KUBE_CONFIG")
         if kubeconfig:
-            kube_config_path = write_kubeconfig(tools, kubeconfig)
+            kube_config_path = write_stack_kubeconfig(tools, kubeconfig)
 
     return {
         "kube_config_path": require_var(
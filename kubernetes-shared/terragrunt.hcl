@@ -12,6 +12,7 @@ terraform {
     ]
   }
 
+  # Longer waits for the state lock are left to the provisioner.
   extra_arguments "retry_lock" {
     commands = [
       "init",
@@ -24,7 +25,7 @@ terraform {
     ]
 
     arguments = [
-      "-lock-timeout=20m"
+      "-lock-timeout=10s"
     ]
   }
 }
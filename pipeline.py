@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+from common.daemon_client import forward_to_daemon
+
+# Runs the command in the provisioner daemon when one is listening, before the
+# imports that the daemon already has.
+forward_to_daemon(__name__, __file__)
+
+import importlib.util
+import json
+import sys
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from azure import provision as azure_provision
+from common.cli_utils import get_app
+from common.history_utils import add_history_commands
+from common.process_utils import run_tasks
+from common.provisioner_utils import (
+    check_terraform_drift,
+    check_terragrunt_drift,
+    get_affected_stacks,
+    get_cache_dir,
+    get_terraform_changes,
+    get_terragrunt_changes,
+    get_terragrunt_manifest_key,
+    init_environment,
+    init_terragrunt_projects,
+    load_stack_projects,
+    print_unaffected,
+    run_drift_checks,
+    run_terragrunt_stack,
+    write_global_vars,
+    write_preprovision_vars,
+    write_terraform_vars,
+)
+from common.utils import write_text_atomic
+
+KUBERNETES_SHARED_SCRIPT_PATH = (
+    Path(__file__).parent / "kubernetes-shared" / "provision.py"
+)
+
+app = get_app()
+add_history_commands(app, get_cache_dir)
+
+
+def import_kubernetes_shared():
+    spec = importlib.util.spec_from_file_location(
+        "kubernetes_shared_provision",
+        KUBERNETES_SHARED_SCRIPT_PATH,
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Provisions the Azure stack and then kubernetes-shared in one process. The
+# Terragrunt projects are initialized while Azure is applied, and the Azure
+# outputs are passed to kubernetes-shared directly.
+@app.command()
+def all(
+    parallelism: int = 4,
+    force: bool = False,
+    changed_since: str = None,
+):
+    affected = get_affected_stacks(changed_since) if changed_since else None
+    if affected == {}:
+        print_unaffected("the pipeline", changed_since)
+        return {}
+
+    kubernetes_shared = import_kubernetes_shared()
+    azure_tools = init_environment(
+        azure_provision.SCRIPT_PATH,
+        use_terraform=True,
+    )
+    kubernetes_tools = init_environment(
+        KUBERNETES_SHARED_SCRIPT_PATH,
+        use_terragrunt=True,
+    )
+    projects = load_stack_projects(KUBERNETES_SHARED_SCRIPT_PATH)
+    if affected is not None:
+        projects = affected[kubernetes_tools.env.PROV_PROJ_NAME]["projects"]
+
+    # kubernetes-shared needs the Azure outputs even when Azure is unchanged.
+    def provision_azure():
+        if affected is None or azure_tools.env.PROV_PROJ_NAME in affected:
+            return azure_provision.provision(azure_tools, force)
+
+        print_unaffected(azure_tools.env.PROV_PROJ_NAME, changed_since)
+        return azure_provision.read_stack_outputs(azure_tools)
+
+    azure_outputs, _ = run_tasks(
+        provision_azure,
+        lambda: init_terragrunt_projects(kubernetes_tools, projects),
+    )
+
+    return run_terragrunt_stack(
+        KUBERNETES_SHARED_SCRIPT_PATH,
+        kubernetes_tools,
+        load_stack_projects(KUBERNETES_SHARED_SCRIPT_PATH),
+        lambda tools: kubernetes_shared.get_vars(tools, azure_outputs),
+        parallelism,
+        force,
+        affected,
+    )
+
+
+# Whether `all` would change anything. kubernetes-shared is planned only when
+# Azure has no changes, with the current Azure outputs.
+@app.command()
+def changes():
+    kubernetes_shared = import_kubernetes_shared()
+    azure_tools = init_environment(
+        azure_provision.SCRIPT_PATH,
+        use_terraform=True,
+    )
+    kubernetes_tools = init_environment(
+        KUBERNETES_SHARED_SCRIPT_PATH,
+        use_terragrunt=True,
+    )
+    projects = load_stack_projects(KUBERNETES_SHARED_SCRIPT_PATH)
+
+    azure_changes = get_terraform_changes(
+        azure_tools,
+        azure_provision.get_tf_vars(),
+    )
+    if azure_changes["changed"]:
+        return azure_changes
+
+    with redirect_stdout(sys.stderr):
+        azure_outputs = azure_provision.read_stack_outputs(azure_tools)
+        write_global_vars(
+            kubernetes_tools,
+            lambda tools: kubernetes_shared.get_vars(tools, azure_outputs),
+        )
+        write_preprovision_vars(
+            KUBERNETES_SHARED_SCRIPT_PATH,
+            kubernetes_tools,
+            projects,
+        )
+
+    kubernetes_changes = get_terragrunt_changes(kubernetes_tools, projects)
+    return {
+        "changed": kubernetes_changes["changed"],
+        "workspaces": {
+            **azure_changes["workspaces"],
+            **kubernetes_changes["workspaces"],
+        },
+    }
+
+
+# Runs refresh-only plans of the Azure stack and every kubernetes-shared
+# project, up to `parallelism` at a time, and reports the resources that were
+# changed outside of Terraform. Nothing is applied and no state is locked.
+@app.command()
+def drift(parallelism: int = 8, report: Path = None):
+    kubernetes_shared = import_kubernetes_shared()
+    azure_tools = init_environment(
+        azure_provision.SCRIPT_PATH,
+        use_terraform=True,
+    )
+    kubernetes_tools = init_environment(
+        KUBERNETES_SHARED_SCRIPT_PATH,
+        use_terragrunt=True,
+    )
+    projects = load_stack_projects(KUBERNETES_SHARED_SCRIPT_PATH)
+
+    write_terraform_vars(azure_tools.env, azure_provision.get_tf_vars())
+    azure_outputs = azure_provision.read_stack_outputs(azure_tools)
+    write_global_vars(
+        kubernetes_tools,
+        lambda tools: kubernetes_shared.get_vars(tools, azure_outputs),
+    )
+    write_preprovision_vars(
+        KUBERNETES_SHARED_SCRIPT_PATH,
+        kubernetes_tools,
+        projects,
+    )
+
+    checks = {
+        azure_tools.env.PROV_PROJ_NAME: lambda: check_terraform_drift(
+            azure_tools.env
+        ),
+        **{
+            get_terragrunt_manifest_key(kubernetes_tools.env, project): (
+                lambda project=project: check_terragrunt_drift(
+                    kubernetes_tools.env,
+                    project,
+                )
+            )
+            for project in projects
+        },
+    }
+    results = run_drift_checks(checks, parallelism)
+    if report:
+        write_text_atomic(report, json.dumps(results, indent=2) + "\n")
+
+    if failed := [
+        name for name, result in results.items() if result["status"] == "failed"
+    ]:
+        raise RuntimeError("Drift checks did not succeed: " + ", ".join(failed))
+
+    return results
+
+
+if __name__ == "__main__":
+    app()
@@ -1,16 +1,68 @@
+import io
+import json
+import multiprocessing
 import os
+import shutil
 import stat
+import subprocess
 import tempfile
+import threading
+import time
 import unittest
+from collections import Counter
 from pathlib import Path
 from unittest import mock
 
+import pipeline
 from azure import provision as azure_provision
+from common import (
+    daemon_client,
+    daemon_utils,
+    event_utils,
+    history_utils,
+    lock_utils,
+    parallelism_utils,
+    plan_utils,
+    plugin_cache_utils,
+    preprovision_utils,
+    process_utils,
+    snapshot_utils,
+    target_utils,
+    trace_utils,
+)
+from common.cli_utils import (
+    TyperOutputFormat,
+    default_print_retval,
+    get_app,
+)
+from common.json_utils import iter_json_objects
+from common.manifest_utils import record_manifest_entry
 from common.provisioner_utils import (
+    ProvisionerEnvironment,
     ProvisionerTools,
+    check_terraform_drift,
+    find_changes,
+    get_manifest_path,
+    get_stack_outputs,
     get_terraform_output,
+    init_terragrunt_projects,
+    read_unchanged_outputs,
+    run_drift_checks,
+    run_terraform,
     run_terragrunt,
+    run_terragrunt_generic_with_project,
+    run_terragrunt_project,
 )
+from common import outputs_utils, scheduler_utils, workflow_utils
+from common.impact_utils import get_affected
+from common.scheduler_utils import (
+    discover_projects,
+    get_project_graph,
+    load_projects,
+    run_project_graph,
+)
+
+KUBERNETES_SHARED_DIR = Path(__file__).parent.parent / "kubernetes-shared"
 
 
 class AzureProvisionerTests(unittest.TestCase):
@@ -97,29 +149,46 @@ class AzureProvisionerTests(unittest.TestCase):
                         {
                             "ARM_CLIENT_ID": "client",
                             "ARM_TENANT_ID": "tenant",
+                            "PROV_RUN_ROOT": directory,
                         },
                         clear=True,
                     ),
-                    mock.patch.object(azure_provision.subprocess, "run") as run,
+                    mock.patch.object(azure_provision, "run_kubelogin") as run,
                 ):
+                    stack_outputs = azure_provision.write_stack_outputs(
+                        outputs
+                    )
                     azure_provision.write_stack_outputs(outputs)
 
-                run.assert_called_once_with(
+                run.assert_called_once()
+                args = run.call_args.args[0]
+                self.assertEqual(
+                    args[:2],
+                    ["convert-kubeconfig", "--kubeconfig"],
+                )
+                self.assertEqual(Path(args[2]).parent, output_directory)
+                self.assertEqual(
+                    args[3:],
                     [
-                        "kubelogin",
-                        "convert-kubeconfig",
-                        "--kubeconfig",
-                        str(kubeconfig_path),
                         "--login",
                         "spn",
                         "--client-id",
                         "client",
                         "--tenant-id",
                         "tenant",
+                        "--token-cache-dir",
+                        str(output_directory / "kubelogin"),
                     ],
-                    check=True,
                 )
 
+            self.assertEqual(
+                stack_outputs,
+                azure_provision.StackOutputs(
+                    aks_cluster_name="cluster",
+                    ingress_external_ip="192.0.2.1",
+                    kube_config_path=kubeconfig_path.resolve(),
+                ),
+            )
             self.assertEqual(kubeconfig_path.read_text(), "kubeconfig")
             self.assertEqual(
                 stat.S_IMODE(kubeconfig_path.stat().st_mode),
@@ -157,23 +226,1711 @@ class KubernetesProvisionerTests(unittest.TestCase):
             ),
         )
 
+    def test_rewrites_the_kubeconfig_only_when_it_changes(self):
+        kubernetes_shared = pipeline.import_kubernetes_shared()
+        with tempfile.TemporaryDirectory() as directory:
+            tools = ProvisionerTools(env=make_test_environment(Path(directory)))
+            kubeconfig_path = tools.env.PROV_RUN_DIR / "kubeconfig"
+
+            def get_vars(kubeconfig):
+                with mock.patch.dict(
+                    os.environ,
+                    {"KUBE_CONFIG": kubeconfig},
+                    clear=True,
+                ):
+                    return kubernetes_shared.get_vars(tools)
+
+            get_vars("first")
+            written = kubeconfig_path.stat().st_mtime_ns
+            os.utime(kubeconfig_path, ns=(written - 10**9, written - 10**9))
+            get_vars("first")
+            unchanged = kubeconfig_path.stat().st_mtime_ns
+            get_vars("second")
+
+            self.assertEqual(unchanged, written - 10**9)
+            self.assertEqual(kubeconfig_path.read_text(), "second")
+            self.assertEqual(
+                stat.S_IMODE(kubeconfig_path.stat().st_mode),
+                0o600,
+            )
+
+
+def read_output(chunks):
+    def run_command(env, command, additional_args, subprocess_args):
+        return mock.Mock(stdout=subprocess_args["read_stdout"](iter(chunks)))
+
+    return run_command
+
 
 class TerraformOutputTests(unittest.TestCase):
     @mock.patch("common.provisioner_utils.run_terraform_generic")
     def test_accepts_one_json_object_after_diagnostics(self, run_command):
-        run_command.return_value.stdout = 'diagnostic\n{"value": 1}\n'
+        run_command.side_effect = read_output(
+            ['diagnostic\n{"val', 'ue": 1}\n']
+        )
 
         self.assertEqual(
-            get_terraform_output(mock.sentinel.environment),
+            get_terraform_output(mock.Mock(PROV_PROJ_NAME="azure")),
             {"value": 1},
         )
+        self.assertEqual(run_command.call_args.args[1:], ("output", ["-json"]))
 
     @mock.patch("common.provisioner_utils.run_terraform_generic")
     def test_rejects_ambiguous_json_objects(self, run_command):
-        run_command.return_value.stdout = '{"first": 1}\n{"second": 2}'
+        run_command.side_effect = read_output(['{"first": 1}\n{"second": 2}'])
+
+        with self.assertRaisesRegex(RuntimeError, "exactly one JSON object"):
+            get_terraform_output(mock.Mock(PROV_PROJ_NAME="azure"))
+
+    @mock.patch("common.provisioner_utils.run_terraform_generic")
+    def test_stops_the_command_after_a_second_object(self, run_command):
+        run_command.side_effect = (
+            lambda env, command, additional_args, subprocess_args: (
+                process_utils.run_process(
+                    [
+                        "sh",
+                        "-c",
+                        "echo '{\"first\": 1}'; echo '{\"second\": 2}'; "
+                        "exec yes",
+                    ],
+                    check=True,
+                    timeout=10,
+                    **subprocess_args,
+                )
+            )
+        )
 
         with self.assertRaisesRegex(RuntimeError, "exactly one JSON object"):
-            get_terraform_output(mock.sentinel.environment)
+            get_terraform_output(mock.Mock(PROV_PROJ_NAME="azure"))
+
+        self.assertEqual(process_utils.RUNNING_PROCESSES, {})
+
+    @mock.patch("common.provisioner_utils.run_terraform_generic")
+    def test_raises_on_failed_command(self, run_command):
+        run_command.side_effect = subprocess.CalledProcessError(1, "output")
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            get_terraform_output(mock.Mock(PROV_PROJ_NAME="azure"))
+
+
+class JSONObjectTests(unittest.TestCase):
+    def test_finds_objects_split_across_chunks(self):
+        text = 'Warning: "{" {"a": "}\\"{"} noise {"b": {"c": [1]}}'
+
+        for size in (1, 2, 5, len(text)):
+            chunks = [text[i : i + size] for i in range(0, len(text), size)]
+            self.assertEqual(
+                list(iter_json_objects(chunks)),
+                [{"a": '}"{'}, {"b": {"c": [1]}}],
+            )
+
+    def test_stops_reading_after_a_complete_object(self):
+        chunks = iter(['{"a": 1}', "{"])
+
+        self.assertEqual(next(iter_json_objects(chunks)), {"a": 1})
+        self.assertEqual(list(chunks), ["{"])
+
+
+class OutputFormatTests(unittest.TestCase):
+    def test_streams_generators_as_ndjson(self):
+        def records(output):
+            yield {"tags": {"drift"}}
+            self.assertEqual(output.getvalue(), '{"tags":["drift"]}\n')
+            yield {"b": 2}
+
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            default_print_retval(records(stdout), TyperOutputFormat.ndjson)
+            default_print_retval({"c": 3, "d": 4}, TyperOutputFormat.ndjson)
+
+        self.assertEqual(
+            stdout.getvalue(),
+            '{"tags":["drift"]}\n{"b":2}\n{"c":3}\n{"d":4}\n',
+        )
+
+    def test_collects_generators_for_yaml(self):
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            default_print_retval(
+                ({"a": index} for index in range(2)),
+                TyperOutputFormat.yaml,
+            )
+
+        self.assertEqual(stdout.getvalue(), "- a: 0\n- a: 1\n\n")
+
+
+class ProcessEngineTests(unittest.TestCase):
+    def test_streams_output_and_captures_pipes(self):
+        output = []
+        result = process_utils.run_process(
+            ["sh", "-c", "echo first; echo second"],
+            check=True,
+            on_stdout_line=output.append,
+        )
+        captured = process_utils.run_process(
+            ["sh", "-c", "echo value"],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(output, ["first\n", "second\n"])
+        self.assertEqual(captured.stdout, "value\n")
+
+    def test_passes_output_chunks_to_a_reader(self):
+        result = process_utils.run_process(
+            ["sh", "-c", "printf '\\303'; printf '\\251 done'; false"],
+            read_stdout=lambda chunks: "".join(chunks),
+        )
+
+        self.assertEqual((result.returncode, result.stdout), (1, "\u00e9 done"))
+
+    @mock.patch.object(process_utils, "TERMINATE_GRACE_SECONDS", 1)
+    def test_stops_process_group_on_timeout(self):
+        with tempfile.TemporaryDirectory() as directory:
+            marker = Path(directory) / "finished"
+            with self.assertRaises(subprocess.TimeoutExpired):
+                process_utils.run_process(
+                    ["sh", "-c", f"sleep 1; touch {marker}"],
+                    timeout=0.2,
+                )
+
+            time.sleep(1.5)
+
+            self.assertEqual(process_utils.RUNNING_PROCESSES, {})
+            self.assertFalse(marker.exists())
+
+    def test_first_failure_cancels_sibling_tasks(self):
+        def fail():
+            raise RuntimeError("first failure")
+
+        def wait():
+            process_utils.run_process(["sleep", "30"], check=True)
+            process_utils.run_process(["true"])
+
+        with self.assertRaisesRegex(RuntimeError, "first failure"):
+            process_utils.run_tasks(wait, fail)
+
+        self.assertEqual(process_utils.RUNNING_PROCESSES, {})
+
+
+def make_event(event_type: str, seconds: int, message: str, **hook):
+    return json.dumps(
+        {
+            "@message": message,
+            "@timestamp": f"2024-05-01T12:00:{seconds:02}.000000Z",
+            "type": event_type,
+            "hook": hook,
+        }
+    )
+
+
+class EventStreamTests(unittest.TestCase):
+    def test_renders_progress_and_times_resources(self):
+        node_pool = {"resource": {"addr": "azurerm_node_pool.spot"}}
+        vault = {"resource": {"addr": "azurerm_key_vault.shared"}}
+        lines = [
+            "terragrunt log line",
+            make_event("refresh_start", 0, "refreshing", **vault),
+            make_event("refresh_complete", 2, "refreshed", **vault),
+            make_event("apply_start", 3, "Creating...", **node_pool),
+            make_event("apply_progress", 13, "Still creating...", **node_pool),
+            make_event("apply_complete", 33, "Creation complete", **node_pool),
+        ]
+        output = io.StringIO()
+        started = {}
+        timings = []
+
+        for line in lines:
+            event_utils.process_event_line(
+                line + "\n",
+                output,
+                started,
+                timings,
+            )
+
+        self.assertEqual(
+            output.getvalue().splitlines(),
+            ["terragrunt log line", "Creating...", "Creation complete"],
+        )
+        self.assertEqual(
+            [
+                (timing.address, timing.phase, timing.seconds)
+                for timing in timings
+            ],
+            [
+                ("azurerm_key_vault.shared", "refresh", 2),
+                ("azurerm_node_pool.spot", "apply", 30),
+            ],
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            report_path = Path(directory) / "report.json"
+            event_utils.write_timing_report(report_path, "azure", timings)
+            report = json.loads(report_path.read_text())
+
+        self.assertEqual(
+            report["resources"][0]["address"],
+            "azurerm_node_pool.spot",
+        )
+
+
+@mock.patch.object(trace_utils, "TRACE_FILES", new_callable=list)
+@mock.patch.object(trace_utils, "TRACE_SPANS", new_callable=list)
+class TraceTests(unittest.TestCase):
+    def test_records_exit_code_and_output_bytes(self, spans, trace_files):
+        with tempfile.TemporaryFile() as log:
+            with self.assertRaises(subprocess.CalledProcessError):
+                with trace_utils.trace_span("apply", project="system"):
+                    process_utils.run_process(
+                        ["sh", "-c", "printf abc; exit 3"],
+                        check=True,
+                        stdout=log,
+                    )
+
+        self.assertEqual(spans[0]["name"], "apply")
+        self.assertEqual(
+            spans[0]["attributes"],
+            {
+                "project": "system",
+                "exit_code": 3,
+                "output_bytes": 3,
+                "error": "CalledProcessError",
+            },
+        )
+
+    def test_writes_chrome_trace_and_json_lines(self, spans, trace_files):
+        with tempfile.TemporaryDirectory() as directory:
+            trace_file = Path(directory) / "trace.json"
+            trace_utils.start_tracing(trace_file)
+            with trace_utils.trace_span("plan", stack="azure"):
+                pass
+            trace_utils.write_trace_files()
+
+            chrome_trace = json.loads(trace_file.read_text())
+            lines = (Path(directory) / "trace.jsonl").read_text().splitlines()
+
+        event = chrome_trace["traceEvents"][-1]
+        self.assertEqual(
+            (event["name"], event["ph"], event["args"]),
+            ("plan", "X", {"stack": "azure"}),
+        )
+        self.assertEqual([json.loads(line)["name"] for line in lines], ["plan"])
+
+    def test_writes_chrome_trace_to_the_given_file(self, spans, trace_files):
+        with tempfile.TemporaryDirectory() as directory:
+            trace_file = Path(directory) / "run.trace"
+            trace_utils.start_tracing(trace_file)
+            trace_utils.write_trace_files()
+
+            chrome_trace = json.loads(trace_file.read_text())
+            names = sorted(path.name for path in Path(directory).iterdir())
+
+        self.assertIn("traceEvents", chrome_trace)
+        self.assertEqual(names, ["run.trace", "run.trace.jsonl"])
+
+
+class ProjectGraphTests(unittest.TestCase):
+    def test_caches_projects_until_directories_change(self):
+        with tempfile.TemporaryDirectory() as directory:
+            code_dir = Path(directory) / "code"
+            registry_path = Path(directory) / "projects.json"
+            (code_dir / "network").mkdir(parents=True)
+            (code_dir / "network" / "terragrunt.hcl").write_text("")
+            (code_dir / "cluster").mkdir()
+
+            with mock.patch.object(
+                scheduler_utils,
+                "discover_projects",
+                wraps=discover_projects,
+            ) as discover:
+                self.assertEqual(
+                    load_projects(code_dir, registry_path),
+                    ["network"],
+                )
+                self.assertEqual(
+                    load_projects(code_dir, registry_path),
+                    ["network"],
+                )
+                self.assertEqual(discover.call_count, 1)
+
+                (code_dir / "cluster" / "terragrunt.hcl").write_text("")
+                self.assertEqual(
+                    load_projects(code_dir, registry_path),
+                    ["cluster", "network"],
+                )
+                self.assertEqual(discover.call_count, 2)
+
+    def test_reads_dependency_blocks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            code_dir = Path(directory)
+            for project, config in {
+                "network": "",
+                "cluster": 'dependency "network" {\n'
+                '  config_path = "../network"\n'
+                "}\n",
+                "apps": "# dependency \"ignored\" { config_path = \"../x\" }\n"
+                "dependencies {\n"
+                '  paths = ["../network", "../cluster"]\n'
+                "}\n",
+                "_common": "",
+            }.items():
+                (code_dir / project).mkdir()
+                (code_dir / project / "terragrunt.hcl").write_text(config)
+
+            projects = discover_projects(code_dir)
+            self.assertEqual(projects, ["apps", "cluster", "network"])
+            self.assertEqual(
+                get_project_graph(code_dir, projects),
+                {
+                    "apps": {"cluster", "network"},
+                    "cluster": {"network"},
+                    "network": set(),
+                },
+            )
+
+    def test_shared_projects_are_independent(self):
+        projects = discover_projects(KUBERNETES_SHARED_DIR)
+
+        self.assertEqual(
+            get_project_graph(KUBERNETES_SHARED_DIR, projects),
+            {"kube-state-metrics": set(), "system": set()},
+        )
+
+    def test_rejects_dependency_cycles(self):
+        with self.assertRaisesRegex(RuntimeError, "cycle"):
+            run_project_graph({"a": {"b"}, "b": {"a"}}, lambda project: None)
+
+    def test_runs_independent_projects_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def run_project(project):
+            barrier.wait()
+
+        runs = run_project_graph(
+            {"system": set(), "kube-state-metrics": set()},
+            run_project,
+            parallelism=2,
+        )
+
+        self.assertEqual(
+            {run.project: run.status for run in runs},
+            {"system": "succeeded", "kube-state-metrics": "succeeded"},
+        )
+
+    def test_skips_dependents_of_failed_projects(self):
+        started = []
+
+        def run_project(project):
+            started.append(project)
+            if project == "network":
+                raise RuntimeError("failed")
+
+        runs = run_project_graph(
+            {"network": set(), "cluster": {"network"}, "other": set()},
+            run_project,
+        )
+
+        self.assertEqual(sorted(started), ["network", "other"])
+        self.assertEqual(
+            {run.project: run.status for run in runs},
+            {"network": "failed", "cluster": "skipped", "other": "succeeded"},
+        )
+
+
+LOCK_ERROR = """\
+Error: Error acquiring the state lock
+
+Lock Info:
+  ID:        7f2c1e9a
+  Path:      unicornsftw/unicorns-kubernetes-shared-system
+  Operation: OperationTypeApply
+  Who:       runner@ci-1
+  Created:   2024-05-01 12:00:00 +0000 UTC
+"""
+
+
+def make_locked_error(project: str):
+    return lock_utils.StateLockedError(
+        project,
+        lock_utils.LockInfo(None, "runner@ci-1", None, None),
+    )
+
+
+@mock.patch("common.scheduler_utils.record_lock_wait", mock.Mock())
+@mock.patch("common.lock_utils.LOCK_BACKOFF_SECONDS", 0.05)
+class StateLockTests(unittest.TestCase):
+    def test_reads_the_lock_holder_from_the_log(self):
+        def run(options):
+            options["stdout"].write(LOCK_ERROR)
+            options["stdout"].flush()
+            raise subprocess.CalledProcessError(1, "apply")
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(Path(directory) / "system.log", "w") as log:
+                log.write("Error acquiring the state lock\n  Who: earlier\n")
+                with self.assertRaises(lock_utils.StateLockedError) as context:
+                    lock_utils.run_detecting_lock(
+                        "kubernetes-shared/system",
+                        run,
+                        {"stdout": log, "stderr": subprocess.STDOUT},
+                    )
+
+        lock_info = context.exception.lock_info
+        self.assertEqual(lock_info.id, "7f2c1e9a")
+        self.assertEqual(lock_info.who, "runner@ci-1")
+        self.assertEqual(lock_info.operation, "OperationTypeApply")
+        self.assertIn("locked by runner@ci-1", str(context.exception))
+
+    def test_other_failures_are_passed_on(self):
+        def run(options):
+            options["on_stderr_line"]("Error: Unsupported argument\n")
+            raise subprocess.CalledProcessError(1, "plan")
+
+        with mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            with self.assertRaises(subprocess.CalledProcessError):
+                lock_utils.run_detecting_lock("azure", run)
+
+        self.assertEqual(stderr.getvalue(), "Error: Unsupported argument\n")
+
+    def test_runs_other_projects_while_one_is_locked(self):
+        started = []
+
+        def run_project(project):
+            started.append(project)
+            if started == ["network"]:
+                raise make_locked_error(project)
+
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            runs = run_project_graph(
+                {"network": set(), "apps": {"network"}, "other": set()},
+                run_project,
+            )
+
+        runs = {run.project: run for run in runs}
+        self.assertEqual(started, ["network", "other", "network", "apps"])
+        self.assertEqual(runs["network"].status, "succeeded")
+        self.assertGreater(runs["network"].lock_wait, 0)
+        self.assertEqual(runs["apps"].lock_wait, 0)
+        self.assertIn("locked by runner@ci-1", stdout.getvalue())
+
+    @mock.patch.dict(os.environ, {"PROV_LOCK_WAIT_LIMIT": "0"})
+    def test_fails_fast_over_the_wait_limit(self):
+        def run_project(project):
+            raise make_locked_error(project)
+
+        runs = run_project_graph(
+            {"network": set(), "apps": {"network"}},
+            run_project,
+        )
+
+        runs = {run.project: run for run in runs}
+        self.assertEqual(runs["network"].status, "failed")
+        self.assertIn("Gave up", str(runs["network"].error))
+        self.assertEqual(runs["apps"].status, "skipped")
+
+
+def make_test_environment(directory: Path):
+    env = ProvisionerEnvironment(
+        PROV_PROJ_NAME="stack",
+        PROV_BASE_DIR=directory,
+        PROV_CODE_DIR=directory / "code",
+        PROV_RUN_DIR=directory / "run",
+        PROV_CACHE_DIR=directory / "cache",
+    )
+    for path in (env.PROV_CODE_DIR, env.PROV_RUN_DIR, env.PROV_CACHE_DIR):
+        path.mkdir()
+
+    return env
+
+
+@mock.patch(
+    "common.provisioner_utils.get_tool_version",
+    mock.Mock(return_value="Terraform v1.8.2"),
+)
+@mock.patch.dict(os.environ, {"NO_CONFIRM": "1"})
+class RunManifestTests(unittest.TestCase):
+    @mock.patch("common.provisioner_utils.run_terraform_apply")
+    @mock.patch("common.provisioner_utils.run_terraform_init")
+    def test_skips_unchanged_terraform_apply(self, run_init, run_apply):
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            tools = ProvisionerTools(env=env)
+            (env.PROV_CODE_DIR / "main.tf").write_text("# first")
+
+            self.assertTrue(run_terraform(tools, {"name": "value"}))
+            self.assertFalse(run_terraform(tools, {"name": "value"}))
+            self.assertTrue(run_terraform(tools, {"name": "value"}, force=True))
+            self.assertTrue(run_terraform(tools, {"name": "other"}))
+
+            (env.PROV_CODE_DIR / "main.tf").write_text("# second")
+            self.assertTrue(run_terraform(tools, {"name": "other"}))
+
+            self.assertEqual(run_init.call_count, 5)
+            self.assertEqual(run_apply.call_count, 4)
+
+    @mock.patch("common.provisioner_utils.run_terraform_apply")
+    @mock.patch("common.provisioner_utils.run_terraform_init")
+    def test_runs_after_a_failed_apply(self, run_init, run_apply):
+        with tempfile.TemporaryDirectory() as directory:
+            tools = ProvisionerTools(env=make_test_environment(Path(directory)))
+
+            run_terraform(tools, {"name": "a"})
+            run_apply.side_effect = subprocess.CalledProcessError(1, "apply")
+            with self.assertRaises(subprocess.CalledProcessError):
+                run_terraform(tools, {"name": "b"})
+            run_apply.side_effect = None
+
+            self.assertTrue(run_terraform(tools, {"name": "a"}))
+            self.assertEqual(run_apply.call_count, 3)
+
+    @mock.patch("common.provisioner_utils.run_terragrunt")
+    def test_hashes_files_referenced_by_variables(self, run_command):
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            tools = ProvisionerTools(env=env)
+            (env.PROV_CODE_DIR / "system").mkdir()
+            kubeconfig = Path(directory) / "kubeconfig"
+            kubeconfig.write_text("first")
+            (env.PROV_RUN_DIR / "terraform.tfvars.json").write_text(
+                f'{{"kube_config_path": "{kubeconfig}"}}'
+            )
+
+            statuses = [run_terragrunt_project(tools, "system")]
+            statuses.append(run_terragrunt_project(tools, "system"))
+            kubeconfig.write_text("second")
+            statuses.append(run_terragrunt_project(tools, "system"))
+
+            self.assertEqual(statuses, ["succeeded", "unchanged", "succeeded"])
+            self.assertEqual(run_command.call_count, 2)
+
+    @mock.patch("common.provisioner_utils.run_terraform_plan")
+    @mock.patch("common.provisioner_utils.run_terraform_apply")
+    @mock.patch("common.provisioner_utils.run_terraform_init")
+    def test_dry_run_does_not_record_apply(self, run_init, run_apply, run_plan):
+        with tempfile.TemporaryDirectory() as directory:
+            tools = ProvisionerTools(env=make_test_environment(Path(directory)))
+
+            with mock.patch.dict(os.environ, {"DRY_RUN": "1"}):
+                run_terraform(tools, {})
+                run_terraform(tools, {})
+
+            self.assertEqual(run_plan.call_count, 2)
+            run_apply.assert_not_called()
+
+
+def make_plan(*changes: str):
+    return {
+        "resource_changes": [
+            {
+                "address": "helm_release.release",
+                "change": {"actions": ["no-op"]},
+            },
+            *(
+                {"address": address, "change": {"actions": ["update"]}}
+                for address in changes
+            ),
+        ],
+        "prior_state": {
+            "values": {
+                "outputs": {
+                    "aks_kube_config": {"sensitive": True, "value": "config"},
+                },
+            },
+        },
+    }
+
+
+# Writes the plan file on plan, and prints `plan` on show.
+def fake_plan_command(plan_path: Path, plan: dict):
+    def run_command(*args, **kwargs):
+        if "plan" in args:
+            plan_path.parent.mkdir(parents=True, exist_ok=True)
+            plan_path.write_text("plan")
+        if "show" in args:
+            return mock.Mock(stdout=json.dumps(plan))
+
+    return run_command
+
+
+@mock.patch(
+    "common.provisioner_utils.get_tool_version",
+    mock.Mock(return_value="Terraform v1.8.2"),
+)
+@mock.patch.dict(os.environ, {"NO_CONFIRM": "1", "SAVED_PLAN": "1"})
+class SavedPlanTests(unittest.TestCase):
+    @mock.patch("common.provisioner_utils.run_terraform_init")
+    @mock.patch("common.provisioner_utils.run_terraform_generic")
+    def test_applies_the_saved_terraform_plan(self, run_command, run_init):
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            plan_path = env.PROV_RUN_DIR / "terraform.tfplan"
+            run_command.side_effect = fake_plan_command(
+                plan_path,
+                make_plan("azurerm_resource_group.main"),
+            )
+
+            self.assertTrue(run_terraform(ProvisionerTools(env=env), {}))
+
+            self.assertEqual(
+                [
+                    call.args[1:]
+                    for call in run_command.call_args_list
+                    if call.args[1] != "show"
+                ],
+                [
+                    (
+                        "plan",
+                        [
+                            f"-var-file={env.PROV_RUN_DIR}/"
+                            "terraform.tfvars.json",
+                            "-lock-timeout=10s",
+                            f"-out={plan_path}",
+                            "-parallelism=10",
+                        ],
+                    ),
+                    (
+                        "apply",
+                        [
+                            "-lock-timeout=10s",
+                            "-parallelism=10",
+                            str(plan_path),
+                        ],
+                    ),
+                ],
+            )
+
+    @mock.patch("common.provisioner_utils.run_terragrunt_generic_with_project")
+    def test_does_not_apply_without_a_plan_file(self, run_command):
+        with tempfile.TemporaryDirectory() as directory:
+            tools = ProvisionerTools(env=make_test_environment(Path(directory)))
+
+            with self.assertRaisesRegex(RuntimeError, "did not write the plan"):
+                run_terragrunt(tools, "system")
+
+            self.assertEqual(
+                [call.args[2] for call in run_command.call_args_list],
+                ["init", "plan"],
+            )
+
+    @mock.patch("builtins.input", mock.Mock(return_value="no"))
+    @mock.patch("common.provisioner_utils.run_terragrunt_generic_with_project")
+    def test_asks_before_applying_interactively(self, run_command):
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            plan_path = env.PROV_RUN_DIR / "system" / "terraform.tfplan"
+            run_command.side_effect = fake_plan_command(
+                plan_path,
+                make_plan("helm_release.release"),
+            )
+
+            with mock.patch.dict(os.environ, {"NO_CONFIRM": ""}):
+                with self.assertRaisesRegex(RuntimeError, "cancelled"):
+                    run_terragrunt(ProvisionerTools(env=env), "system")
+
+            self.assertNotIn(
+                "apply",
+                [call.args[2] for call in run_command.call_args_list],
+            )
+
+
+    @mock.patch("common.provisioner_utils.run_terraform_init")
+    @mock.patch("common.provisioner_utils.run_terraform_generic")
+    def test_skips_the_apply_of_a_plan_without_changes(
+        self,
+        run_command,
+        run_init,
+    ):
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            tools = ProvisionerTools(env=env)
+            run_command.side_effect = fake_plan_command(
+                env.PROV_RUN_DIR / "terraform.tfplan",
+                make_plan(),
+            )
+
+            self.assertFalse(run_terraform(tools, {}))
+            outputs = read_unchanged_outputs(env)
+            self.assertFalse(run_terraform(tools, {}))
+
+        self.assertEqual(
+            [call.args[1] for call in run_command.call_args_list],
+            ["plan", "show"],
+        )
+        self.assertEqual(
+            outputs,
+            {"aks_kube_config": {"sensitive": True, "value": "config"}},
+        )
+
+    @mock.patch("common.provisioner_utils.run_terragrunt_generic_with_project")
+    def test_unchanged_project_plan_does_not_force_dependents(
+        self,
+        run_command,
+    ):
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            (env.PROV_CODE_DIR / "system").mkdir()
+            run_command.side_effect = fake_plan_command(
+                env.PROV_RUN_DIR / "system" / "terraform.tfplan",
+                make_plan(),
+            )
+
+            status = run_terragrunt_project(ProvisionerTools(env=env), "system")
+
+        self.assertEqual(status, "unchanged")
+        self.assertEqual(
+            [call.args[2] for call in run_command.call_args_list],
+            ["init", "plan", "show"],
+        )
+
+    @mock.patch("common.provisioner_utils.run_terragrunt_generic_with_project")
+    def test_buffered_project_reports_to_its_log(self, run_command):
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            (env.PROV_CODE_DIR / "system").mkdir()
+            run_command.side_effect = fake_plan_command(
+                env.PROV_RUN_DIR / "system" / "terraform.tfplan",
+                make_plan(),
+            )
+
+            with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                run_terragrunt_project(
+                    ProvisionerTools(env=env),
+                    "system",
+                    buffered=True,
+                )
+            log = (env.PROV_RUN_DIR / "system" / "terragrunt.log").read_text()
+
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertTrue(
+            log.startswith("Running stack/system with -parallelism=10")
+        )
+        self.assertIn(
+            "Skipping the apply of stack/system: the plan has no changes.",
+            log,
+        )
+
+    def test_finds_changes_until_the_first_changed_workspace(self):
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            record_manifest_entry(get_manifest_path(env), "stack/a", "digest")
+            plans = {"stack/b": make_plan(), "stack/c": make_plan("x.y")}
+            get_plan = mock.Mock(side_effect=lambda name: plans[name])
+
+            result = find_changes(
+                env,
+                {
+                    name: ("digest", lambda name=name: get_plan(name))
+                    for name in ["stack/a", "stack/b", "stack/c", "stack/d"]
+                },
+            )
+
+        self.assertEqual(
+            result,
+            {
+                "changed": True,
+                "workspaces": {
+                    "stack/a": {},
+                    "stack/b": {},
+                    "stack/c": {"x.y": "update"},
+                },
+            },
+        )
+        self.assertEqual(get_plan.call_count, 2)
+
+    def test_indexes_the_changes_of_a_plan(self):
+        plan = make_plan("azurerm_dns_zone.zone")
+        plan["resource_changes"].append(
+            {
+                "address": "azurerm_kubernetes_cluster.aks",
+                "change": {"actions": ["delete", "create"]},
+            }
+        )
+        plan["output_changes"] = {
+            "ingress_static_ip": {"actions": ["no-op"]},
+            "aks_cluster_name": {"actions": ["create"]},
+        }
+
+        self.assertEqual(
+            plan_utils.get_plan_changes(plan),
+            {
+                "azurerm_dns_zone.zone": "update",
+                "azurerm_kubernetes_cluster.aks": "replace",
+                "output.aks_cluster_name": "create",
+            },
+        )
+        self.assertEqual(plan_utils.get_plan_changes(make_plan()), {})
+
+
+class PipelineTests(unittest.TestCase):
+    def test_kubernetes_vars_come_from_azure_outputs(self):
+        kubernetes_shared = pipeline.import_kubernetes_shared()
+        with tempfile.TemporaryDirectory() as directory:
+            kubeconfig_path = Path(directory) / "kubeconfig"
+            kubeconfig_path.write_text("kubeconfig")
+            azure_outputs = azure_provision.StackOutputs(
+                aks_cluster_name="cluster",
+                ingress_external_ip="192.0.2.1",
+                kube_config_path=kubeconfig_path,
+            )
+
+            with mock.patch.dict(os.environ, {}, clear=True):
+                variables = kubernetes_shared.get_vars(
+                    mock.sentinel.tools,
+                    azure_outputs,
+                )
+
+        self.assertEqual(
+            variables,
+            {
+                "kube_config_path": str(kubeconfig_path.resolve()),
+                "ingress_external_ip": "192.0.2.1",
+            },
+        )
+
+    @mock.patch("common.provisioner_utils.run_terragrunt_generic")
+    def test_terragrunt_gets_the_variables_of_its_stack(self, run_command):
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            with mock.patch.dict(
+                os.environ,
+                {"PROV_RUN_DIR": "/run/azure", "TF_DATA_DIR": "/run/azure/.tf"},
+            ):
+                run_terragrunt_generic_with_project(env, "system", "plan")
+
+        command_env = run_command.call_args.args[1]["env"]
+        self.assertEqual(command_env["PROV_RUN_DIR"], str(env.PROV_RUN_DIR))
+        self.assertNotIn("TF_DATA_DIR", command_env)
+
+    @mock.patch("common.provisioner_utils.run_terragrunt_generic_with_project")
+    def test_early_init_failures_are_reported(self, run_command):
+        run_command.side_effect = subprocess.CalledProcessError(1, "init")
+        with tempfile.TemporaryDirectory() as directory:
+            tools = ProvisionerTools(env=make_test_environment(Path(directory)))
+            with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                init_terragrunt_projects(tools, ["system", "kube-state-metrics"])
+
+        self.assertEqual(run_command.call_count, 2)
+        self.assertIn("Early init of system failed", stdout.getvalue())
+
+
+def make_drift_event(address: str, action: str):
+    return json.dumps(
+        {
+            "@message": f"{address}: Drift detected ({action})",
+            "type": "resource_drift",
+            "change": {"resource": {"addr": address}, "action": action},
+        }
+    )
+
+
+class DriftTests(unittest.TestCase):
+    @mock.patch("common.provisioner_utils.run_terraform_generic")
+    def test_reports_drifted_resources(self, run_command):
+        def run_plan(env, command, args, subprocess_args):
+            on_stdout_line = subprocess_args["on_stdout_line"]
+            on_stdout_line(
+                make_drift_event("azurerm_key_vault.shared", "update")
+            )
+            on_stdout_line("not an event\n")
+            raise subprocess.CalledProcessError(2, command)
+
+        run_command.side_effect = run_plan
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            status, resources = check_terraform_drift(env)
+            log = (env.PROV_RUN_DIR / "drift" / "stack.log").read_text()
+
+        self.assertEqual(status, "drifted")
+        self.assertEqual(
+            resources,
+            [{"address": "azurerm_key_vault.shared", "action": "update"}],
+        )
+        self.assertIn("Drift detected (update)", log)
+        self.assertIn("-detailed-exitcode", run_command.call_args.args[2])
+
+    @mock.patch("common.provisioner_utils.run_terraform_generic")
+    def test_plan_errors_are_not_drift(self, run_command):
+        run_command.side_effect = subprocess.CalledProcessError(1, "plan")
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+            with self.assertRaisesRegex(RuntimeError, "exited with 1"):
+                check_terraform_drift(env)
+
+    def test_a_failed_check_does_not_stop_the_others(self):
+        def fail():
+            raise RuntimeError("plan failed")
+
+        with mock.patch("sys.stdout", new_callable=io.StringIO):
+            results = run_drift_checks(
+                {
+                    "azure": lambda: ("clean", []),
+                    "kubernetes-shared/system": fail,
+                },
+                parallelism=2,
+            )
+
+        system = results["kubernetes-shared/system"]
+        self.assertEqual(results["azure"]["status"], "clean")
+        self.assertEqual(system["status"], "failed")
+        self.assertEqual(system["error"], "plan failed")
+
+
+def write_hook(stack_dir: Path, project: str, content: str):
+    (stack_dir / project).mkdir(parents=True, exist_ok=True)
+    (stack_dir / project / "preprovision.py").write_text(content)
+
+
+class PreprovisionHookTests(unittest.TestCase):
+    def test_runs_hooks_concurrently(self):
+        with tempfile.TemporaryDirectory() as directory:
+            script_path = Path(directory) / "stack" / "provision.py"
+            for project in ("system", "monitoring"):
+                write_hook(
+                    script_path.parent,
+                    project,
+                    "def get_vars(tools, project):\n"
+                    "    tools.barrier.wait()\n"
+                    "    return {'project': project}\n",
+                )
+            tools = mock.Mock(
+                env=make_test_environment(Path(directory)),
+                barrier=threading.Barrier(2, timeout=5),
+            )
+
+            with mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+                results = preprovision_utils.run_preprovision_hooks(
+                    script_path,
+                    tools,
+                    ["system", "monitoring", "apps"],
+                )
+
+        self.assertEqual(
+            [result.variables for result in results],
+            [{"project": "system"}, {"project": "monitoring"}, None],
+        )
+        self.assertIn("Preprovision hooks: system", stderr.getvalue())
+
+    def test_memoizes_hooks_with_a_cache_key(self):
+        with tempfile.TemporaryDirectory() as directory:
+            script_path = Path(directory) / "stack" / "provision.py"
+            write_hook(
+                script_path.parent,
+                "system",
+                "def get_cache_key(tools, project):\n"
+                "    return tools.key\n"
+                "\n"
+                "def get_vars(tools, project):\n"
+                "    tools.calls.append(project)\n"
+                "    return {'key': tools.key}\n",
+            )
+            tools = mock.Mock(
+                env=make_test_environment(Path(directory)),
+                calls=[],
+                key="first",
+            )
+
+            def run_hook():
+                return preprovision_utils.run_preprovision_hook(
+                    script_path,
+                    tools,
+                    "system",
+                )
+
+            first = run_hook()
+            second = run_hook()
+            tools.key = "second"
+            third = run_hook()
+
+        self.assertEqual(tools.calls, ["system", "system"])
+        self.assertEqual([first.cached, second.cached], [False, True])
+        self.assertEqual(second.variables, {"key": "first"})
+        self.assertEqual(third.variables, {"key": "second"})
+
+
+class ParallelismTests(unittest.TestCase):
+    def test_chooses_parallelism_from_the_last_run(self):
+        entry = {"parallelism": 20, "throttled": 0, "resources": 200}
+
+        self.assertEqual(parallelism_utils.choose_parallelism(None)[0], 10)
+        self.assertEqual(parallelism_utils.choose_parallelism(entry)[0], 32)
+        self.assertEqual(
+            parallelism_utils.choose_parallelism({**entry, "throttled": 3})[0],
+            10,
+        )
+        self.assertEqual(
+            parallelism_utils.choose_parallelism({**entry, "ceiling": 20})[0],
+            19,
+        )
+
+    def test_halves_parallelism_after_throttling(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_dir = Path(directory)
+            log_path = cache_dir / "apply.log"
+
+            def apply(parallelism_args):
+                with open(log_path, "a") as log:
+                    with parallelism_utils.watch_throttling(
+                        "apply",
+                        {"stdout": log, "stderr": subprocess.STDOUT},
+                    ):
+                        log.write("Error: StatusCode=429 Too Many Requests\n")
+                parallelism_args.append(run["args"])
+
+            args = []
+            for _ in range(2):
+                with parallelism_utils.tuned_parallelism(
+                    cache_dir,
+                    "stack/system",
+                ) as run:
+                    apply(args)
+
+            report = parallelism_utils.get_parallelism_report(
+                cache_dir,
+                "stack",
+            )
+
+        self.assertEqual(args, [["-parallelism=10"], ["-parallelism=5"]])
+        self.assertEqual(report["stack/system"]["last"]["throttled"], 1)
+        self.assertEqual(report["stack/system"]["last"]["ceiling"], 5)
+        self.assertEqual(report["stack/system"]["next"]["parallelism"], 2)
+
+    @mock.patch.dict(os.environ, {"PROV_PARALLELISM_BUDGET": "12"})
+    def test_shares_the_parallelism_budget(self):
+        with parallelism_utils.reserve_parallelism(10) as first:
+            with parallelism_utils.reserve_parallelism(10) as second:
+                self.assertEqual([first, second], [10, 2])
+
+        with parallelism_utils.reserve_parallelism(10) as third:
+            self.assertEqual(third, 10)
+
+
+TARGET_GRAPH = """digraph {
+  "[root] azurerm_resource_group.main (expand)" [label = "main"]
+  "[root] module.aks.azurerm_kubernetes_cluster.aks (expand)" [label = "aks"]
+  "[root] helm_release.release (expand)" [label = "release"]
+  "[root] azurerm_dns_zone.zone (expand)" [label = "zone"]
+  "[root] provider[\\"registry.terraform.io/hashicorp/helm\\"]" [label = "helm"]
+  "[root] helm_release.release (expand)" -> "[root] provider[\\"registry.terraform.io/hashicorp/helm\\"]"
+  "[root] provider[\\"registry.terraform.io/hashicorp/helm\\"]" -> "[root] module.aks.output.kube_config (expand)"
+  "[root] module.aks.output.kube_config (expand)" -> "[root] module.aks.azurerm_kubernetes_cluster.aks (expand)"
+  "[root] module.aks.azurerm_kubernetes_cluster.aks (expand)" -> "[root] azurerm_resource_group.main (expand)"
+  "[root] azurerm_dns_zone.zone (expand)" -> "[root] azurerm_resource_group.main (expand)"
+}
+"""
+
+
+@mock.patch(
+    "common.provisioner_utils.get_tool_version",
+    mock.Mock(return_value="Terraform v1.8.2"),
+)
+@mock.patch.dict(os.environ, {"NO_CONFIRM": "1"})
+class TargetTests(unittest.TestCase):
+    def test_expands_targets_to_their_dependencies(self):
+        graph = target_utils.parse_graph(TARGET_GRAPH)
+        state = ['helm_release.release["ingress"]', "azurerm_dns_zone.zone"]
+
+        self.assertEqual(
+            target_utils.expand_targets(
+                ['helm_release.*["ingress"]'],
+                graph,
+                state,
+            ),
+            [
+                "azurerm_resource_group.main",
+                'helm_release.release["ingress"]',
+                "module.aks.azurerm_kubernetes_cluster.aks",
+            ],
+        )
+        self.assertEqual(
+            target_utils.expand_targets(["module.aks"], graph, state),
+            [
+                "azurerm_resource_group.main",
+                "module.aks.azurerm_kubernetes_cluster.aks",
+            ],
+        )
+        with self.assertRaisesRegex(RuntimeError, "No resource matches"):
+            target_utils.expand_targets(["helm_release.other"], graph, state)
+
+    @mock.patch("common.provisioner_utils.run_terraform_init")
+    @mock.patch("common.provisioner_utils.run_terraform_generic")
+    def test_applies_only_the_targets(self, run_command, run_init):
+        outputs = {
+            "graph": TARGET_GRAPH,
+            "state": "azurerm_dns_zone.zone\n",
+        }
+        run_command.side_effect = lambda env, command, *_, **__: mock.Mock(
+            stdout=outputs.get(command, "")
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            env = make_test_environment(Path(directory))
+
+            run_terraform(
+                ProvisionerTools(env=env),
+                {},
+                targets=["azurerm_dns_zone.*"],
+            )
+            manifest_exists = (env.PROV_CACHE_DIR / "manifest.json").exists()
+
+        self.assertEqual(
+            [call.args[1] for call in run_command.call_args_list],
+            ["graph", "state", "apply"],
+        )
+        self.assertEqual(
+            run_command.call_args.args[2][-3:],
+            [
+                "-target=azurerm_dns_zone.zone",
+                "-target=azurerm_resource_group.main",
+                "-auto-approve",
+            ],
+        )
+        self.assertFalse(manifest_exists)
+
+    @mock.patch("common.provisioner_utils.run_terraform_init")
+    @mock.patch("common.provisioner_utils.run_terraform_generic")
+    def test_full_run_after_a_targeted_apply(self, run_command, run_init):
+        outputs = {"graph": TARGET_GRAPH, "state": ""}
+        run_command.side_effect = lambda env, command, *_, **__: mock.Mock(
+            stdout=outputs.get(command, "")
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            tools = ProvisionerTools(env=make_test_environment(Path(directory)))
+
+            run_terraform(tools, {})
+            run_terraform(tools, {}, targets=["azurerm_dns_zone.zone"])
+
+            self.assertTrue(run_terraform(tools, {}))
+
+
+def make_span(name: str, duration: float, **attributes):
+    return {
+        "name": name,
+        "start": time.time(),
+        "duration": duration,
+        "attributes": {"stack": "stack", **attributes},
+    }
+
+
+class RunHistoryTests(unittest.TestCase):
+    def test_reports_phase_stats_and_regressions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            history_path = history_utils.get_history_path(Path(directory))
+            for commit, apply_duration in (("a" * 40, 10.0), ("b" * 40, 20.0)):
+                spans = [
+                    make_span("manifest", 0.1, project="system", cached=True),
+                    make_span("plan", 2.0, project="system", exit_code=0),
+                    make_span("apply", apply_duration, project="system"),
+                    make_span("apply", 1.0, project="apps", error="Error"),
+                    {**make_span("output", 1.0), "attributes": {}},
+                ]
+                history_utils.write_phase_rows(
+                    history_path,
+                    history_utils.get_phase_rows(
+                        spans,
+                        commit,
+                        {"terraform": "Terraform v1.8.2"},
+                        commit,
+                    ),
+                )
+
+            stats = history_utils.get_stats(history_path, "stack", 30, 1)
+            history = list(
+                history_utils.get_history(history_path, None, 30, 2)
+            )
+
+        self.assertEqual(
+            stats["phases"]["apply"],
+            {
+                "runs": 4,
+                "p50": 1.0,
+                "p95": 20.0,
+                "cache_hits": 0,
+                "failures": 2,
+            },
+        )
+        self.assertEqual(stats["phases"]["manifest"]["cache_hits"], 2)
+        self.assertNotIn("output", stats["phases"])
+        self.assertEqual(
+            stats["slowest_projects"],
+            [
+                {
+                    "workspace": "stack/system",
+                    "runs": 2,
+                    "p50": 10.0,
+                    "p95": 20.0,
+                }
+            ],
+        )
+        self.assertEqual(
+            stats["regressions"],
+            [
+                {
+                    "workspace": "stack/system",
+                    "phase": "apply",
+                    "from": "a" * 12,
+                    "to": "b" * 12,
+                    "before": 10.0,
+                    "after": 20.0,
+                }
+            ],
+        )
+        self.assertEqual(
+            [(row["workspace"], row["phase"]) for row in history],
+            [("stack/apps", "apply"), ("stack/system", "apply")],
+        )
+
+
+class DaemonTests(unittest.TestCase):
+    def run_command(self, socket_path: Path, args: list):
+        read_fd, write_fd = os.pipe()
+        null_fd = os.open(os.devnull, os.O_RDWR)
+        try:
+            exit_code = daemon_client.run_in_daemon(
+                socket_path,
+                "stack/provision.py",
+                args,
+                fds=(null_fd, write_fd, null_fd),
+            )
+        finally:
+            os.close(write_fd)
+            os.close(null_fd)
+
+        with open(read_fd) as output:
+            return exit_code, output.read()
+
+    def test_runs_commands_with_the_request_environment(self):
+        app = get_app()
+
+        @app.command()
+        def show(name: str):
+            return os.environ.get(name)
+
+        @app.command()
+        def fail():
+            raise RuntimeError("failed")
+
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = Path(directory) / "provisioner.sock"
+            daemon = multiprocessing.get_context("fork").Process(
+                target=daemon_utils.run_daemon,
+                args=(socket_path,),
+                kwargs={"apps": {"stack/provision.py": app}},
+            )
+            with mock.patch("sys.stdout", new_callable=io.StringIO):
+                daemon.start()
+            try:
+                for _ in range(100):
+                    if socket_path.exists():
+                        break
+                    time.sleep(0.05)
+
+                with mock.patch.dict(
+                    os.environ,
+                    {"DRY_RUN": "1", "UNFORWARDED": "1"},
+                ):
+                    dry_run = self.run_command(socket_path, ["show", "DRY_RUN"])
+                    unforwarded = self.run_command(
+                        socket_path,
+                        ["show", "UNFORWARDED"],
+                    )
+                with mock.patch.dict(os.environ, {"DRY_RUN": ""}):
+                    cleared = self.run_command(socket_path, ["show", "DRY_RUN"])
+                failed = self.run_command(socket_path, ["fail"])
+            finally:
+                daemon.terminate()
+                daemon.join(10)
+
+            self.assertFalse(socket_path.exists())
+
+        self.assertEqual(dry_run, (0, "'1'\n\n"))
+        self.assertEqual(unforwarded, (0, "null\n\n"))
+        self.assertEqual(cleared, (0, "''\n\n"))
+        self.assertEqual(failed[0], 1)
+
+    def forward(self, **patches):
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = Path(directory) / "provisioner.sock"
+            socket_path.touch()
+            with mock.patch.dict(
+                os.environ,
+                {"PROV_DAEMON_SOCKET": str(socket_path)},
+            ), mock.patch.multiple("common.daemon_client", **patches):
+                daemon_client.forward_to_daemon("__main__", "provision.py")
+
+    def test_runs_in_process_when_the_socket_is_not_accessible(self):
+        send_to_daemon = mock.Mock(
+            side_effect=PermissionError(13, "Permission denied")
+        )
+
+        self.forward(send_to_daemon=send_to_daemon)
+
+        send_to_daemon.assert_called_once()
+
+    def test_does_not_run_in_process_after_sending_the_command(self):
+        read_exit_code = mock.Mock(side_effect=ConnectionResetError())
+
+        with self.assertRaisesRegex(RuntimeError, "Lost the connection"):
+            self.forward(
+                send_to_daemon=mock.Mock(return_value=mock.MagicMock()),
+                read_exit_code=read_exit_code,
+            )
+
+        read_exit_code.assert_called_once()
+
+
+class ImpactTests(unittest.TestCase):
+    STACKS = {
+        "azure": None,
+        "kubernetes-shared": {
+            "system": set(),
+            "kube-state-metrics": {"system"},
+            "monitoring": set(),
+        },
+    }
+
+    def test_docs_affect_nothing(self):
+        self.assertEqual(
+            get_affected(
+                ["README.md", "docs/aks-shared-stack.md", "tests/x.py"],
+                self.STACKS,
+            ),
+            {},
+        )
+
+    def test_project_change_affects_its_dependents(self):
+        self.assertEqual(
+            get_affected(["kubernetes-shared/system/ingress.tf"], self.STACKS),
+            {
+                "kubernetes-shared": {
+                    "paths": ["kubernetes-shared/system/ingress.tf"],
+                    "projects": ["kube-state-metrics", "system"],
+                },
+            },
+        )
+
+    def test_shared_terragrunt_files_affect_every_project(self):
+        affected = get_affected(
+            ["kubernetes-shared/_common/locals.tf"],
+            self.STACKS,
+        )
+
+        self.assertEqual(
+            affected["kubernetes-shared"]["projects"],
+            ["kube-state-metrics", "monitoring", "system"],
+        )
+        self.assertNotIn("azure", affected)
+
+    def test_azure_change_affects_its_consumers(self):
+        affected = get_affected(["azure/aks.tf"], self.STACKS)
+
+        self.assertEqual(affected["azure"], {"paths": ["azure/aks.tf"]})
+        self.assertEqual(
+            affected["kubernetes-shared"]["projects"],
+            ["kube-state-metrics", "monitoring", "system"],
+        )
+
+
+class WorkflowTests(unittest.TestCase):
+    @mock.patch.object(workflow_utils, "get_stack_graphs")
+    def test_one_job_per_stack_and_project(self, get_stack_graphs):
+        get_stack_graphs.return_value = {
+            "azure": None,
+            "kubernetes-shared": {
+                "system": set(),
+                "kube-state-metrics": {"system"},
+            },
+        }
+
+        jobs = {
+            job["name"]: job for job in workflow_utils.get_provision_jobs()
+        }
+
+        self.assertEqual(
+            {name: job["dependencies"] for name, job in jobs.items()},
+            {
+                "Provision azure": [],
+                "Provision kubernetes-shared system": ["Provision azure"],
+                "Provision kubernetes-shared kube-state-metrics": [
+                    "Provision azure",
+                    "Provision kubernetes-shared system",
+                ],
+            },
+        )
+        self.assertTrue(jobs["Provision azure"]["upload_outputs"])
+        self.assertNotIn(
+            "--force",
+            jobs["Provision kubernetes-shared system"]["command"],
+        )
+        self.assertIn(
+            "--force",
+            jobs["Provision kubernetes-shared kube-state-metrics"]["command"],
+        )
+
+
+class OutputsCacheTests(unittest.TestCase):
+    def test_finds_workspaces_of_both_stacks(self):
+        self.assertEqual(
+            outputs_utils.get_terraform_workspace(
+                Path(azure_provision.SCRIPT_PATH).parent
+            ),
+            outputs_utils.Workspace(
+                "app.terraform.io",
+                "unicornsftw",
+                "unicorns-azure",
+            ),
+        )
+        self.assertEqual(
+            outputs_utils.get_terragrunt_workspace(
+                KUBERNETES_SHARED_DIR,
+                "system",
+            ).name,
+            "unicorns-kubernetes-shared-system",
+        )
+
+    def test_leaves_out_sensitive_outputs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = Path(directory) / "outputs.json"
+            outputs_utils.write_outputs_cache(
+                cache_path,
+                outputs_utils.Workspace("host", "organization", "azure"),
+                {
+                    "serial": 3,
+                    "outputs": {
+                        "aks_cluster_name": {"value": "cluster"},
+                        "aks_kube_config": {
+                            "value": "secret",
+                            "sensitive": True,
+                        },
+                    },
+                },
+            )
+
+            self.assertEqual(
+                outputs_utils.read_outputs_cache(cache_path),
+                {
+                    "workspace": "azure",
+                    "serial": 3,
+                    "outputs": {"aks_cluster_name": "cluster"},
+                    "sensitive": ["aks_kube_config"],
+                },
+            )
+
+    @mock.patch("common.provisioner_utils.init_environment")
+    @mock.patch("common.provisioner_utils.pull_stack_state")
+    @mock.patch("common.provisioner_utils.get_state_serial", return_value=2)
+    def test_refreshes_when_the_serial_changes(self, get_serial, pull, init):
+        pull.return_value = {
+            "serial": 3,
+            "outputs": {"ingress_static_ip": {"value": "192.0.2.2"}},
+        }
+        script_path = Path(azure_provision.SCRIPT_PATH)
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = Path(directory) / "outputs" / "unicorns-azure.json"
+            cache_path.parent.mkdir()
+            cache_path.write_text(
+                json.dumps(
+                    {
+                        "serial": 2,
+                        "outputs": {"ingress_static_ip": "192.0.2.1"},
+                    }
+                )
+            )
+
+            with mock.patch.dict(os.environ, {"PROV_CACHE_DIR": directory}):
+                unchanged = get_stack_outputs(script_path, refresh=True)
+                get_serial.return_value = 3
+                changed = get_stack_outputs(script_path, refresh=True)
+
+        self.assertEqual(unchanged, {"azure": {"ingress_static_ip": "192.0.2.1"}})
+        self.assertEqual(changed, {"azure": {"ingress_static_ip": "192.0.2.2"}})
+        pull.assert_called_once()
+
+
+@mock.patch.object(plugin_cache_utils, "PLUGIN_CACHE_USED", new_callable=set)
+@mock.patch.object(
+    plugin_cache_utils,
+    "PLUGIN_CACHE_STATS",
+    new_callable=Counter,
+)
+class PluginCacheTests(unittest.TestCase):
+    PROVIDER = "registry.terraform.io/hashicorp/helm/2.8.0"
+
+    def write_package(self, plugin_cache_dir: Path, provider: str, content):
+        package_dir = plugin_cache_utils.get_package_dir(
+            plugin_cache_dir,
+            provider,
+        )
+        package_dir.mkdir(parents=True, exist_ok=True)
+        (package_dir / "terraform-provider").write_bytes(content)
+        return package_dir
+
+    def write_lockfile(self, path: Path, provider: str, hashes):
+        source, version = provider.rsplit("/", 1)
+        path.write_text(
+            f'provider "{source}" {{\n'
+            f'  version = "{version}"\n'
+            "  hashes = [\n"
+            + "".join(f'    "{value}",\n' for value in hashes)
+            + "  ]\n}\n"
+        )
+
+    def test_package_hash_matches_terraform(self, stats, used):
+        with tempfile.TemporaryDirectory() as directory:
+            package_dir = Path(directory)
+            (package_dir / "terraform-provider").write_bytes(b"binary")
+
+            # sha256("binary") followed by two spaces and the file name.
+            self.assertEqual(
+                plugin_cache_utils.get_package_hash(package_dir),
+                "h1:XV78HgN1CIs8NPRhUjhclU+nGTmlc6qF/kbMlyRINt8=",
+            )
+
+    def test_counts_verified_packages_as_hits(self, stats, used):
+        with tempfile.TemporaryDirectory() as directory:
+            plugin_cache_dir = Path(directory) / "plugins"
+            lockfile = Path(directory) / ".terraform.lock.hcl"
+            package_dir = self.write_package(
+                plugin_cache_dir,
+                self.PROVIDER,
+                b"binary",
+            )
+            self.write_lockfile(
+                lockfile,
+                self.PROVIDER,
+                [plugin_cache_utils.get_package_hash(package_dir)],
+            )
+
+            misses = [plugin_cache_utils.check_plugin_cache(
+                plugin_cache_dir,
+                lockfile,
+            )]
+            (package_dir / "terraform-provider").write_bytes(b"tampered")
+            misses.append(plugin_cache_utils.check_plugin_cache(
+                plugin_cache_dir,
+                lockfile,
+            ))
+
+            self.assertEqual(misses, [[], [self.PROVIDER]])
+            self.assertEqual(stats, {"hits": 1, "misses": 1})
+
+    def test_evicts_least_recently_used_unused_versions(self, stats, used):
+        with tempfile.TemporaryDirectory() as directory:
+            plugin_cache_dir = Path(directory)
+            providers = [
+                "registry.terraform.io/hashicorp/helm/2.7.0",
+                "registry.terraform.io/hashicorp/helm/2.8.0",
+                "registry.terraform.io/hashicorp/helm/2.9.0",
+            ]
+            for index, provider in enumerate(providers):
+                self.write_package(plugin_cache_dir, provider, b"x" * 10)
+                plugin_cache_utils.update_usage_index(
+                    plugin_cache_dir,
+                    {provider: {"last_used": index}},
+                )
+            used.add(providers[0])
+
+            evicted = plugin_cache_utils.evict_plugin_cache(plugin_cache_dir, 15)
+
+            self.assertEqual(evicted, providers[1:])
+            self.assertEqual(
+                list(plugin_cache_utils.get_cached_packages(plugin_cache_dir)),
+                providers[:1],
+            )
+
+
+@mock.patch("common.snapshot_utils.atexit", mock.Mock())
+@mock.patch.object(snapshot_utils, "SNAPSHOT_SAVINGS", new_callable=dict)
+class InitSnapshotTests(unittest.TestCase):
+    def run_init(self, snapshot_dir: Path, key: str, target: Path, run_init):
+        with mock.patch("builtins.print"):
+            return snapshot_utils.run_with_snapshot(
+                snapshot_dir,
+                "kubernetes-shared/system",
+                key,
+                target,
+                run_init,
+            )
+
+    def test_restores_snapshot_with_matching_key(self, savings):
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_dir = Path(directory) / "snapshots"
+            target = Path(directory) / "run" / ".terraform"
+            key = "a" * 64
+
+            def run_init():
+                target.mkdir(parents=True)
+                (target / "terraform.tfstate").write_text("backend")
+
+            run_init = mock.Mock(side_effect=run_init)
+            self.run_init(snapshot_dir, key, target, run_init)
+            shutil.rmtree(target)
+            self.run_init(snapshot_dir, key, target, run_init)
+
+            run_init.assert_called_once()
+            self.assertEqual(
+                (target / "terraform.tfstate").read_text(),
+                "backend",
+            )
+            self.assertIn("kubernetes-shared/system", savings)
+
+            shutil.rmtree(target)
+            self.run_init(snapshot_dir, "b" * 64, target, run_init)
+            self.assertEqual(run_init.call_count, 2)
+            self.assertEqual(len(list(snapshot_dir.glob("*.tar.gz"))), 1)
+
+    @mock.patch.object(trace_utils, "TRACE_SPANS", new_callable=list)
+    def test_history_counts_restores_as_cache_hits(self, spans, savings):
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_dir = Path(directory) / "snapshots"
+            target = Path(directory) / "run" / ".terraform"
+
+            def run_init():
+                target.mkdir(parents=True)
+                (target / "terraform.tfstate").write_text("backend")
+
+            for _ in range(2):
+                with mock.patch("builtins.print"):
+                    snapshot_utils.run_with_snapshot(
+                        snapshot_dir,
+                        "kubernetes-shared/system",
+                        "a" * 64,
+                        target,
+                        run_init,
+                        stack="kubernetes-shared",
+                        project="system",
+                    )
+                shutil.rmtree(target)
+
+        rows = history_utils.get_phase_rows(spans, "run", {}, None)
+
+        self.assertEqual(
+            [(row[2], row[3], row[4], row[7]) for row in rows],
+            [
+                ("kubernetes-shared", "system", "snapshot", 0),
+                ("kubernetes-shared", "system", "snapshot", 1),
+            ],
+        )
+
+    def test_runs_init_when_snapshot_links_are_broken(self, savings):
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_dir = Path(directory) / "snapshots"
+            target = Path(directory) / "run" / ".terraform"
+            provider = Path(directory) / "plugins" / "provider"
+            provider.parent.mkdir()
+            provider.write_text("binary")
+            key = "a" * 64
+
+            def run_init():
+                target.mkdir(parents=True, exist_ok=True)
+                (target / "provider").unlink(missing_ok=True)
+                (target / "provider").symlink_to(provider)
+
+            run_init = mock.Mock(side_effect=run_init)
+            self.run_init(snapshot_dir, key, target, run_init)
+            shutil.rmtree(target)
+            provider.unlink()
+            self.run_init(snapshot_dir, key, target, run_init)
+
+            self.assertEqual(run_init.call_count, 2)
+            self.assertEqual(savings, {})
 
 
 if __name__ == "__main__":